@@ -1,5 +1,6 @@
 import asyncio
 import json
+import logging
 import random
 import socket  # To get the hostname
 import netifaces  # For getting MAC address
@@ -10,9 +11,14 @@ from bluez_peripheral.agent import NoIoAgent
 from bluez_peripheral.util import get_message_bus, Adapter
 from typing import Callable, Dict, Optional
 
+from ble_transfer import ChunkExchange
 from config import *
+from discovery import DutyCycle
+from peers import GossipCache, PeerManifests
 from sync import *
 
+logger = logging.getLogger(__name__)
+
 
 def get_wifi_mac_address():
     """Retrieve the MAC address of the Wi-Fi interface."""
@@ -25,13 +31,18 @@ def get_wifi_mac_address():
 
 # Define the BLE service
 class FileSharingService(Service):
-    def __init__(self, hostname: str, packages: Optional[Dict[str, Package]] = {}, on_manifest: Optional[Callable] = None):
+    def __init__(self, hostname: str, packages: Optional[Dict[str, Package]] = {}, on_manifest: Optional[Callable] = None,
+                 peers: Optional[PeerManifests] = None, gossip: Optional[GossipCache] = None):
         super().__init__(UUID, True)  # Custom service UUID
         self.hostname = hostname
-        self.client_requests = {}  # Map of client identifiers to requested files
+        self.client_requests = {}  # Map of client identifiers to their package requests
         self.mac_address = get_wifi_mac_address()  # Retrieve Wi-Fi MAC address
         self.packages: Dict[str, Package] = packages
         self.on_manifest = on_manifest
+        self.peers = peers if peers is not None else PeerManifests()
+        self.gossip = gossip if gossip is not None else GossipCache()
+        # Chunks moved over BLE when a diff is too small to bring up Wi-Fi for
+        self.chunks = ChunkExchange(self.packages)
     
     # Read-only characteristic to advertise the list of packages
     @characteristic(PKG_LIST_R, CharFlags.READ)
@@ -40,7 +51,9 @@ class FileSharingService(Service):
         pkg_list_with_mac = {
             "ssid": self.hostname,
             "mac": self.mac_address,  # Include the MAC address
-            "pkgs": list(self.packages.keys())
+            "pkgs": list(self.packages.keys()),
+            # What we've heard of other peers' manifests, to help the reader pick who to sync with
+            "gossip": self.gossip.export(),
         }
         return bytes(json.dumps(pkg_list_with_mac), "utf-8")
 
@@ -55,10 +68,15 @@ class FileSharingService(Service):
         # Use client-specific identifier from options
         client_id = options.device
 
-        # Decode the package name from the client's write request
-        requested_pkg = value.decode("utf-8")
-        self.client_requests[client_id] = requested_pkg
-        print(f"Client {client_id} requested file: {requested_pkg}")
+        # Requests are {"pkg", "ssid", "seen"}; older peers write just the package name
+        try:
+            request = json.loads(value)
+        except ValueError:
+            request = None
+        if not isinstance(request, dict):
+            request = {"pkg": value.decode("utf-8")}
+        self.client_requests[client_id] = request
+        logger.debug(f"Client {client_id} requested file: {request['pkg']}")
 
     # Read-only characteristic to respond with package manifest
     @characteristic(PKG_MANIFEST_R, CharFlags.READ)
@@ -68,11 +86,12 @@ class FileSharingService(Service):
 
         # Check if this client has made a request
         if client_id in self.client_requests:
-            requested_pkg = self.client_requests[client_id]
-            if requested_pkg in self.packages:
-                pkg = self.packages[requested_pkg]
-                # Return manifest as a JSON list
-                return bytes(json.dumps(pkg.load_manifest(FILE_DIR + "/manifest.json")), "utf-8")
+            request = self.client_requests[client_id]
+            if request["pkg"] in self.packages:
+                pkg = self.packages[request["pkg"]]
+                # Only what changed since the client last saw our manifest, and
+                # what we've seen of theirs, so they can do the same
+                return pkg.manifest.serialize_for(request.get("seen"), seen=self.peers.seen(request.get("ssid")))
 
         # Return an empty list if no valid request is found
         return bytes(json.dumps([]), "utf-8")
@@ -88,42 +107,132 @@ class FileSharingService(Service):
         try:
             decoded = value.decode("utf-8")
             parsed = json.loads(decoded)
-            self.on_manifest(parsed)
+            manifest = self.peers.apply(parsed["ssid"], parsed)
+            if manifest is None:
+                logger.info(f'Delta manifest from {parsed["ssid"]} did not match what we have; dropping it')
+                return
+            self.gossip.merge(parsed.get("gossip"), via=parsed["ssid"], us=self.hostname)
+            self.gossip.note(parsed["ssid"], manifest)
+            self.on_manifest({"ssid": parsed["ssid"], "manifest": manifest})
         except Exception as e:
-            print(f'Failed to process manifest: {str(e)}')
+            logger.error(f'Failed to process manifest: {str(e)}')
 
 
-async def ble_server(packages = None, on_manifest = None):
-    """
-    Hosts the FileSharingService over Bluetooth LE.
-    """
-    # Get the system D-Bus connection
-    bus = await get_message_bus()
-
-    # Retrieve the hostname for uniqueness
-    hostname = socket.gethostname()
+    # Write-only characteristic for chunk requests, pushed chunk pieces and "done" (see ble_transfer)
+    @characteristic(PKG_CHUNK_W, CharFlags.WRITE)
+    def pkg_chunk(self, options):
+        pass  # Placeholder (Python 3.9+ doesn't require this)
 
-    # Create and register the file-sharing service
-    service = FileSharingService(hostname, packages, on_manifest=on_manifest)
-    service_collection = ServiceCollection()
-    service_collection.add_service(service)
-    await service_collection.register(bus)
+    # Setter for the chunk characteristic
+    @pkg_chunk.setter
+    def write_pkg_chunk(self, value, options):
+        try:
+            self.chunks.write(options.device, bytes(value))
+        except Exception as e:
+            logger.error(f'Failed to process chunk write: {str(e)}')
 
-    # how long to spend advertising before scanning
-    timeout = 10 * int(hostname[-1])
+    # Read-only characteristic returning the chunk piece last asked for
+    @characteristic(PKG_CHUNK_R, CharFlags.READ)
+    def read_pkg_chunk(self, options):
+        return self.chunks.read(options.device)
 
-    # Advertise the file-sharing service using the hostname
-    advert = Advertisement(f"FileShare-{hostname}", [service._uuid], 0x0040, timeout)
-    adapter = await Adapter.get_first(bus)
-    await advert.register(bus, adapter)
 
-    agent = NoIoAgent()
-    await agent.register(bus)
+async def _sleep_unless(stop: asyncio.Event, seconds: float):
+    """Sleep for `seconds`, waking early if `stop` is set."""
+    try:
+        await asyncio.wait_for(stop.wait(), seconds)
+    except asyncio.TimeoutError:
+        pass
 
-    print(f"File Sharing Service is running as '{hostname}' and being advertised.")
 
-    await asyncio.sleep(timeout)
-    await agent.unregister(bus)
+class BLEAdvertiser:
+    """
+    Keeps the FileSharingService registered with BlueZ across sync rounds.
+    Registration happens once; each round only refreshes the advertisement.
+    """
+    def __init__(self, hostname: str, packages: Optional[Dict[str, Package]] = None, on_manifest: Optional[Callable] = None,
+                 peers: Optional[PeerManifests] = None, gossip: Optional[GossipCache] = None):
+        self.hostname = hostname
+        self.service = FileSharingService(hostname, packages or {}, on_manifest=on_manifest, peers=peers,
+                                          gossip=gossip)
+        self.bus = None
+        self.adapter = None
+        self.agent = None
+        self.advert_path = "/com/spacecheese/bluez_peripheral/advert0"
+        self.ble_transfer_done = asyncio.Event()
+        self.service.chunks.on_done = lambda client_id: self.ble_transfer_done.set()
+
+    async def start(self):
+        """Connect to D-Bus and register the service and agent, once."""
+        if self.bus:
+            return
+
+        # Get the system D-Bus connection
+        self.bus = await get_message_bus()
+
+        # Register the file-sharing service
+        service_collection = ServiceCollection()
+        service_collection.add_service(self.service)
+        await service_collection.register(self.bus)
+
+        self.adapter = await Adapter.get_first(self.bus)
+
+        self.agent = NoIoAgent()
+        await self.agent.register(self.bus)
+
+        logger.info(f"File Sharing Service is running as '{self.hostname}' and being advertised.")
+
+    def reset(self):
+        """Forget per-round client requests."""
+        self.service.client_requests.clear()
+        self.ble_transfer_done.clear()
+
+    async def wait_for_ble_transfer(self, timeout: float) -> bool:
+        """Wait for a central to finish moving chunks over BLE; False if it didn't in time."""
+        try:
+            await asyncio.wait_for(self.ble_transfer_done.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    async def advertise(self, duty: Optional[DutyCycle] = None, stop: Optional[asyncio.Event] = None):
+        """
+        Advertise in bursts paced by `duty` until `stop` is set, so this can
+        run alongside the scanner on the same event loop.
+        """
+        if duty is None:
+            duty = DutyCycle()
+        if stop is None:
+            stop = asyncio.Event()
+
+        await self.start()
+
+        # bluez_peripheral doesn't expose the advertising interval, so pace the
+        # advertiser with timed bursts instead; the burst length and the gap
+        # between bursts follow the shared duty cycle.
+        while not stop.is_set():
+            timeout = max(1, round(duty.next_window()))
+            self.bus.unexport(self.advert_path)
+            advert = Advertisement(f"FileShare-{self.hostname}", [self.service._uuid], 0x0040, timeout)
+            await advert.register(self.bus, self.adapter, self.advert_path)
+            await _sleep_unless(stop, timeout + duty.next_gap())
+
+    async def close(self):
+        if self.agent:
+            await self.agent.unregister(self.bus)
+        self.bus = None
+
+
+async def ble_server(packages = None, on_manifest = None, duty: Optional[DutyCycle] = None,
+                     stop: Optional[asyncio.Event] = None):
+    """
+    Hosts the FileSharingService over Bluetooth LE for a single round.
+    """
+    advertiser = BLEAdvertiser(socket.gethostname(), packages, on_manifest=on_manifest)
+    try:
+        await advertiser.advertise(duty, stop)
+    finally:
+        await advertiser.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,142 @@
+"""
+Bytes transferred for typical update sets, fixed vs adaptive block sizes.
+
+For each scenario, a source package is built from an initial set of files
+and a peer syncs it. The source then applies a typical update and the peer
+syncs again. The benchmark reports what the second sync costs: chunks
+requested, chunk payload bytes, manifest bytes, and a total that also counts
+per-chunk request/frame overhead.
+
+Usage:
+    python bench_block_size.py
+    python bench_block_size.py --scale 4 --json results.json
+"""
+import argparse
+import json
+import random
+import tempfile
+from typing import Callable, Dict, List, Optional, Tuple
+
+from sync import DEFAULT_BLOCK_SIZE, Package
+
+# Rough size of a request message plus the metadata of its 'file' frame
+PER_CHUNK_OVERHEAD = 200
+
+Files = Dict[str, bytes]
+
+
+def edit(data: bytes, rng: random.Random, edits: int, size: int = 16) -> bytes:
+    """Overwrite `edits` random spans of `size` bytes."""
+    data = bytearray(data)
+    for _ in range(edits):
+        offset = rng.randrange(max(1, len(data) - size))
+        data[offset:offset + size] = rng.randbytes(size)
+    return bytes(data)
+
+
+# Each scenario returns (initial files, updated files, changes per day)
+
+def config_files(rng: random.Random, scale: int) -> Tuple[Files, Files, float]:
+    """Small config files, a few of them edited."""
+    before = {f"/etc/app{n}.conf": rng.randbytes(rng.randrange(1024, 32 * 1024)) for n in range(50 * scale)}
+    after = dict(before)
+    for path in rng.sample(sorted(before), 5 * scale):
+        after[path] = edit(before[path], rng, 2)
+    return before, after, 48
+
+
+def append_log(rng: random.Random, scale: int) -> Tuple[Files, Files, float]:
+    """A growing log or database file, appended to. Its end falls inside a block, as a log's usually does."""
+    before = {"/var/app/events.log": rng.randbytes(16 * 1048576 * scale + 1536 * 1024)}
+    after = {"/var/app/events.log": before["/var/app/events.log"] + rng.randbytes(64 * 1024)}
+    return before, after, 24
+
+
+def source_tree(rng: random.Random, scale: int) -> Tuple[Files, Files, float]:
+    """Mid-sized files, some edited in the middle."""
+    before = {f"/src/module{n}.py": rng.randbytes(rng.randrange(16 * 1024, 512 * 1024)) for n in range(100 * scale)}
+    after = dict(before)
+    for path in rng.sample(sorted(before), 10 * scale):
+        after[path] = edit(before[path], rng, 3, size=256)
+    return before, after, 1
+
+
+def disk_image(rng: random.Random, scale: int) -> Tuple[Files, Files, float]:
+    """A large image that rarely changes, patched in a few places."""
+    before = {"/img/rootfs.img": rng.randbytes(128 * 1048576 * scale)}
+    after = {"/img/rootfs.img": edit(before["/img/rootfs.img"], rng, 20, size=4096)}
+    return before, after, 0.01
+
+
+SCENARIOS: Dict[str, Callable] = {
+    "config_files": config_files,
+    "append_log": append_log,
+    "source_tree": source_tree,
+    "disk_image": disk_image,
+}
+
+
+def build(base: str, files: Files, changes_per_day: float, block_size: Optional[int]) -> Package:
+    # Index mode keeps chunks on disk unpadded, so big blocks don't cost memory
+    pkg = Package("bench", 1, base, use_index=True)
+    for path, data in files.items():
+        pkg.add_file(path, data, changes_per_day, block_size=block_size)
+    return pkg
+
+
+def sync_cost(scenario: str, block_size: Optional[int], scale: int, seed: int) -> Dict:
+    """Sync a peer to the initial files, update them, and measure the second sync."""
+    before, after, changes_per_day = SCENARIOS[scenario](random.Random(seed), scale)
+    with tempfile.TemporaryDirectory() as source_dir, tempfile.TemporaryDirectory() as peer_dir:
+        source = build(source_dir, before, changes_per_day, block_size)
+        peer = Package("bench", 1, peer_dir, use_index=True)
+        peer.sync_chunks(source, peer.get_missing_chunks(source.manifest.to_dict()))
+
+        for path, data in after.items():
+            if before.get(path) != data:
+                source.add_file(path, data, changes_per_day, block_size=block_size)
+
+        manifest = source.manifest.to_dict()
+        missing = peer.get_missing_chunks(manifest)
+        payload = sum(source.get_chunk_length(c.file_path, c.block_number, c.version) or 0 for c in missing)
+        manifest_bytes = len(source.manifest.serialize())
+        sizes = sorted({source.get_block_size(path) for path in after})
+
+    changed = sum(len(data) for path, data in after.items() if before.get(path) != data)
+    return {
+        "scenario": scenario,
+        "block_size": "adaptive" if block_size is None else block_size,
+        "block_sizes_used": sizes,
+        "changed_file_bytes": changed,
+        "chunks": len(missing),
+        "payload_bytes": payload,
+        "manifest_bytes": manifest_bytes,
+        "total_bytes": payload + manifest_bytes + len(missing) * PER_CHUNK_OVERHEAD,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--only", action="append", choices=sorted(SCENARIOS), help="run only these scenarios")
+    parser.add_argument("--scale", type=int, default=1, help="multiply file counts and sizes")
+    parser.add_argument("--fixed", type=int, default=DEFAULT_BLOCK_SIZE, help="fixed block size to compare against")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="also write results to this file")
+    args = parser.parse_args()
+
+    results: List[Dict] = []
+    print(f"{'scenario':<14} {'blocks':>9} {'chunks':>7} {'payload':>12} {'manifest':>10} {'total':>12}")
+    for scenario in args.only or list(SCENARIOS):
+        for block_size in (args.fixed, None):
+            result = sync_cost(scenario, block_size, args.scale, args.seed)
+            results.append(result)
+            print(f"{scenario:<14} {str(result['block_size']):>9} {result['chunks']:>7} "
+                  f"{result['payload_bytes']:>12,} {result['manifest_bytes']:>10,} {result['total_bytes']:>12,}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+"""
+Load test for concurrent transfer sessions on one FileTransferServer.
+
+Starts a server holding a synthetic source package on 127.0.0.1, then
+connects many simulated clients at once, each with its own stale copy of
+the package, and has every client pull its diff. Reports per-client
+completion time percentiles, aggregate throughput and how many sessions
+succeeded, to check that one slow or finished client doesn't stall or end
+the others.
+
+Usage:
+    python bench_sessions.py --clients 10
+    python bench_sessions.py --clients 50 --chunks 8 --chunk-size 262144 --workers 16
+"""
+if __name__ == "__main__":
+    # Before anything imports threading or socket (see main.py)
+    import eventlet
+    eventlet.monkey_patch()
+
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from typing import Dict, List
+
+from bench_transfer import build_packages, load_package, percentile, wait_for_port
+from file_server import FileTransferServer
+
+
+def run_client(stale_dir: str, source_manifest: Dict, host: str, port: int, result: Dict):
+    pkg = load_package(stale_dir)
+    diff = pkg.get_missing_chunks(source_manifest)
+    result["chunks_wanted"] = len(diff)
+    transfer = FileTransferServer(pkg, callback=lambda success: result.setdefault("success", success),
+                                  host=host, port=port, request_delay=0)
+    started = time.perf_counter()
+    transfer.start_client(diff)
+    result["seconds"] = time.perf_counter() - started
+    result["chunks"] = sum(session.stats["chunks_received"] for session in transfer.completed_sessions)
+    result["bytes"] = sum(session.stats["bytes_received"] for session in transfer.completed_sessions)
+
+
+def run_load(clients: int, source_dir: str, stale_dir: str, base_dir: str, host: str, port: int,
+             workers: int) -> Dict:
+    source = load_package(source_dir)
+    server = FileTransferServer(source, callback=lambda success: None, host=host, port=port,
+                                request_delay=0, max_workers=workers)
+    server.serve()
+    wait_for_port(host, port)
+
+    results: List[Dict] = [{} for _ in range(clients)]
+    threads = []
+    for n in range(clients):
+        client_dir = os.path.join(base_dir, f"client{n}")
+        shutil.copytree(stale_dir, client_dir)
+        threads.append(threading.Thread(target=run_client, daemon=True,
+                                        args=(client_dir, source.manifest.to_dict(), host, port, results[n])))
+
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    server.stop()
+
+    seconds = [result.get("seconds", elapsed) for result in results]
+    total_bytes = sum(result.get("bytes", 0) for result in results)
+    return {
+        "clients": clients,
+        "workers": workers,
+        "succeeded": sum(1 for result in results
+                         if result.get("success") and result.get("chunks") == result.get("chunks_wanted")),
+        "seconds": elapsed,
+        "mb_per_s": total_bytes / elapsed / 1e6 if elapsed else 0.0,
+        "client_seconds_p50": percentile(seconds, 50),
+        "client_seconds_p90": percentile(seconds, 90),
+        "client_seconds_max": max(seconds) if seconds else 0.0,
+        "server_sessions": len(server.completed_sessions),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=65432)
+    parser.add_argument("--clients", type=int, action="append",
+                        help="simulated clients (repeatable; default: 10, 25 and 50)")
+    parser.add_argument("--workers", type=int, default=8, help="server worker pool size")
+    parser.add_argument("--chunks", type=int, default=8)
+    parser.add_argument("--chunk-size", type=int, default=256 * 1024)
+    parser.add_argument("--changed", type=float, default=1.0, help="fraction of blocks newer in the source")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="also write results to this file")
+    args = parser.parse_args()
+
+    results = []
+    for clients in args.clients or [10, 25, 50]:
+        with tempfile.TemporaryDirectory() as base_dir:
+            source_dir, stale_dir = build_packages(base_dir, args.chunks, args.chunk_size, 0.0,
+                                                   args.changed, seed=args.seed)
+            result = run_load(clients, source_dir, stale_dir, base_dir, args.host, args.port, args.workers)
+        results.append(result)
+        print(json.dumps(result, indent=2))
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""
+Cold-start import benchmark.
+
+Imports each module in a fresh interpreter under `python -X importtime`
+and reports the total import time, the wall time of the interpreter, and
+the slowest of its direct imports. `main` is measured the way its entry
+point runs, with eventlet imported and the standard library patched first.
+The BLE stacks and the transfer server are only imported when a round needs
+them, so they're measured on their own; discovery loads both BLE stacks in
+the first round.
+
+Usage:
+    python bench_startup.py
+    python bench_startup.py --module main --module file_server --runs 5 --json startup.json
+"""
+import argparse
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+import time
+from typing import Dict, List
+
+MODULES = ("main", "advertiser", "scanner", "file_server", "multicast")
+
+# What an entry point runs before importing the module (see main.py)
+PRELUDES = {
+    "main": "import eventlet; eventlet.monkey_patch(); ",
+}
+
+# "import time: self [us] | cumulative | imported package"
+LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|(\s*)(\S+)")
+
+
+def parse_importtime(stderr: str) -> List[Dict]:
+    """The -X importtime report as [{"module", "self_us", "cumulative_us", "depth"}]."""
+    imports = []
+    for line in stderr.splitlines():
+        match = LINE.match(line)
+        if match:
+            self_us, cumulative_us, indent, module = match.groups()
+            imports.append({"module": module, "self_us": int(self_us), "cumulative_us": int(cumulative_us),
+                            "depth": (len(indent) - 1) // 2})
+    return imports
+
+
+def measure(module: str, runs: int, top: int) -> Dict:
+    totals, walls, error = [], [], None
+    imports: List[Dict] = []
+    here = os.path.dirname(os.path.abspath(__file__))
+    for _ in range(runs):
+        started = time.perf_counter()
+        result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"{PRELUDES.get(module, '')}import {module}"],
+                                cwd=here, capture_output=True, text=True)
+        walls.append(time.perf_counter() - started)
+        if result.returncode != 0:
+            error = result.stderr.strip().splitlines()[-1] if result.stderr.strip() else "import failed"
+            break
+        imports = parse_importtime(result.stderr)
+        totals.append(sum(item["self_us"] for item in imports) / 1e6)
+    return {
+        "module": module,
+        "runs": len(totals),
+        "error": error,
+        "import_seconds": statistics.median(totals) if totals else None,
+        "wall_seconds": statistics.median(walls) if walls else None,
+        "slowest": [
+            {"module": item["module"], "cumulative_ms": item["cumulative_us"] / 1000}
+            for item in sorted(imports, key=lambda item: -item["cumulative_us"]) if item["depth"] == 1
+        ][:top],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--module", action="append", help=f"module to import (repeatable; default: {', '.join(MODULES)})")
+    parser.add_argument("--runs", type=int, default=3, help="fresh interpreters per module (median reported)")
+    parser.add_argument("--top", type=int, default=10, help="slowest top-level imports to list")
+    parser.add_argument("--json", help="also write results to this file")
+    args = parser.parse_args()
+
+    results = [measure(module, args.runs, args.top) for module in args.module or MODULES]
+    for result in results:
+        print(json.dumps(result, indent=2))
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,258 @@
+"""
+Micro-benchmarks for the sync.py hot paths at scale.
+
+Each benchmark runs over a grid of package sizes (total blocks x files) and
+records the best of a few repeats. Results are written as JSON, tagged with
+the current commit, so runs can be compared between commits.
+
+Usage:
+    python bench_sync.py                          # quick grid, up to 100k blocks
+    python bench_sync.py --full                   # up to 1M blocks / 10k files
+    python bench_sync.py --only get_missing_chunks --output results.json
+    python bench_sync.py --compare old.json new.json
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+from typing import Callable, Dict, List, Tuple
+
+from metrics import Metrics, NullMetrics
+from sync import ChunkedFile, Package
+
+# Tiny blocks keep memory bounded at 1M blocks; the costs measured here are
+# per block and per file, not per byte
+BENCH_BLOCK_SIZE = 64
+CHUNK = b"x" * BENCH_BLOCK_SIZE
+
+QUICK_GRID = [(10, 1), (1_000, 1), (1_000, 100), (100_000, 1), (100_000, 1_000)]
+FULL_GRID = QUICK_GRID + [(1_000_000, 1), (1_000_000, 10_000)]
+
+# Benchmarks that touch one file per block on disk are capped lower
+MAX_DISK_BLOCKS = 100_000
+
+
+def block_layout(blocks: int, files: int):
+    for n in range(blocks):
+        yield f"/bench/file{n % files}.bin", n // files
+
+
+def build_package(blocks: int, files: int, base_path: str = None, version: int = 1,
+                  use_segments: bool = False) -> Package:
+    """Fill a package directly, without paying for a manifest save per block."""
+    pkg = Package("bench", 1, base_path, block_size=BENCH_BLOCK_SIZE, use_segments=use_segments)
+    for path, block_number in block_layout(blocks, files):
+        if path not in pkg.files:
+            pkg.files[path] = ChunkedFile(BENCH_BLOCK_SIZE)
+        pkg.files[path].write_block(block_number, CHUNK, version)
+        pkg.manifest.update(path, block_number, version)
+    return pkg
+
+
+def newer_manifest(blocks: int, files: int, fraction: float = 0.1) -> Dict:
+    """A peer manifest where `fraction` of the blocks are at version 2."""
+    stride = max(1, int(1 / fraction))
+    manifest = {"name": "bench", "version": 1, "files": {}}
+    for n, (path, block_number) in enumerate(block_layout(blocks, files)):
+        manifest["files"].setdefault(path, {})[str(block_number)] = 2 if n % stride == 0 else 1
+    return manifest
+
+
+def timed(fn: Callable[[], None], repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+# Each benchmark takes (blocks, files, repeat) and returns (seconds, operations)
+
+def bench_write_chunk(blocks, files, repeat):
+    pkg = build_package(blocks, files)
+    targets = list(block_layout(min(blocks, 1_000), files))
+    version = [1]
+    def run():
+        version[0] += 1
+        for path, block_number in targets:
+            pkg.write_chunk(path, block_number, CHUNK, version[0])
+    return timed(run, repeat), len(targets)
+
+
+def bench_write_chunk_disk(blocks, files, repeat, use_segments=False):
+    with tempfile.TemporaryDirectory() as base:
+        pkg = build_package(blocks, files, base, use_segments=use_segments)
+        targets = list(block_layout(min(blocks, 20), files))
+        version = [1]
+        def run():
+            version[0] += 1
+            for path, block_number in targets:
+                pkg.write_chunk(path, block_number, CHUNK, version[0])
+        return timed(run, repeat), len(targets)
+
+
+def bench_save_manifest(blocks, files, repeat):
+    with tempfile.TemporaryDirectory() as base:
+        pkg = build_package(blocks, files, base)
+        version = [1]
+        def run():
+            # Invalidate the cached serialization, as a chunk write would
+            version[0] += 1
+            pkg.manifest.update("/bench/file0.bin", 0, version[0])
+            pkg.save_manifest()
+        return timed(run, repeat), 1
+
+
+def bench_load_from_filesystem(blocks, files, repeat, use_segments=False):
+    if blocks > MAX_DISK_BLOCKS:
+        return None
+    with tempfile.TemporaryDirectory() as base:
+        pkg = build_package(blocks, files, base, use_segments=use_segments)
+        for path, block_number in block_layout(blocks, files):
+            pkg.store.write(pkg._generate_chunk_filename(path, block_number, 1), CHUNK)
+        pkg.store.close()
+        pkg.save_manifest()
+        def run():
+            loaded = Package("bench", 1, base, block_size=BENCH_BLOCK_SIZE, use_segments=use_segments)
+            loaded.load_from_filesystem()
+            loaded.store.close()
+        return timed(run, repeat), 1
+
+
+def bench_manifests_differ(blocks, files, repeat):
+    ours = build_package(blocks, files).manifest.to_dict()
+    # Identical manifests are the worst case: every block gets compared
+    theirs = json.loads(json.dumps(ours))
+    return timed(lambda: Package.manifests_differ(ours, theirs), repeat), 1
+
+
+def bench_get_missing_chunks(blocks, files, repeat):
+    pkg = build_package(blocks, files)
+    theirs = newer_manifest(blocks, files)
+    return timed(lambda: pkg.get_missing_chunks(theirs), repeat), 1
+
+
+def bench_get_version_map(blocks, files, repeat):
+    pkg = build_package(blocks, files)
+    def run():
+        for chunked_file in pkg.files.values():
+            chunked_file.get_version_map()
+    return timed(run, repeat), 1
+
+
+def bench_sync_chunks(blocks, files, repeat):
+    source = build_package(blocks, files, version=2)
+    missing = build_package(blocks, files).get_missing_chunks(newer_manifest(blocks, files))
+    def run():
+        build_package(0, 1).sync_chunks(source, missing)
+    return timed(run, repeat), len(missing)
+
+
+def bench_metrics(blocks, files, repeat, enabled=False):
+    """The per-chunk instrumentation of a transfer: a counter and a span."""
+    if files != 1:
+        return None
+    metrics = Metrics() if enabled else NullMetrics()
+    def run():
+        for _ in range(blocks):
+            metrics.inc("chunks_received")
+            with metrics.span("chunk"):
+                pass
+    return timed(run, repeat), blocks
+
+
+BENCHMARKS = {
+    "write_chunk": bench_write_chunk,
+    "write_chunk_disk": bench_write_chunk_disk,
+    "write_chunk_segments": lambda *args: bench_write_chunk_disk(*args, use_segments=True),
+    "save_manifest": bench_save_manifest,
+    "load_from_filesystem": bench_load_from_filesystem,
+    "load_from_filesystem_segments": lambda *args: bench_load_from_filesystem(*args, use_segments=True),
+    "manifests_differ": bench_manifests_differ,
+    "get_missing_chunks": bench_get_missing_chunks,
+    "get_version_map": bench_get_version_map,
+    "sync_chunks": bench_sync_chunks,
+    "metrics_disabled": bench_metrics,
+    "metrics_enabled": lambda *args: bench_metrics(*args, enabled=True),
+}
+
+
+def current_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or "unknown"
+    except OSError:
+        return "unknown"
+
+
+def run_suite(grid: List[Tuple[int, int]], names: List[str], repeat: int) -> Dict:
+    results = []
+    for name in names:
+        for blocks, files in grid:
+            measured = BENCHMARKS[name](blocks, files, repeat)
+            if measured is None:
+                continue
+            seconds, ops = measured
+            results.append({
+                "name": name,
+                "blocks": blocks,
+                "files": files,
+                "seconds": seconds,
+                "per_op": seconds / ops if ops else seconds,
+            })
+            print(f"{name:<22} blocks={blocks:<9} files={files:<7} {seconds * 1000:10.3f} ms"
+                  f"  ({seconds / max(ops, 1) * 1e6:.1f} us/op)")
+    return {
+        "commit": current_commit(),
+        "timestamp": time.time(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "repeat": repeat,
+        "results": results,
+    }
+
+
+def compare(old_path: str, new_path: str):
+    """Print the per-benchmark speedup between two result files."""
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+    baseline = {(r["name"], r["blocks"], r["files"]): r["seconds"] for r in old["results"]}
+    print(f"{'benchmark':<22} {'blocks':>9} {'files':>7} {old['commit']:>10} {new['commit']:>10}  speedup")
+    for r in new["results"]:
+        key = (r["name"], r["blocks"], r["files"])
+        if key not in baseline:
+            continue
+        before, after = baseline[key], r["seconds"]
+        print(f"{r['name']:<22} {r['blocks']:>9} {r['files']:>7} {before * 1000:>8.2f}ms {after * 1000:>8.2f}ms"
+              f"  {before / after if after else float('inf'):6.2f}x")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--full", action="store_true", help="include the 1M block / 10k file sizes")
+    parser.add_argument("--only", action="append", choices=sorted(BENCHMARKS), help="run only these benchmarks")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", help="results file (default: bench_results/<commit>.json)")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="compare two result files and exit")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    report = run_suite(FULL_GRID if args.full else QUICK_GRID, args.only or list(BENCHMARKS), args.repeat)
+    output = args.output or os.path.join("bench_results", f"{report['commit']}.json")
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,251 @@
+"""
+End-to-end transfer benchmark for FileTransferServer over loopback.
+
+Builds a synthetic source package and a stale copy of it, then syncs the
+stale copy from the source through a real socket.io server and client on
+127.0.0.1 and reports throughput, time to first chunk, per-chunk latency
+percentiles, CPU time and peak RSS for each transport mode.
+
+With --link, the client reaches the server through a LinkShaper proxy
+(see linkshaper.py) that degrades the link according to a scripted
+scenario, to measure goodput and completion on bad links.
+
+Modes:
+    client-pull  the client has the diff and requests chunks from the server
+    server-pull  the server has the diff and requests chunks from the client
+
+Usage:
+    python bench_transfer.py --chunks 32 --chunk-size 1048576 --changed 0.5
+    python bench_transfer.py --mode server-pull --processes 2 --json results.json
+    python bench_transfer.py --link wifi-poor --link drop-mid
+"""
+if __name__ in ("__main__", "__mp_main__"):
+    # Before anything imports threading or socket (see main.py). A sender
+    # process for --processes 2 re-runs this script as __mp_main__.
+    import eventlet
+    eventlet.monkey_patch()
+
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import resource
+import socket
+import tempfile
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+from file_server import FileTransferServer
+from linkshaper import SCENARIOS, LinkProfile, LinkShaper
+from sync import Package
+
+MODES = ("client-pull", "server-pull")
+
+
+def make_chunk(rng: random.Random, size: int, compressibility: float) -> bytes:
+    """Random bytes, with the given fraction replaced by zeros."""
+    zeros = int(size * compressibility)
+    return rng.randbytes(size - zeros) + bytes(zeros)
+
+
+def build_packages(base_dir: str, chunks: int, chunk_size: int, compressibility: float,
+                   changed: float, files: int = 1, seed: int = 0) -> Tuple[str, str]:
+    """
+    Write a source package and a stale copy of it to disk.
+
+    Every block exists at version 1 in both; `changed` of the blocks are
+    bumped to version 2 in the source only.
+
+    Returns:
+        tuple: (source package dir, stale package dir)
+    """
+    rng = random.Random(seed)
+    source_dir = os.path.join(base_dir, "source")
+    stale_dir = os.path.join(base_dir, "stale")
+    source = Package("bench", 1, source_dir)
+    stale = Package("bench", 1, stale_dir)
+
+    blocks = [(f"/bench/file{n % files}.bin", n // files) for n in range(chunks)]
+    for path, block_number in blocks:
+        data = make_chunk(rng, chunk_size, compressibility)
+        source.write_chunk(path, block_number, data, version=1)
+        stale.write_chunk(path, block_number, data, version=1)
+    for path, block_number in rng.sample(blocks, int(len(blocks) * changed)):
+        source.write_chunk(path, block_number, make_chunk(rng, chunk_size, compressibility), version=2)
+    return source_dir, stale_dir
+
+
+def load_package(package_dir: str) -> Package:
+    pkg = Package("bench", 1, package_dir)
+    pkg.load_from_filesystem()
+    return pkg
+
+
+def wait_for_port(host: str, port: int, timeout: float = 10.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection((host, port), timeout=0.5):
+                return
+        except OSError:
+            time.sleep(0.05)
+    raise TimeoutError(f"Nothing listening on {host}:{port}")
+
+
+def run_sender(mode: str, package_dir: str, host: str, port: int, client_port: int):
+    """Serve chunks to the receiver: as the server (client-pull) or the client (server-pull)."""
+    if mode == "client-pull":
+        transfer = FileTransferServer(load_package(package_dir), callback=lambda success: None,
+                                      host=host, port=port, request_delay=0)
+        transfer.start_server()
+        # The server outlives its round; free the port for the next mode
+        transfer.stop()
+    else:
+        transfer = FileTransferServer(load_package(package_dir), callback=lambda success: None,
+                                      host=host, port=client_port, request_delay=0)
+        wait_for_port(host, port)
+        transfer.start_client([])
+
+
+def percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+def run_transfer(mode: str, source_dir: str, stale_dir: str, host: str, port: int, processes: int,
+                 link: Optional[LinkProfile] = None, link_port: Optional[int] = None) -> Dict:
+    """
+    Sync the stale package from the source once and measure it.
+
+    With a `link` profile, the client connects to the server through a
+    LinkShaper listening on `link_port`.
+    """
+    receiver_pkg = load_package(stale_dir)
+    diff = receiver_pkg.get_missing_chunks(load_package(source_dir).manifest.to_dict())
+
+    # Record when each chunk lands
+    arrivals: List[float] = []
+    received_bytes = [0]
+    write_chunk = receiver_pkg.write_chunk
+    def timed_write_chunk(path, block_number, data, version=1, block_size=None):
+        result = write_chunk(path, block_number, data, version, block_size)
+        arrivals.append(time.perf_counter())
+        received_bytes[0] += len(data)
+        return result
+    receiver_pkg.write_chunk = timed_write_chunk
+
+    shaper = None
+    client_port = port
+    if link is not None:
+        client_port = link_port or port + 1
+        shaper = LinkShaper(client_port, port, link, listen_host=host, target_host=host)
+        shaper.start()
+
+    outcome = {}
+    receiver = FileTransferServer(receiver_pkg, callback=lambda success: outcome.setdefault("success", success),
+                                  host=host, port=client_port if mode == "client-pull" else port,
+                                  request_delay=0)
+
+    sender_args = (mode, source_dir, host, port, client_port)
+    if processes == 2:
+        # Spawned, not forked: a fork would inherit our eventlet hub and
+        # whatever green threads the previous mode left on it
+        sender = multiprocessing.get_context("spawn").Process(target=run_sender, args=sender_args)
+    else:
+        sender = threading.Thread(target=run_sender, args=sender_args, daemon=True)
+
+    usage_before = resource.getrusage(resource.RUSAGE_SELF)
+    started = time.perf_counter()
+    if mode == "client-pull":
+        sender.start()
+        wait_for_port(host, port)
+        started = time.perf_counter()
+        receiver.start_client(diff)
+    else:
+        server = threading.Thread(target=receiver.start_server, args=(diff,), daemon=True)
+        server.start()
+        wait_for_port(host, port)
+        started = time.perf_counter()
+        sender.start()
+        server.join()
+    finished = time.perf_counter()
+    if mode == "server-pull":
+        receiver.stop()
+    sender.join(timeout=30)
+    usage_after = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    if shaper:
+        shaper.stop()
+
+    elapsed = finished - started
+    cpu = (usage_after.ru_utime - usage_before.ru_utime) + (usage_after.ru_stime - usage_before.ru_stime)
+    if processes == 2:
+        cpu += children.ru_utime + children.ru_stime
+    gaps = [later - earlier for earlier, later in zip([started] + arrivals, arrivals)]
+
+    return {
+        "mode": mode,
+        "processes": processes,
+        "success": outcome.get("success", False) and len(arrivals) == len(diff),
+        "chunks": len(arrivals),
+        "chunks_wanted": len(diff),
+        "bytes": received_bytes[0],
+        "seconds": elapsed,
+        "mb_per_s": received_bytes[0] / elapsed / 1e6 if elapsed else 0.0,
+        "time_to_first_chunk": arrivals[0] - started if arrivals else None,
+        "chunk_latency_p50": percentile(gaps, 50),
+        "chunk_latency_p90": percentile(gaps, 90),
+        "chunk_latency_p99": percentile(gaps, 99),
+        "cpu_seconds": cpu,
+        "peak_rss_kb": max(usage_after.ru_maxrss, children.ru_maxrss),
+        "link": shaper.stats() if shaper else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=65432)
+    parser.add_argument("--mode", choices=MODES + ("all",), default="all")
+    parser.add_argument("--processes", type=int, choices=(1, 2), default=1,
+                        help="run sender and receiver in one process or two")
+    parser.add_argument("--chunks", type=int, default=16)
+    parser.add_argument("--chunk-size", type=int, default=1024 * 1024)
+    parser.add_argument("--files", type=int, default=1)
+    parser.add_argument("--compressibility", type=float, default=0.0, help="fraction of each chunk that is zeros")
+    parser.add_argument("--changed", type=float, default=1.0, help="fraction of blocks newer in the source")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--link", action="append", choices=sorted(SCENARIOS) + ["all"],
+                        help="shape the link with this scenario (repeatable)")
+    parser.add_argument("--link-port", type=int, help="port for the link shaper (default: --port + 1)")
+    parser.add_argument("--json", help="also write results to this file")
+    args = parser.parse_args()
+
+    modes = MODES if args.mode == "all" else (args.mode,)
+    links = [None]
+    if args.link:
+        links = list(SCENARIOS) if "all" in args.link else args.link
+    results = []
+    for link in links:
+        for mode in modes:
+            with tempfile.TemporaryDirectory() as base_dir:
+                source_dir, stale_dir = build_packages(base_dir, args.chunks, args.chunk_size, args.compressibility,
+                                                       args.changed, args.files, args.seed)
+                result = run_transfer(mode, source_dir, stale_dir, args.host, args.port, args.processes,
+                                      SCENARIOS[link] if link else None, args.link_port)
+            result["scenario"] = link
+            result["params"] = {key: getattr(args, key) for key in ("chunks", "chunk_size", "files", "compressibility", "changed")}
+            results.append(result)
+            print(json.dumps(result, indent=2))
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,212 @@
+"""
+Moving small diffs over the BLE connection instead of bringing up Wi-Fi.
+
+Switching a node to AP or client mode, joining and connecting costs tens of
+seconds before the first byte moves, while BLE moves a few KB per second
+right away. TransferCosts estimates both for a diff and picks the faster.
+The estimate only uses the two manifests and shared config, so both peers
+reach the same decision without talking about it.
+
+On the BLE path, the node that connected as central does all the work over
+the FileSharingService chunk characteristics: it pulls the chunks it lacks
+(write a "get" for a piece, read the piece back) and pushes the chunks the
+peer lacks ("put" writes), then writes "done". Every write and read is one
+attribute of at most 512 bytes:
+
+    header length (2) | JSON header | data
+"""
+import json
+import logging
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from config import BLE_BYTES_PER_SECOND, WIFI_BYTES_PER_SECOND, WIFI_SETUP_SECONDS
+from sync import DEFAULT_BLOCK_SIZE, ChunkVersion, Package
+
+logger = logging.getLogger(__name__)
+
+MAX_ATTRIBUTE_BYTES = 512  # Longest GATT attribute value
+
+
+def estimate_bytes(chunks: List[ChunkVersion]) -> int:
+    """
+    Bytes to move a set of chunks: their lengths, from the file sizes in the
+    manifest, or a full block each for files whose size the manifest doesn't give.
+    """
+    return sum(chunk.length if chunk.length is not None else chunk.block_size or DEFAULT_BLOCK_SIZE
+               for chunk in chunks)
+
+
+@dataclass
+class TransferCosts:
+    """
+    Seconds to move a diff over either link.
+
+    Attributes:
+        wifi_setup_seconds (float): Bringing the Wi-Fi link and the transfer server up
+        wifi_bytes_per_second (float): Wi-Fi throughput once up
+        ble_bytes_per_second (float): Chunk throughput over GATT
+    """
+    wifi_setup_seconds: float = WIFI_SETUP_SECONDS
+    wifi_bytes_per_second: float = WIFI_BYTES_PER_SECOND
+    ble_bytes_per_second: float = BLE_BYTES_PER_SECOND
+
+    def wifi_seconds(self, size: int) -> float:
+        return self.wifi_setup_seconds + size / self.wifi_bytes_per_second
+
+    def ble_seconds(self, size: int) -> float:
+        return size / self.ble_bytes_per_second
+
+    def threshold_bytes(self) -> int:
+        """Diff size at which both links take as long."""
+        per_byte = 1 / self.ble_bytes_per_second - 1 / self.wifi_bytes_per_second
+        return int(self.wifi_setup_seconds / per_byte) if per_byte > 0 else 0
+
+    def choose(self, size: int) -> str:
+        """'ble' or 'wifi', whichever moves `size` bytes sooner."""
+        return 'ble' if size and self.ble_seconds(size) < self.wifi_seconds(size) else 'wifi'
+
+
+def encode_frame(header: Dict, data: bytes = b"") -> bytes:
+    encoded = json.dumps(header, separators=(',', ':')).encode('utf-8')
+    frame = len(encoded).to_bytes(2, 'big') + encoded + data
+    if len(frame) > MAX_ATTRIBUTE_BYTES:
+        raise ValueError(f"Frame of {len(frame)} bytes doesn't fit an attribute")
+    return frame
+
+
+def decode_frame(frame: bytes) -> Tuple[Dict, bytes]:
+    length = int.from_bytes(frame[:2], 'big')
+    return json.loads(frame[2:2 + length]), bytes(frame[2 + length:])
+
+
+def _piece(header: Dict, data: bytes, offset: int) -> bytes:
+    """Frame `header` with as much of `data` from `offset` as fits."""
+    budget = MAX_ATTRIBUTE_BYTES - len(encode_frame(header))
+    if budget <= 0:
+        raise ValueError(f"No room for data after header {header}")
+    return encode_frame(header, data[offset:offset + budget])
+
+
+class ChunkExchange:
+    """
+    Peripheral side of the BLE chunk transfer: answers piece reads and
+    assembles pushed chunks, per connected central.
+    """
+    def __init__(self, packages: Dict[str, Package], on_done: Optional[Callable[[str], None]] = None):
+        """
+        Args:
+            packages (Dict): Package name -> Package
+            on_done (Callable, optional): Called with a central's id when it has finished
+        """
+        self.packages = packages
+        self.on_done = on_done
+        self.requests: Dict[str, Dict] = {}    # Central -> last "get"
+        self.incoming: Dict[str, Tuple[Tuple, bytearray]] = {}  # Central -> chunk being pushed
+        self.received = 0
+
+    def write(self, client_id: str, value: bytes):
+        header, data = decode_frame(value)
+        op = header.get("op")
+        if op == "get":
+            self.requests[client_id] = header
+        elif op == "put":
+            self._put(client_id, header, data)
+        elif op == "done":
+            self.requests.pop(client_id, None)
+            self.incoming.pop(client_id, None)
+            if self.on_done:
+                self.on_done(client_id)
+
+    def _put(self, client_id: str, header: Dict, data: bytes):
+        key = (header["pkg"], header["path"], header["block"], header["version"])
+        if header["offset"] == 0:
+            self.incoming[client_id] = (key, bytearray())
+        current = self.incoming.get(client_id)
+        if current is None or current[0] != key or len(current[1]) != header["offset"]:
+            logger.warning(f"[ble] Out of order piece for {key}; dropping the chunk")
+            self.incoming.pop(client_id, None)
+            return
+        buffer = current[1]
+        buffer += data
+        if len(buffer) >= header["length"]:
+            del self.incoming[client_id]
+            package = self.packages.get(header["pkg"])
+            if package is not None and package.write_chunk(header["path"], header["block"], bytes(buffer),
+                                                           header["version"], header.get("block_size")):
+                self.received += 1
+
+    def read(self, client_id: str) -> bytes:
+        """The piece asked for by the central's last "get"."""
+        request = self.requests.get(client_id)
+        package = self.packages.get(request["pkg"]) if request else None
+        data = None
+        if package is not None:
+            data = package.read_chunk(request["path"], request["block"], request["version"], padded=False)
+        if data is None:
+            return encode_frame({"missing": True})
+        return _piece({"offset": request["offset"], "length": len(data)}, data, request["offset"])
+
+
+async def pull_chunks(write: Callable[[bytes], Awaitable], read: Callable[[], Awaitable[bytes]],
+                      package: Package, pkg_name: str, chunks: List[ChunkVersion]) -> List[ChunkVersion]:
+    """
+    Fetch `chunks` from a peer's ChunkExchange into `package`.
+
+    Args:
+        write (Callable): Writes a value to the peer's chunk characteristic
+        read (Callable): Reads the peer's chunk characteristic
+
+    Returns:
+        list: The chunks received
+    """
+    received = []
+    for chunk in chunks:
+        buffer = bytearray()
+        while True:
+            await write(encode_frame({"op": "get", "pkg": pkg_name, "path": chunk.file_path,
+                                      "block": chunk.block_number, "version": chunk.version,
+                                      "offset": len(buffer)}))
+            header, data = decode_frame(await read())
+            if header.get("missing") or header["offset"] != len(buffer):
+                logger.warning(f"[ble] Peer can't send {chunk}")
+                buffer = None
+                break
+            buffer += data
+            if len(buffer) >= header["length"] or not data:
+                break
+        if buffer is not None and package.write_chunk(chunk.file_path, chunk.block_number, bytes(buffer),
+                                                      chunk.version, chunk.block_size):
+            received.append(chunk)
+    return received
+
+
+async def push_chunks(write: Callable[[bytes], Awaitable], package: Package, pkg_name: str,
+                      chunks: List[ChunkVersion]) -> int:
+    """
+    Send `chunks` of `package` to a peer's ChunkExchange.
+
+    Returns:
+        int: Bytes of chunk data sent
+    """
+    sent = 0
+    for chunk in chunks:
+        data = package.read_chunk(chunk.file_path, chunk.block_number, chunk.version, padded=False)
+        if data is None:
+            continue
+        offset = 0
+        while True:
+            piece = _piece({"op": "put", "pkg": pkg_name, "path": chunk.file_path, "block": chunk.block_number,
+                            "version": chunk.version, "block_size": package.get_block_size(chunk.file_path),
+                            "offset": offset, "length": len(data)}, data, offset)
+            await write(piece)
+            offset += len(decode_frame(piece)[1])
+            if offset >= len(data):
+                break
+        sent += len(data)
+    return sent
+
+
+async def finish(write: Callable[[bytes], Awaitable]):
+    """Tell the peer the transfer is over."""
+    await write(encode_frame({"op": "done"}))
@@ -0,0 +1,62 @@
+import asyncio
+
+from ble_transfer import ChunkExchange, TransferCosts, estimate_bytes, finish, pull_chunks, push_chunks
+from multicast import chunks_to_offer
+from sync import *
+
+
+def test_small_diffs_go_over_ble():
+    costs = TransferCosts(wifi_setup_seconds=25, wifi_bytes_per_second=2 * 1048576, ble_bytes_per_second=4096)
+    threshold = costs.threshold_bytes()
+    assert 100_000 < threshold < 110_000
+    assert costs.choose(16 * 1024) == 'ble'
+    assert costs.choose(threshold + 1024) == 'wifi'
+    assert costs.choose(0) == 'wifi'
+
+    # Chunks are counted at their length, not as whole 4 MB blocks
+    ours, theirs = Package("my-package", 1), Package("my-package", 1)
+    theirs.write_chunk("/etc/app.conf", 0, b"x" * DEFAULT_BLOCK_SIZE)
+    theirs.write_chunk("/etc/app.conf", 1, b"debug=true\n")
+    assert estimate_bytes(ours.get_missing_chunks(theirs.manifest.to_dict())) == DEFAULT_BLOCK_SIZE + 11
+    ours.write_chunk("/etc/app.conf", 0, b"x" * DEFAULT_BLOCK_SIZE)
+    assert costs.choose(estimate_bytes(ours.get_missing_chunks(theirs.manifest.to_dict()))) == 'ble'
+
+
+def test_pull_and_push_over_the_chunk_characteristic():
+    central = Package("my-package", 1)
+    peripheral = Package("my-package", 1)
+    central.add_file("/etc/hosts", b"127.0.0.1 localhost\n" * 100)       # 2000 bytes, several pieces
+    peripheral.add_file("/etc/motd", b"hello\n")
+    peripheral.add_file("/etc/issue", b"")
+
+    done = []
+    exchange = ChunkExchange({"SamplePackage": peripheral}, on_done=done.append)
+
+    async def write(value: bytes):
+        assert len(value) <= 512
+        exchange.write("central", value)
+
+    async def read() -> bytes:
+        return exchange.read("central")
+
+    wanted = central.get_missing_chunks(peripheral.manifest.to_dict())
+    offer = chunks_to_offer(central, peripheral.manifest.to_dict())
+    assert TransferCosts().choose(estimate_bytes(wanted + offer)) == 'ble'
+
+    async def run():
+        received = await pull_chunks(write, read, central, "SamplePackage", wanted)
+        await push_chunks(write, central, "SamplePackage", offer)
+        await finish(write)
+        return received
+
+    assert len(asyncio.run(run())) == len(wanted) == 2
+    assert done == ["central"]
+    assert not central.get_missing_chunks(peripheral.manifest.to_dict())
+    assert not peripheral.get_missing_chunks(central.manifest.to_dict())
+    assert peripheral.read_chunk("/etc/hosts", 0, padded=False) == b"127.0.0.1 localhost\n" * 100
+
+
+if __name__ == "__main__":
+    test_small_diffs_go_over_ble()
+    test_pull_and_push_over_the_chunk_characteristic()
+    print("tests passed")
@@ -0,0 +1,65 @@
+import tempfile
+
+from sync import *
+
+
+def test_add_file_picks_block_size_and_writes_only_changes():
+    pkg = Package("my-package", 1)
+    config = bytes(range(256)) * 64  # 16 KB, edited often
+    assert pkg.add_file("/etc/app.conf", config, changes_per_day=48) == [0]
+    assert pkg.get_block_size("/etc/app.conf") == MIN_BLOCK_SIZE
+
+    image = bytes(4 * 1048576)
+    written = pkg.add_file("/img/disk.bin", image, changes_per_day=0)
+    assert pkg.get_block_size("/img/disk.bin") == 64 * 1024
+    assert written == list(range(64))
+
+    # A one-byte edit rewrites one block, at the next version
+    edited = image[:300000] + b"x" + image[300001:]
+    assert pkg.add_file("/img/disk.bin", edited, changes_per_day=0) == [4]
+    assert pkg.manifest.get_version("/img/disk.bin", 4) == 2
+    assert b"".join(pkg.read_chunk("/img/disk.bin", n, padded=False) for n in range(64)) == edited
+
+    # Shrinking (not enough to re-chunk) empties the blocks past the new end
+    assert pkg.add_file("/img/disk.bin", edited[:2000000], changes_per_day=0) == list(range(30, 64))
+    assert pkg.get_file_size("/img/disk.bin") == 2000000
+
+
+def test_peers_with_different_block_sizes_converge():
+    data = bytes(range(256)) * 4096  # 1 MB
+    old = Package("my-package", 1, block_size=DEFAULT_BLOCK_SIZE)
+    old.write_chunk("/data.bin", 0, data, version=1)
+
+    # The new layout is newer, so the old peer needs all of it
+    new = Package("my-package", 1)
+    new.add_file("/data.bin", data, block_size=64 * 1024)
+    new.add_file("/data.bin", data[:-1] + b"!", block_size=64 * 1024)
+    assert new.manifest.get_version("/data.bin", 0) == 1
+    missing = old.get_missing_chunks(new.manifest.to_dict())
+    assert len(missing) == 16 and {chunk.block_size for chunk in missing} == {64 * 1024}
+    assert new.get_missing_chunks(old.manifest.to_dict()) == []
+
+    old.sync_chunks(new, missing)
+    assert old.get_block_size("/data.bin") == 64 * 1024
+    assert old.manifest.files == new.manifest.files
+    assert old.manifest.block_sizes == new.manifest.block_sizes
+    assert old.get_file_size("/data.bin") == len(data)
+
+
+def test_block_size_counts_manifest_bytes_and_edits_survive_restarts():
+    # A weekly edit is outweighed by the manifest entries sent in between
+    assert choose_block_size(64 * 1048576, changes_per_day=1) == 256 * 1024
+    assert choose_block_size(64 * 1048576, changes_per_day=1 / 7) == 512 * 1024
+
+    base = tempfile.mkdtemp()
+    pkg = Package("my-package", 1, base_path=base)
+    pkg.add_file("/etc/app.conf", b"debug=false\n")
+    pkg.add_file("/etc/app.conf", b"debug=true\n")
+    assert len(Package("my-package", 1, base_path=base)._edit_times["/etc/app.conf"]) == 2
+
+
+if __name__ == "__main__":
+    test_add_file_picks_block_size_and_writes_only_changes()
+    test_peers_with_different_block_sizes_converge()
+    test_block_size_counts_manifest_bytes_and_edits_survive_restarts()
+    print("tests passed")
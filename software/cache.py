@@ -0,0 +1,121 @@
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional
+
+
+class BlockCache:
+    """
+    Byte-budgeted LRU cache for chunk data read from storage.
+
+    Entries can be pinned while they are in flight; pinned entries are never
+    evicted, so the cache may go over budget until they are unpinned.
+    """
+    def __init__(self, max_bytes: int):
+        """
+        Args:
+            max_bytes (int): Memory budget for cached data, in bytes
+        """
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries: "OrderedDict[Hashable, bytes]" = OrderedDict()
+        self._pins: Dict[Hashable, int] = {}
+        self._lock = threading.Lock()
+
+        # Counters
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._entries
+
+    def get(self, key: Hashable) -> Optional[bytes]:
+        with self._lock:
+            data = self._entries.get(key)
+            if data is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return data
+
+    def _sizeof(self, data: Any) -> int:
+        return len(data)
+
+    def fits(self, data: Any) -> bool:
+        """Whether `data` can be added without evicting anything."""
+        return self.size + self._sizeof(data) <= self.max_bytes
+
+    def put(self, key: Hashable, data: bytes):
+        """Cache `data` under `key`, evicting least recently used entries to fit."""
+        if self._sizeof(data) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= self._sizeof(old)
+            self._entries[key] = data
+            self.size += self._sizeof(data)
+            self._evict()
+
+    def invalidate(self, key: Hashable):
+        with self._lock:
+            data = self._entries.pop(key, None)
+            if data is not None:
+                self.size -= self._sizeof(data)
+            self._pins.pop(key, None)
+
+    def pin(self, key: Hashable) -> bool:
+        """Protect a cached entry from eviction. Returns False if it isn't cached."""
+        with self._lock:
+            if key not in self._entries:
+                return False
+            self._pins[key] = self._pins.get(key, 0) + 1
+            return True
+
+    def unpin(self, key: Hashable):
+        with self._lock:
+            count = self._pins.get(key, 0) - 1
+            if count > 0:
+                self._pins[key] = count
+            else:
+                self._pins.pop(key, None)
+            self._evict()
+
+    def _evict(self):
+        # Caller holds the lock
+        if self.size <= self.max_bytes:
+            return
+        for key in list(self._entries):
+            if self.size <= self.max_bytes:
+                break
+            if key in self._pins:
+                continue
+            self.size -= self._sizeof(self._entries.pop(key))
+            self.evictions += 1
+
+    def stats(self) -> Dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(self._entries),
+            "bytes": self.size,
+            "pinned": len(self._pins),
+        }
+
+
+class FrameCache(BlockCache):
+    """
+    Cache of ready-to-send outbound frames, keyed by
+    (file path, block number, version, codec), plus the offset for the
+    parts of a streamed chunk.
+
+    Values are the response dicts emitted to peers; their size is the length
+    of the encoded payload.
+    """
+    def _sizeof(self, frame: Dict) -> int:
+        return len(frame['content']['data'])
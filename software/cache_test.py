@@ -0,0 +1,50 @@
+import tempfile
+
+from cache import BlockCache
+from sync import *
+
+
+def test_lru_eviction_respects_budget():
+    cache = BlockCache(max_bytes=10)
+    cache.put("a", b"1234")
+    cache.put("b", b"1234")
+    assert cache.get("a") == b"1234"   # "b" is now least recently used
+    cache.put("c", b"1234")
+    assert "b" not in cache
+    assert cache.size == 8
+    assert cache.stats()["evictions"] == 1
+
+
+def test_pinned_entries_are_not_evicted():
+    cache = BlockCache(max_bytes=8)
+    cache.put("a", b"1234")
+    assert cache.pin("a")
+    cache.put("b", b"1234")
+    cache.put("c", b"1234")
+    assert "a" in cache and "b" not in cache
+
+    cache.unpin("a")
+    cache.put("d", b"1234")
+    assert "a" not in cache
+
+
+def test_package_serves_repeat_reads_from_cache():
+    base = tempfile.mkdtemp()
+    pkg = Package("my-package", 1, base_path=base, use_index=True, cache_bytes=1024)
+    pkg.write_chunk("/src/file1.txt", 0, b"Hello World", version=1)
+    pkg.cache.invalidate(("/src/file1.txt", 0, 1))
+
+    with pkg.pinned_chunk("/src/file1.txt", 0) as data:
+        assert data.startswith(b"Hello World")
+        assert pkg.cache.stats()["pinned"] == 1
+    pkg.read_chunk("/src/file1.txt", 0)
+
+    stats = pkg.cache.stats()
+    assert (stats["hits"], stats["misses"], stats["pinned"]) == (1, 1, 0)
+
+
+if __name__ == "__main__":
+    test_lru_eviction_respects_budget()
+    test_pinned_entries_are_not_evicted()
+    test_package_serves_repeat_reads_from_cache()
+    print("tests passed")
@@ -0,0 +1,183 @@
+import sqlite3
+from typing import Dict, List, Optional, Tuple
+
+from sync import ChunkVersion
+
+
+class ChunkIndex:
+    """
+    SQLite (WAL-mode) index of the chunks stored for a package.
+
+    One row per (file, block, version) with the chunk's length, content hash
+    and storage location. Lookups go through indexes instead of walking the
+    in-memory block dicts, and each write only touches its own row.
+
+    The index is also the package's record on disk: each file's block size
+    or pack entry is kept in `files`, and the package's name and version in
+    `package`, so the manifest can be rebuilt from it without manifest.json.
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS chunks (
+            file TEXT NOT NULL,
+            block INTEGER NOT NULL,
+            version INTEGER NOT NULL,
+            length INTEGER NOT NULL,
+            hash TEXT NOT NULL,
+            location TEXT NOT NULL,
+            PRIMARY KEY (file, block, version)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS chunks_by_version ON chunks (version);
+        CREATE TABLE IF NOT EXISTS files (
+            file TEXT PRIMARY KEY,
+            block_size INTEGER,
+            pack TEXT,
+            pack_offset INTEGER,
+            pack_length INTEGER,
+            pack_version INTEGER
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS package (
+            id INTEGER PRIMARY KEY CHECK (id = 0),
+            name TEXT NOT NULL,
+            version INTEGER NOT NULL
+        );
+    """
+
+    def __init__(self, path: str):
+        """
+        Args:
+            path (str): SQLite database file; created if missing
+        """
+        self.path = str(path)
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(self.SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def sync(self):
+        """Make committed rows durable (synchronous=NORMAL leaves the WAL unsynced)."""
+        self.conn.execute("PRAGMA wal_checkpoint(PASSIVE)")
+
+    def add(self, file: str, block: int, version: int, length: int, content_hash: str, location: str):
+        """Insert or replace the row for a chunk version."""
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO chunks VALUES (?, ?, ?, ?, ?, ?)",
+                (file, block, version, length, content_hash, location)
+            )
+
+    def remove(self, file: str, block: int, version: int):
+        with self.conn:
+            self.conn.execute(
+                "DELETE FROM chunks WHERE file = ? AND block = ? AND version = ?",
+                (file, block, version)
+            )
+
+    def set_package(self, name: str, version: int):
+        with self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO package VALUES (0, ?, ?)", (name, version))
+
+    def package(self) -> Optional[Tuple[str, int]]:
+        """The (name, version) of the package stored here, or None if it was never saved."""
+        return self.conn.execute("SELECT name, version FROM package").fetchone()
+
+    def set_block_size(self, file: str, block_size: int):
+        """Record the block size a file is laid out in (it is no longer packed)."""
+        with self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO files (file, block_size) VALUES (?, ?)", (file, block_size))
+
+    def set_packed(self, file: str, pack: str, offset: int, length: int, version: int):
+        """Record where a packed file's contents live (it no longer has a block size)."""
+        with self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO files VALUES (?, NULL, ?, ?, ?, ?)",
+                              (file, pack, offset, length, version))
+
+    def remove_file(self, file: str):
+        with self.conn:
+            self.conn.execute("DELETE FROM files WHERE file = ?", (file,))
+
+    def files(self) -> Dict[str, Tuple[Optional[int], Optional[Tuple[str, int, int, int]]]]:
+        """
+        Every file's layout.
+
+        Returns:
+            Dict: file path -> (block size, or None if packed;
+                                (pack, offset, length, version), or None if not packed)
+        """
+        rows = self.conn.execute("SELECT file, block_size, pack, pack_offset, pack_length, pack_version FROM files")
+        return {file: (block_size, (pack, offset, length, version) if pack is not None else None)
+                for file, block_size, pack, offset, length, version in rows}
+
+    def is_empty(self) -> bool:
+        return self.conn.execute("SELECT 1 FROM chunks LIMIT 1").fetchone() is None
+
+    def lookup(self, file: str, block: int, version: Optional[int] = None) -> Optional[Tuple[int, int, str, str]]:
+        """
+        Find a chunk, or its latest version if `version` is None.
+
+        Returns:
+            tuple: (version, length, hash, location), or None if not indexed
+        """
+        if version is None:
+            return self.conn.execute(
+                "SELECT version, length, hash, location FROM chunks "
+                "WHERE file = ? AND block = ? ORDER BY version DESC LIMIT 1",
+                (file, block)
+            ).fetchone()
+        return self.conn.execute(
+            "SELECT version, length, hash, location FROM chunks "
+            "WHERE file = ? AND block = ? AND version = ?",
+            (file, block, version)
+        ).fetchone()
+
+    def versions(self, file: str, block: int) -> List[int]:
+        """All stored versions of a block, oldest first."""
+        rows = self.conn.execute(
+            "SELECT version FROM chunks WHERE file = ? AND block = ? ORDER BY version",
+            (file, block)
+        )
+        return [version for (version,) in rows]
+
+    def latest_versions(self, file: Optional[str] = None) -> Dict[str, Dict[int, int]]:
+        """
+        Latest version per block, for one file or the whole package.
+
+        Returns:
+            Dict: file path -> {block number: latest version}
+        """
+        if file is None:
+            rows = self.conn.execute(
+                "SELECT file, block, MAX(version) FROM chunks GROUP BY file, block"
+            )
+        else:
+            rows = self.conn.execute(
+                "SELECT file, block, MAX(version) FROM chunks WHERE file = ? GROUP BY block",
+                (file,)
+            )
+        latest: Dict[str, Dict[int, int]] = {}
+        for path, block, version in rows:
+            latest.setdefault(path, {})[block] = version
+        return latest
+
+    def blocks_newer_than(self, version: int) -> List[ChunkVersion]:
+        """Every stored chunk version newer than `version`."""
+        rows = self.conn.execute(
+            "SELECT file, block, version FROM chunks WHERE version > ? ORDER BY file, block, version",
+            (version,)
+        )
+        return [ChunkVersion(block_number=block, version=v, file_path=path) for path, block, v in rows]
+
+    def blocks_of_file(self, file: str) -> List[Tuple[int, int, int, str, str]]:
+        """
+        Every stored chunk version of one file.
+
+        Returns:
+            list: (block, version, length, hash, location) rows, by block then version
+        """
+        return self.conn.execute(
+            "SELECT block, version, length, hash, location FROM chunks "
+            "WHERE file = ? ORDER BY block, version",
+            (file,)
+        ).fetchall()
@@ -0,0 +1,54 @@
+import os
+import tempfile
+
+from sync import *
+
+
+def test_indexed_package_reads_from_disk():
+    base = tempfile.mkdtemp()
+    pkg = Package("my-package", 1, base_path=base, use_index=True)
+    pkg.write_chunk("/src/file1.txt", 0, b"Hello World", version=1)
+    pkg.write_chunk("/src/file1.txt", 0, b"Updated content", version=2)
+    pkg.write_chunk("/src/file2.txt", 1, b"Some data", version=1)
+
+    # A chunk written from a file is moved into the store, not read
+    source = os.path.join(base, "received")
+    with open(source, "wb") as f:
+        f.write(b"From a file")
+    assert pkg.write_chunk_file("/src/file2.txt", 2, source, version=1)
+    assert not os.path.exists(source)
+    assert pkg.read_chunk("/src/file2.txt", 2, padded=False) == b"From a file"
+
+    # Nothing is held in memory; reads go through the index
+    assert pkg.files == {}
+    assert pkg.read_chunk("/src/file1.txt", 0).startswith(b"Updated content")
+    assert pkg.read_chunk("/src/file1.txt", 0, 1).startswith(b"Hello World")
+
+    # Writes only touch their rows, and the manifest is rebuilt from the index
+    assert not os.path.exists(os.path.join(base, "manifest.json"))
+    reloaded = Package("my-package", 1, base_path=base, use_index=True)
+    reloaded.load_from_filesystem()
+    assert reloaded.manifest.digest() == pkg.manifest.digest()
+
+
+def test_index_queries():
+    base = tempfile.mkdtemp()
+    pkg = Package("my-package", 1, base_path=base, use_index=True)
+    pkg.write_chunk("/src/file1.txt", 0, b"a", version=1)
+    pkg.write_chunk("/src/file1.txt", 0, b"b", version=3)
+    pkg.write_chunk("/src/file1.txt", 1, b"c", version=2)
+    pkg.write_chunk("/src/file2.txt", 0, b"d", version=1)
+
+    assert pkg.index.latest_versions() == {"/src/file1.txt": {0: 3, 1: 2}, "/src/file2.txt": {0: 1}}
+    assert pkg.index.versions("/src/file1.txt", 0) == [1, 3]
+    newer = pkg.index.blocks_newer_than(1)
+    assert [(c.file_path, c.block_number, c.version) for c in newer] == [
+        ("/src/file1.txt", 0, 3), ("/src/file1.txt", 1, 2)
+    ]
+    assert [row[:3] for row in pkg.index.blocks_of_file("/src/file1.txt")] == [(0, 1, 1), (0, 3, 1), (1, 2, 1)]
+
+
+if __name__ == "__main__":
+    test_indexed_package_reads_from_disk()
+    test_index_queries()
+    print("tests passed")
@@ -0,0 +1,145 @@
+import errno
+import os
+import shutil
+import threading
+from abc import ABC, abstractmethod
+from pathlib import Path
+from typing import Optional, Set
+
+
+class ChunkStore(ABC):
+    """
+    Where a package keeps chunk data on disk, addressed by chunk name (see
+    Package._generate_chunk_filename).
+    """
+    @abstractmethod
+    def write(self, name: str, data: bytes):
+        ...
+
+    @abstractmethod
+    def write_file(self, name: str, path: str):
+        """
+        Store a chunk from the file at `path` without reading it into memory.
+        The file may be moved into the store; anything left at `path` is the
+        caller's to remove.
+        """
+
+    @abstractmethod
+    def read(self, name: str) -> Optional[bytes]:
+        """The chunk's bytes, or None if it isn't stored."""
+
+    @abstractmethod
+    def read_range(self, name: str, offset: int, length: int) -> Optional[bytes]:
+        """Up to `length` bytes of the chunk from `offset`, or None if it isn't stored."""
+
+    @abstractmethod
+    def length(self, name: str) -> Optional[int]:
+        ...
+
+    @abstractmethod
+    def delete(self, name: str) -> int:
+        """
+        Forget a chunk.
+
+        Returns:
+            int: Bytes freed (0 if it wasn't stored)
+        """
+
+    @abstractmethod
+    def usage(self) -> int:
+        """Bytes of disk used."""
+
+    def compact(self) -> int:
+        """Reclaim space left by deleted chunks. Returns bytes reclaimed."""
+        return 0
+
+    @abstractmethod
+    def sync(self):
+        """Make every chunk written so far durable."""
+
+    def close(self):
+        pass
+
+
+class FileChunkStore(ChunkStore):
+    """One file per chunk version, `<name>` in a flat directory."""
+    def __init__(self, directory: str):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        # Chunks written since the last sync()
+        self._unsynced: Set[str] = set()
+        self._lock = threading.Lock()
+
+    def write(self, name: str, data: bytes):
+        with open(self.directory / name, 'wb') as f:
+            f.write(data)
+        with self._lock:
+            self._unsynced.add(name)
+
+    def write_file(self, name: str, path: str):
+        try:
+            os.replace(path, self.directory / name)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            # On another filesystem, so it can't just be renamed
+            shutil.copyfile(path, self.directory / name)
+        with self._lock:
+            self._unsynced.add(name)
+
+    def sync(self):
+        with self._lock:
+            names, self._unsynced = self._unsynced, set()
+        if not names:
+            return
+        for name in names:
+            try:
+                fd = os.open(self.directory / name, os.O_RDONLY)
+            except FileNotFoundError:
+                continue
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        # New directory entries too
+        fd = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def read(self, name: str) -> Optional[bytes]:
+        try:
+            with open(self.directory / name, 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def read_range(self, name: str, offset: int, length: int) -> Optional[bytes]:
+        try:
+            fd = os.open(self.directory / name, os.O_RDONLY)
+        except FileNotFoundError:
+            return None
+        try:
+            return os.pread(fd, length, offset)
+        finally:
+            os.close(fd)
+
+    def length(self, name: str) -> Optional[int]:
+        try:
+            return (self.directory / name).stat().st_size
+        except FileNotFoundError:
+            return None
+
+    def delete(self, name: str) -> int:
+        path = self.directory / name
+        try:
+            freed = path.stat().st_size
+            path.unlink()
+        except FileNotFoundError:
+            return 0
+        return freed
+
+    def usage(self) -> int:
+        with os.scandir(self.directory) as entries:
+            return sum(entry.stat().st_size for entry in entries if entry.name.endswith(".chunk"))
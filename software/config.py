@@ -6,6 +6,81 @@ PKG_LIST_R = "de960fd7-0001-4dab-aa6c-29449c725039"
 PKG_REQUEST_W = "de960fd7-0002-4dab-aa6c-29449c725039"
 PKG_MANIFEST_R = "de960fd7-0003-4dab-aa6c-29449c725039"
 PKG_MANIFEST_W = "de960fd7-0004-4dab-aa6c-29449c725039"
+PKG_CHUNK_W = "de960fd7-0005-4dab-aa6c-29449c725039"
+PKG_CHUNK_R = "de960fd7-0006-4dab-aa6c-29449c725039"
 
 import os
 FILE_DIR = os.path.abspath(os.path.dirname(__file__) + '/downloads')  # Directory for files
+
+# Keep the chunk index in SQLite and read chunks from disk on demand
+USE_CHUNK_INDEX = False
+
+# Append chunks to large segment files instead of one file per chunk version
+USE_SEGMENT_STORE = False
+
+# Store small files added together in shared pack chunks (see Package.add_files)
+PACK_SMALL_FILES = False
+
+# Retention of old block versions
+RETENTION_KEEP_LATEST = 2      # Versions to keep per block
+RETENTION_KEEP_PEER = True     # Keep versions that known peers still have
+RETENTION_DISK_QUOTA = None    # Bytes of chunk storage, or None for no quota
+GC_INTERVAL = 30               # Seconds between garbage collection passes
+
+# Memory budget for chunks cached after being read from disk (indexed packages)
+BLOCK_CACHE_BYTES = 64 * 1024 * 1024
+
+# Memory budget for pre-encoded outbound frames
+FRAME_CACHE_BYTES = 64 * 1024 * 1024
+
+# Wi-Fi transfer server (the AP's address on the ad-hoc network)
+AP_HOST = '192.168.4.1'
+AP_PORT = 65432
+REQUEST_DELAY = 2              # Seconds between chunk requests
+TRANSFER_WORKERS = 8           # Chunk requests served at once, across all connected peers
+TRANSFER_CONNECT_TIMEOUT = 60  # Seconds to wait for the peer to connect to the transfer server
+TRANSFER_ROUND_TIMEOUT = 900   # Seconds a Wi-Fi transfer round may take before it's abandoned
+IO_WORKERS = 2                 # Files whose received chunks are written at once
+IO_QUEUE_BYTES = 32 * 1048576  # Received data waiting for disk before we stop reading from peers
+DURABLE_WRITES = True          # fsync received chunks before counting them as received
+SUBFRAME_BYTES = 64 * 1024     # Blocks longer than this are streamed in parts of this size (0: whole blocks)
+STREAM_WINDOW = 8              # Parts of a streamed block in flight before waiting for the peer's ack
+
+# Multicast delivery: as AP, also stream fountain-coded chunks to a multicast
+# group so every client on the AP can decode them from one transmission
+MULTICAST_ENABLED = False
+MULTICAST_GROUP = '239.255.42.99'
+MULTICAST_PORT = 65433
+MULTICAST_RATE = 2 * 1048576   # Bytes per second, leaving room for the unicast transfer
+MULTICAST_WINDOW = 15          # Seconds a client listens before fetching the rest by unicast
+
+# BLE fast path: diffs small enough to move over the BLE connection before
+# Wi-Fi could even come up skip Wi-Fi. Both peers must enable it.
+BLE_FAST_PATH = False
+WIFI_SETUP_SECONDS = 25        # Switching modes, joining/DHCP and connecting socket.io
+WIFI_BYTES_PER_SECOND = 2 * 1048576
+BLE_BYTES_PER_SECOND = 4 * 1024  # GATT write + read per 512-byte attribute
+BLE_TRANSFER_TIMEOUT = 60      # Seconds to wait for the peer to finish a BLE transfer
+
+# Gossip: summaries of other nodes' manifests, passed along in BLE exchanges
+GOSSIP_MAX_PEERS = 32
+GOSSIP_MAX_AGE = 600           # Seconds before what we heard about a node is forgotten
+GOSSIP_SUMMARY_FILES = 32      # Files (with the newest versions) per summary
+
+# Transfer order: glob pattern -> priority, higher first (e.g. {'/etc/security/*': 10})
+TRANSFER_PRIORITIES = {}
+# Write each file out here as soon as its transfer completes (None to keep chunks only)
+MATERIALIZE_DIR = None
+
+# Logging and metrics
+LOG_LEVEL = 'INFO'
+METRICS_ENABLED = False
+METRICS_TEXTFILE = None        # e.g. '/var/lib/node_exporter/textfile_collector/p2p.prom'
+METRICS_SOCKET = None          # Unix socket path serving the current metrics
+
+# Wi-Fi link (managed through NetworkManager over D-Bus)
+WIFI_INTERFACE = 'wlan0'
+WIFI_PASSWORD = 'password'
+AP_PROFILE = 'AP_Mode'         # NetworkManager profile created by setup_ap_client_switch.sh
+DHCP_UNIT = 'dnsmasq.service'  # Started in AP mode, stopped in client mode
+LINK_TIMEOUT = 30              # Seconds to wait for the peer's AP / an address
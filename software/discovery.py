@@ -0,0 +1,134 @@
+import random
+import time
+from typing import Dict, Hashable, List, Optional
+
+_UNSEEN = object()
+
+
+class DutyCycle:
+    """
+    Adaptive BLE duty cycle shared by the advertiser and the scanner.
+
+    Both roles run at the same time. Every scan listens for `window` seconds
+    and then waits `gap` seconds before the next one; the advertiser uses the
+    same numbers for its advert bursts. When new advertisements appear the
+    cycle speeds up (short window, no gap) so we connect quickly. Every quiet
+    window backs both off toward their maximums. Peers heard in the previous
+    window are remembered, so a neighbour that stays in range and keeps
+    advertising the same thing counts as quiet.
+    """
+
+    def __init__(self, min_window: float = 2.0, max_window: float = 15.0,
+                 max_gap: float = 10.0, backoff: float = 1.5, jitter: float = 0.25):
+        """
+        Args:
+            min_window (float): Shortest scan window / advert burst, in seconds
+            max_window (float): Longest scan window / advert burst, in seconds
+            max_gap (float): Longest pause between windows when the area is quiet
+            backoff (float): Multiplier applied after each quiet window
+            jitter (float): Random fraction added to each wait, so two nodes
+                            never stay in lockstep
+        """
+        self.min_window = min_window
+        self.max_window = max_window
+        self.max_gap = max_gap
+        self.backoff = backoff
+        self.jitter = jitter
+
+        self.window = min_window
+        self.gap = 0.0
+
+        # Address -> advertisement heard in the previous / current window
+        self.known: Dict[str, Hashable] = {}
+        self.heard: Dict[str, Hashable] = {}
+        self.heard_new = False
+
+        # Discovery latency metric
+        self.round_started: Optional[float] = None
+        self.first_seen: Optional[float] = None
+        self.latencies: List[float] = []
+        self.max_samples = 100
+
+    def _jittered(self, seconds: float) -> float:
+        return seconds * (1 + random.uniform(0, self.jitter))
+
+    def next_window(self) -> float:
+        """Length of the next scan window / advert burst."""
+        return self._jittered(self.window)
+
+    def next_gap(self) -> float:
+        """Pause before the next scan window / advert burst."""
+        return self._jittered(self.gap) if self.gap else 0.0
+
+    def observe(self, address: str, advertisement: Hashable) -> bool:
+        """
+        Note an advertisement heard during the current window.
+
+        Args:
+            address (str): Address of the advertiser
+            advertisement (Hashable): What it advertised
+
+        Returns:
+            bool: True if the peer or its advertisement is new, which speeds
+                  the cycle up
+        """
+        previous = self.heard.get(address, self.known.get(address, _UNSEEN))
+        self.heard[address] = advertisement
+        if previous == advertisement:
+            return False
+        self.heard_new = True
+        self.on_advertisement()
+        return True
+
+    def end_window(self):
+        """Close a scan window: back off if nothing new was heard in it."""
+        if not self.heard_new:
+            self.on_quiet()
+        self.known, self.heard = self.heard, {}
+        self.heard_new = False
+
+    def on_advertisement(self):
+        """A new advertisement was seen: speed the cycle up."""
+        if self.first_seen is None:
+            self.first_seen = time.monotonic()
+        self.window = self.min_window
+        self.gap = 0.0
+
+    def on_quiet(self):
+        """A whole window passed without new advertisements: back off."""
+        self.window = min(self.window * self.backoff, self.max_window)
+        self.gap = min(max(self.gap, 1.0) * self.backoff, self.max_gap)
+
+    def start_round(self):
+        """Mark the start of a discovery round."""
+        self.round_started = time.monotonic()
+        self.first_seen = None
+
+    def finish_round(self) -> Optional[float]:
+        """
+        Mark a completed manifest exchange and record the discovery latency.
+
+        Returns:
+            float: Seconds from the start of the round to the exchange, or None
+                   if no round was started
+        """
+        if self.round_started is None:
+            return None
+        latency = time.monotonic() - self.round_started
+        self.latencies.append(latency)
+        if len(self.latencies) > self.max_samples:
+            self.latencies.pop(0)
+        self.round_started = None
+        return latency
+
+    def latency_summary(self) -> dict:
+        """Summary of the recorded discovery latencies, in seconds."""
+        if not self.latencies:
+            return {"count": 0}
+        ordered = sorted(self.latencies)
+        return {
+            "count": len(ordered),
+            "mean": sum(ordered) / len(ordered),
+            "p50": ordered[len(ordered) // 2],
+            "max": ordered[-1],
+        }
@@ -0,0 +1,29 @@
+from discovery import DutyCycle
+
+
+def test_duty_cycle_backs_off_for_known_peers_and_resets_on_new_ones():
+    duty = DutyCycle(min_window=2.0, max_window=15.0, max_gap=10.0, backoff=2.0, jitter=0)
+    assert duty.observe("aa", ("node-a", 1))
+    assert not duty.observe("aa", ("node-a", 1))
+    duty.end_window()
+    assert (duty.next_window(), duty.next_gap()) == (2.0, 0.0)
+
+    # The same neighbour advertising the same thing is quiet, so the cycle backs off to its maximums
+    for _ in range(5):
+        assert not duty.observe("aa", ("node-a", 1))
+        duty.end_window()
+    assert (duty.next_window(), duty.next_gap()) == (15.0, 10.0)
+
+    # A changed advertisement resets the cycle, and so does a new peer
+    assert duty.observe("aa", ("node-a", 2))
+    duty.end_window()
+    assert (duty.next_window(), duty.next_gap()) == (2.0, 0.0)
+    duty.end_window()
+    assert duty.next_window() == 4.0
+    assert duty.observe("bb", ("node-b", 1))
+    assert (duty.next_window(), duty.next_gap()) == (2.0, 0.0)
+
+
+if __name__ == "__main__":
+    test_duty_cycle_backs_off_for_known_peers_and_resets_on_new_ones()
+    print("tests passed")
@@ -1,174 +1,681 @@
 import socketio
 import base64
+import logging
+import os
+import tempfile
 import time
 import threading
-from typing import Callable, List
+from urllib.parse import parse_qs
+from typing import Callable, Dict, List, Optional, Tuple
 import eventlet
 import eventlet.wsgi
+from eventlet import tpool
 import socketio
 
-eventlet.monkey_patch()
+from cache import FrameCache
+from config import (AP_HOST, AP_PORT, DURABLE_WRITES, FRAME_CACHE_BYTES, IO_QUEUE_BYTES, IO_WORKERS,
+                    REQUEST_DELAY, STREAM_WINDOW, SUBFRAME_BYTES, TRANSFER_CONNECT_TIMEOUT, TRANSFER_ROUND_TIMEOUT,
+                    TRANSFER_WORKERS)
+from io_executor import IOExecutor
+from metrics import get_metrics, redact_frame
+from scheduler import TransferScheduler
+
+logger = logging.getLogger(__name__)
+
+# socketio's websocket client binds threading.Lock when it is imported (above).
+# If the standard library is patched only afterwards, that lock stays native,
+# and a disconnect from any green thread but the reader deadlocks the hub.
+PATCHED_ON_IMPORT = eventlet.patcher.is_monkey_patched('thread')
+
+# Payload encoders for outbound 'file' frames, by codec name
+FRAME_CODECS = {
+    'base64': lambda data: base64.b64encode(data).decode('utf-8'),
+}
+
+# Session key used on the client side, where there is only ever one session
+CLIENT_SESSION = 'client'
+
+# Handshake flag for peers that take streamed 'part' frames: the client sets it
+# in its connect URL's query string, the server in a 'hello' event. Peers that
+# don't (older versions) only ever get whole 'file' frames.
+PARTS_FLAG = 'parts'
+
+
+class IncomingChunk:
+    """
+    A streamed block being put together in a temp file, so only the parts in
+    flight are held in memory until it is complete.
+    """
+    def __init__(self, directory: str, length: int):
+        """
+        :param directory: Where to create the temp file
+        :param length: The block's full (unpadded) length
+        """
+        fd, self.path = tempfile.mkstemp(prefix='part-', dir=directory)
+        self.fd = fd
+        self.length = length
+        self.offsets = set()
+        self.received = 0
+        os.ftruncate(fd, length)
+
+    def write(self, offset: int, data: bytes):
+        if offset in self.offsets:
+            return
+        os.pwrite(self.fd, data, offset)
+        self.offsets.add(offset)
+        self.received += len(data)
+
+    def complete(self) -> bool:
+        return self.received >= self.length
+
+    def close(self):
+        if self.fd is None:
+            return
+        os.close(self.fd)
+        self.fd = None
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class Session:
+    """
+    Transfer state for one connected peer: the chunks we want from it, our
+    progress, its activity and the completion handshake.
+    """
+    def __init__(self, key: str, diff: Optional[List['ChunkVersion']], scheduler: TransferScheduler,
+                 client=None):
+        """
+        :param key: The peer's socket.io sid on the server, CLIENT_SESSION on the client
+        :param diff: Chunks to request from the peer
+        :param scheduler: Orders the requests and reports completed files
+        :param client: The socketio.Client, on the client side
+        """
+        self.key = key
+        self.diff = diff or []
+        self.scheduler = scheduler
+        self.client = client
+        self.remaining_chunks = set(
+            (chunk.file_path, chunk.block_number, chunk.version)
+            for chunk in self.diff
+        )
+        self.success = True
+        self.last_activity_time = time.time()
+        self.connection_active = True
+        self.finalized = False
+
+        # Completion handshake: each side sends 'done' once it has every chunk
+        # it asked for, and the session ends when both sides are done
+        self.sent_done = False
+        self.peer_done = False
+
+        self.stats = {'chunks_sent': 0, 'bytes_sent': 0, 'chunks_received': 0, 'bytes_received': 0}
+
+        # Streamed blocks: the ones we are receiving, by chunk, and how far the
+        # peer has acknowledged each block we stream to it
+        self.incoming: Dict[Tuple[str, int, int], IncomingChunk] = {}
+        self.acked: Dict[Tuple[str, int, int], int] = {}
+        self.acks = threading.Condition()
+        # Whether the peer said in the handshake that it takes streamed blocks
+        self.peer_parts = False
+
+    def touch(self):
+        self.last_activity_time = time.time()
+
 
 class FileTransferServer:
-    def __init__(self, package: 'Package', callback: Callable):
+    def __init__(self, package: 'Package', callback: Callable, host: str = AP_HOST, port: int = AP_PORT,
+                 request_delay: float = REQUEST_DELAY, priorities: Optional[Dict[str, int]] = None,
+                 on_file_complete: Optional[Callable[[str], None]] = None, max_workers: int = TRANSFER_WORKERS,
+                 diff_provider: Optional[Callable[[Dict], List['ChunkVersion']]] = None,
+                 durable: bool = DURABLE_WRITES, subframe_bytes: int = SUBFRAME_BYTES,
+                 stream_window: int = STREAM_WINDOW, connect_timeout: float = TRANSFER_CONNECT_TIMEOUT,
+                 round_timeout: float = TRANSFER_ROUND_TIMEOUT):
         """
         Initialize the SocketIO server with package and callback.
         :param package: Package object for handling file chunks
-        :param callback: Function to call upon completion or termination
+        :param callback: Function called with each session's success when it ends
+        :param host: Address the server listens on / the client connects to
+        :param port: Port the server listens on / the client connects to
+        :param request_delay: Seconds to wait between chunk requests
+        :param priorities: Glob pattern -> priority for ordering requests (see TransferScheduler)
+        :param on_file_complete: Called with a file's path as soon as its last missing chunk
+                                 arrives, on its own green thread; blocking disk work
+                                 in it should go through run_io
+        :param max_workers: Chunk requests served at once, across all sessions
+        :param diff_provider: Picks the chunks to request from a newly connected
+                              client, given its WSGI environ; by default every
+                              client gets the diff passed to start_server
+        :param durable: Only count a received chunk once it is fsynced
+        :param subframe_bytes: Stream blocks longer than this as 'part' frames of
+                               this size to peers that take them; 0 always
+                               sends whole blocks
+        :param stream_window: Parts of a streamed block sent ahead of the peer's acks
+        :param connect_timeout: Seconds a round waits for its peer to connect
+        :param round_timeout: Seconds after which a round's open sessions are ended as failed
         """
-        print("[__init__] Initializing FileTransferServer")
-        self.host = '192.168.4.1'
-        self.port = 65432
+        logger.info("[__init__] Initializing FileTransferServer")
+        if not PATCHED_ON_IMPORT:
+            # Importing this module doesn't patch; the entry point must, first (see main.py)
+            raise RuntimeError("eventlet.monkey_patch() must run before file_server is imported")
+        self.host = host
+        self.port = port
+        self.request_delay = request_delay
         self.package = package
         self.callback = callback
-        self.success = True
-        self.diff = None
-        
-        # Tracking variables
-        self.remaining_chunks = set()
-        self.last_activity_time = None
+        self.codec = 'base64'
+        self.frames = FrameCache(FRAME_CACHE_BYTES)  # Ready-to-send frames for hot chunks
         self.inactivity_timeout = 10  # 10 seconds
-        self.connection_active = False
-        
+        self.connect_timeout = connect_timeout
+        self.round_timeout = round_timeout
+        self.priorities = priorities
+        self.on_file_complete = on_file_complete
+        self.diff_provider = diff_provider
+
+        # Open sessions by sid (or CLIENT_SESSION), and a bounded pool serving their requests
+        self.sessions: Dict[str, Session] = {}
+        self.pool = eventlet.GreenPool(max_workers)
+        self._monitor_thread = None
+
+        # Large blocks go out a part at a time, at most a window of parts
+        # ahead of the peer, from a bounded number of streams at once
+        self.subframe_bytes = subframe_bytes
+        self.stream_window = stream_window
+        self.stream_slots = eventlet.Semaphore(max_workers)
+        self._server_parts = False  # On the client: whether the server takes them (see PARTS_FLAG)
+
+        # Disk work runs on native threads (tpool), one piece at a time under
+        # the package's lock, so the event loop keeps serving sockets.
+        # Received chunks are committed in order per file, in the background.
+        self.durable = durable
+        self.io = IOExecutor(IO_WORKERS, IO_QUEUE_BYTES, flush=self.flush_writes)
+
+        # The server outlives its sessions; start_server() only waits for a round of them
+        self._server_socket = None
+        self._server_thread = None
+        self._done = threading.Event()
+        self._connected = threading.Event()
+        self.reset()
+
         # Create SocketIO server
-        print("[__init__] Setting up SocketIO server")
-        self.sio = socketio.Server(always_connect=True,max_http_buffer_size=10**8)  # 100 MB
+        logger.info("[__init__] Setting up SocketIO server")
+        # Handlers run on each connection's reader, so one blocked on a full
+        # write queue stops reading from that peer
+        self.sio = socketio.Server(always_connect=True,max_http_buffer_size=10**8,  # 100 MB
+                                   async_handlers=False)
         self.app = socketio.WSGIApp(self.sio)
-        
+
         # Register server-side event handlers
         self.setup_server_event_handlers()
 
+    def reset(self, diff: List['ChunkVersion'] = None):
+        """
+        Start a new round of sessions. Sessions still open carry on.
+        :param diff: Chunks to request from each peer that connects during the round
+        """
+        self.diff = diff
+        self.success = True
+        self.completed_sessions: List[Session] = []
+        self._done.clear()
+        self._connected.clear()
+
+    def run_io(self, fn: Callable, *args):
+        """Run blocking disk work on a native thread and wait for it without blocking other green threads."""
+        def locked():
+            with self.package.io_lock:
+                return fn(*args)
+        return tpool.execute(locked)
+
+    def flush_writes(self):
+        """Persist the manifest after a batch of chunk writes, and make the batch durable if configured."""
+        self.run_io(self.package.flush, self.durable)
+
+    def open_session(self, key: str, diff: Optional[List['ChunkVersion']], client=None) -> Session:
+        scheduler = TransferScheduler(diff or [], self.priorities, self.package,
+                                      self.file_complete if self.on_file_complete else None)
+        session = Session(key, diff, scheduler, client)
+        self.sessions[key] = session
+        self._connected.set()
+        get_metrics().set('sessions_active', len(self.sessions))
+        self.start_inactivity_monitor()
+        return session
+
+    def file_complete(self, path: str):
+        """
+        Pass a completed file on to on_file_complete, off the disk worker that
+        wrote its last chunk, so a slow or failing hook holds up no writes.
+        """
+        def notify():
+            try:
+                self.on_file_complete(path)
+            except Exception as e:
+                logger.error(f"[file_complete] Handling completed file {path} failed: {e}")
+        eventlet.spawn_n(notify)
+
+    def count_chunk(self, session: Session, direction: str, size: int, chunks: int = 1):
+        """Count encoded bytes (and whole chunks) 'sent' or 'received' in a session."""
+        session.stats[f'chunks_{direction}'] += chunks
+        session.stats[f'bytes_{direction}'] += size
+        metrics = get_metrics()
+        if chunks:
+            metrics.inc(f'chunks_{direction}', chunks)
+        metrics.inc(f'bytes_{direction}', size)
+
+    def _emit(self, session: Session, event: str, payload: Dict):
+        """Send an event to a session's peer: directly on the client, to its room on the server."""
+        if session.client:
+            session.client.emit(event, payload)
+        else:
+            self.sio.emit(event, payload, room=session.key)
+
+    def check_complete(self, session: Session):
+        """
+        Tell the peer once our diff is complete, and end the session once
+        both sides are. Peers that never send 'done' still end the session
+        through the inactivity monitor.
+        """
+        if session.remaining_chunks or session.finalized:
+            return
+        if not session.sent_done:
+            session.sent_done = True
+            self._emit(session, 'done', {})
+        if session.peer_done:
+            logger.info(f"[check_complete] Both sides done, ending session {session.key}")
+            self.end_session(session)
+
+    def end_session(self, session: Session):
+        """Disconnect a session's peer and finalize it."""
+        if session.client:
+            self.finalize_session(session)
+        else:
+            # Finalized by the disconnect handler
+            self.sio.disconnect(session.key)
+            self.finalize_session(session)
+
+    def serve_request(self, session: Session, data: Dict):
+        """
+        Answer a chunk request from a peer (run on the worker pool).
+        """
+        file_path = data['content']['file_path']
+        block_number = data['content']['block_number']
+        version = data['content'].get('version', 1)
+        logger.debug(f"[serve_request] Request details - File Path: {file_path}, Block: {block_number}, Version: {version}")
+
+        # Cache hits stay on the event loop; misses read and encode off it
+        key = (file_path, block_number, version, self.codec)
+        response = self.frames.get(key)
+        if response is None:
+            length = self.run_io(self.package.get_chunk_length, file_path, block_number, version)
+            if session.peer_parts and self.subframe_bytes and length and length > self.subframe_bytes:
+                # Streamed off the pool: waiting there for acks would hold a
+                # worker that the peer's next request may be queued behind
+                eventlet.spawn_n(self.stream_chunk, session, file_path, block_number, version, length)
+                return
+            response = self.run_io(self.encode_frame, file_path, block_number, version)
+            if response:
+                self.frames.put(key, response)
+        if response:
+            logger.info(f"[serve_request] Sending chunk: {file_path}, block {block_number}, version {version}")
+            self._emit(session, 'file', response)
+            self.count_chunk(session, 'sent', len(response['content']['data']))
+        else:
+            logger.warning(f"[serve_request] Chunk not found: {file_path}, block {block_number}")
+            error_response = {
+                'type': 'error',
+                'content': f"Chunk not found: {file_path}, block {block_number}"
+            }
+            self._emit(session, 'error', error_response)
+
+    def stream_chunk(self, session: Session, file_path: str, block_number: int, version: int, length: int):
+        """
+        Send a chunk as 'part' frames of subframe_bytes, read from disk one at
+        a time and at most stream_window of them ahead of the peer's acks, so
+        neither side holds more than a window of the block in memory.
+        :param length: The chunk's unpadded length
+        """
+        key = (file_path, block_number, version)
+        window = self.stream_window * self.subframe_bytes
+        logger.info(f"[stream_chunk] Streaming chunk: {file_path}, block {block_number}, version {version}")
+        with self.stream_slots:
+            for offset in range(0, length, self.subframe_bytes):
+                with session.acks:
+                    ready = session.acks.wait_for(
+                        lambda: session.finalized or offset - session.acked.get(key, 0) < window,
+                        timeout=self.inactivity_timeout)
+                if session.finalized:
+                    return
+                if not ready:
+                    logger.warning(f"[stream_chunk] No ack from {session.key} for {file_path} block {block_number}")
+                    return
+                # Parts of hot chunks are cached like whole frames, by offset
+                part_key = (file_path, block_number, version, self.codec, offset)
+                part = self.frames.get(part_key)
+                if part is None:
+                    part = self.run_io(self.encode_part, file_path, block_number, version, offset, length)
+                    if part is None:
+                        logger.warning(f"[stream_chunk] Chunk went away: {file_path}, block {block_number}")
+                        return
+                    self.frames.put(part_key, part)
+                self._emit(session, 'part', part)
+                self.count_chunk(session, 'sent', len(part['content']['data']), chunks=0)
+                session.touch()
+            self.count_chunk(session, 'sent', 0)
+
+    def receive_ack(self, session: Session, data: Dict):
+        """Note how much of a streamed chunk the peer has on disk, letting the stream move on."""
+        session.touch()
+        content = data['content']
+        key = (content['file_path'], content['block_number'], content.get('version', 1))
+        with session.acks:
+            session.acked[key] = max(session.acked.get(key, 0), content['offset'])
+            session.acks.notify_all()
+
+    def incoming_dir(self) -> str:
+        """Where streamed blocks are put together: next to the package's chunks, if it has any on disk."""
+        if self.package.base_path is None:
+            return tempfile.gettempdir()
+        directory = self.package.base_path / 'incoming'
+        directory.mkdir(exist_ok=True)
+        return str(directory)
+
+    def receive_file(self, session: Session, data: Dict):
+        """
+        Queue a chunk a peer sent us for writing, and update the session's
+        progress once it is on disk. Blocks while the write queue is full.
+        """
+        session.touch()
+        content = data['content']
+        file_path = content['file_path']
+        block_number = content['block_number']
+        version = content.get('version', 1)
+        logger.debug(f"[receive_file] Processing chunk - File Path: {file_path}, Block: {block_number}, Version: {version}")
+
+        def commit():
+            # Decode base64 chunk data
+            chunk_data = base64.b64decode(content['data'])
+            # Write chunk to package; the manifest is saved once per batch, by flush_writes
+            with self.package.deferred_manifest():
+                return self.package.write_chunk(file_path, block_number, chunk_data, version,
+                                                content.get('block_size'))
+
+        def on_done(success: bool, error: Optional[BaseException]):
+            if error is not None or not success:
+                logger.warning(f"[receive_file] Chunk '{file_path}' block {block_number} not saved: {error}")
+                return
+            self.count_chunk(session, 'received', len(content['data']))
+            self.chunk_received(session, file_path, block_number, version)
+
+        # Chunks of one file are written in the order they arrived
+        self.io.submit(file_path, lambda: self.run_io(commit), size=len(content['data']), on_done=on_done)
+
+    def receive_part(self, session: Session, data: Dict):
+        """
+        Queue a part of a streamed chunk for writing to the chunk's temp file,
+        ack it once written, and commit the chunk once its last part is in.
+        """
+        session.touch()
+        content = data['content']
+        file_path = content['file_path']
+        block_number = content['block_number']
+        version = content.get('version', 1)
+        offset = content['offset']
+        key = (file_path, block_number, version)
+
+        def commit():
+            part = base64.b64decode(content['data'])
+            incoming = session.incoming.get(key)
+            if incoming is None:
+                incoming = session.incoming[key] = IncomingChunk(self.incoming_dir(), content['length'])
+            incoming.write(offset, part)
+            if not incoming.complete():
+                return len(part), None
+            # The finished block goes into the store from its temp file, not through memory
+            del session.incoming[key]
+            try:
+                with self.package.deferred_manifest():
+                    return len(part), self.package.write_chunk_file(file_path, block_number, incoming.path,
+                                                                    version, content.get('block_size'))
+            finally:
+                incoming.close()
+
+        def on_done(result, error: Optional[BaseException]):
+            if error is not None:
+                logger.warning(f"[receive_part] Part of '{file_path}' block {block_number} at {offset} not saved: {error}")
+                return
+            size, saved = result
+            self.count_chunk(session, 'received', len(content['data']), chunks=0)
+            self._emit(session, 'ack', {
+                'type': 'ack',
+                'content': {'file_path': file_path, 'block_number': block_number, 'version': version,
+                            'offset': offset + size}
+            })
+            if saved is None:
+                return
+            if not saved:
+                logger.warning(f"[receive_part] Chunk '{file_path}' block {block_number} not saved")
+                return
+            self.count_chunk(session, 'received', 0)
+            self.chunk_received(session, file_path, block_number, version)
+
+        # In order with the file's other chunks and parts
+        self.io.submit(file_path, lambda: self.run_io(commit), size=len(content['data']), on_done=on_done)
+
+    def chunk_received(self, session: Session, file_path: str, block_number: int, version: int):
+        """Update a session's progress for a chunk that is now on disk."""
+        logger.info(f"[chunk_received] Chunk '{file_path}' received and saved.")
+
+        # Remove this chunk from remaining chunks first: it is on disk, whatever happens next
+        remaining_key = (file_path, block_number, version)
+        if remaining_key in session.remaining_chunks:
+            session.remaining_chunks.remove(remaining_key)
+            logger.info(f"[chunk_received] Remaining chunks for {session.key}: {len(session.remaining_chunks)}")
+        try:
+            session.scheduler.received(file_path, block_number, version)
+        finally:
+            self.check_complete(session)
+
     def setup_server_event_handlers(self):
         """
         Set up SocketIO event handlers for the server side.
         """
-        print("[setup_server_event_handlers] Setting up server event handlers")
+        logger.info("[setup_server_event_handlers] Setting up server event handlers")
 
         @self.sio.on('connect')
         def on_connect(sid, environ):
-            print(f"[on_connect] Client connected: {sid}")
-            self.connection_active = True
-            self.last_activity_time = time.time()
-            print("[on_connect] Connection state updated")
-
-            self.connection_active = True
-            self.last_activity_time = time.time()
-            
+            logger.info(f"[on_connect] Client connected: {sid}")
+            diff = self.diff_provider(environ) if self.diff_provider else self.diff
+            session = self.open_session(sid, diff)
+            # Handshake: the client asks for parts in its query string, and we say we take them too
+            session.peer_parts = PARTS_FLAG in parse_qs(environ.get('QUERY_STRING', ''))
+            self.sio.emit('hello', {'type': 'hello', 'content': {PARTS_FLAG: True}}, room=sid)
+
             # If diff is set, start processing chunks after connection
-            if hasattr(self, 'diff') and self.diff:
-                print("[on_connect] Processing diff on connection")
-                # Convert diff to set of remaining chunks
-                self.remaining_chunks = set(
-                    (chunk.file_path, chunk.block_number, chunk.version) 
-                    for chunk in self.diff
-                )
-                self.process_diff(sid)
-                
-                # Start inactivity timeout thread
-                self.start_inactivity_monitor(sid)
-            else :
-                print("[on_connect] No diff to process")
+            if session.diff:
+                logger.info(f"[on_connect] Processing diff of {len(session.diff)} chunks for {sid}")
+                self.pool.spawn_n(self.process_diff, session)
+            else:
+                logger.info("[on_connect] No diff to process")
+            self.check_complete(session)
 
         @self.sio.on('request')
         def on_request(sid, data):
             """
             Handle file chunk request from client.
             """
-            print(f"[on_request] Received request: {data}")
-            # Update last activity time
-            self.last_activity_time = time.time()
-            print("[on_request] Last activity time updated")
-            
-            file_path = data['content']['file_path']
-            block_number = data['content']['block_number']
-            version = data.get('version', 1)
-            print(f"[on_request] Request details - File Path: {file_path}, Block: {block_number}, Version: {version}")
-            
-            # Read chunk from package
-            chunk_data = self.package.read_chunk(file_path, block_number, version)
-            
-            if chunk_data:
-                print(f"[on_request] Sending chunk: {file_path}, block {block_number}, version {version}")
-                response = {
-                    'type': 'file',
-                    'content': {
-                        'file_path': file_path,
-                        'block_number': block_number,
-                        'version': version,
-                        'data': base64.b64encode(chunk_data).decode('utf-8')
-                    }
-                }
-                self.sio.emit('file', response, room=sid)
-            else:
-                print(f"[on_request] Chunk not found: {file_path}, block {block_number}")
-                error_response = {
-                    'type': 'error',
-                    'content': f"Chunk not found: {file_path}, block {block_number}"
-                }
-                self.sio.emit('error', error_response, room=sid)
+            logger.debug(f"[on_request] Received request: {data}")
+            session = self.sessions.get(sid)
+            if session is None:
+                return
+            session.touch()
+            # Blocks while the pool is busy, which holds back this client's reads
+            self.pool.spawn_n(self.serve_request, session, data)
 
         @self.sio.on('file')
         def on_file(sid, data):
             """
             Process received file chunk.
             """
-            print(f"[on_file] Received file chunk: {data}")
-            # Update last activity time
-            self.last_activity_time = time.time()
-            print("[on_file] Last activity time updated")
-            
-            file_path = data['content']['file_path']
-            block_number = data['content']['block_number']
-            version = data['content'].get('version', 1)
-            print(f"[on_file] Processing chunk - File Path: {file_path}, Block: {block_number}, Version: {version}")
-            
-            # Decode base64 chunk data
-            chunk_data = base64.b64decode(data['content']['data'])
-            
-            # Write chunk to package
-            self.package.write_chunk(file_path, block_number, chunk_data, version)
-            print(f"[on_file] Chunk '{file_path}' received and saved.")
-            
-            # Remove this chunk from remaining chunks
-            remaining_key = (file_path, block_number, version)
-            if remaining_key in self.remaining_chunks:
-                self.remaining_chunks.remove(remaining_key)
-                print(f"[on_file] Remaining chunks: {len(self.remaining_chunks)}")
+            logger.debug(f"[on_file] Received file chunk: {redact_frame(data)}")
+            session = self.sessions.get(sid)
+            if session is not None:
+                self.receive_file(session, data)
+
+        @self.sio.on('part')
+        def on_part(sid, data):
+            """
+            Process part of a streamed file chunk.
+            """
+            logger.debug(f"[on_part] Received chunk part: {redact_frame(data)}")
+            session = self.sessions.get(sid)
+            if session is not None:
+                self.receive_part(session, data)
+
+        @self.sio.on('ack')
+        def on_ack(sid, data):
+            session = self.sessions.get(sid)
+            if session is not None:
+                self.receive_ack(session, data)
+
+        @self.sio.on('done')
+        def on_done(sid, data):
+            logger.info(f"[on_done] Client {sid} has all of its chunks")
+            session = self.sessions.get(sid)
+            if session is not None:
+                session.peer_done = True
+                self.check_complete(session)
 
         @self.sio.on('disconnect')
         def on_disconnect(sid):
-            print(f"[on_disconnect] Client disconnected: {sid}")
-            self.connection_active = False
-            self.finalize_transfer()
+            logger.info(f"[on_disconnect] Client disconnected: {sid}")
+            session = self.sessions.get(sid)
+            if session is not None:
+                session.connection_active = False
+                self.finalize_session(session)
+
+    def encode_frame(self, file_path: str, block_number: int, version: int) -> Optional[Dict]:
+        """
+        Read a chunk and encode it as a 'file' frame, bypassing the frame cache.
+        :return: The frame, or None if we don't have the chunk
+        """
+        # Read chunk from package, pinned in the block cache while encoding
+        # Short blocks are sent unpadded, so the receiver learns their real length
+        with self.package.pinned_chunk(file_path, block_number, version, padded=False) as chunk_data:
+            if not chunk_data:
+                return None
+            return {
+                'type': 'file',
+                'content': {
+                    'file_path': file_path,
+                    'block_number': block_number,
+                    'version': version,
+                    'block_size': self.package.get_block_size(file_path),
+                    'data': FRAME_CODECS[self.codec](chunk_data)
+                }
+            }
+
+    def encode_part(self, file_path: str, block_number: int, version: int, offset: int,
+                    length: int) -> Optional[Dict]:
+        """
+        Read subframe_bytes of a chunk from `offset` and encode them as a 'part'
+        frame, bypassing the frame cache.
+        :param length: The chunk's unpadded length
+        :return: The frame, or None if we don't have the chunk
+        """
+        data = self.package.read_chunk_range(file_path, block_number, version, offset, self.subframe_bytes)
+        if not data:
+            return None
+        return {
+            'type': 'part',
+            'content': {
+                'file_path': file_path,
+                'block_number': block_number,
+                'version': version,
+                'block_size': self.package.get_block_size(file_path),
+                'offset': offset,
+                'length': length,
+                'data': FRAME_CODECS[self.codec](data)
+            }
+        }
+
+    def prefill_frames(self, stop: Optional[threading.Event] = None) -> int:
+        """
+        Encode frames for the newest chunks ahead of time, while the node is
+        idle, until the frame cache is full. Meant to run in the background
+        during discovery.
+        :param stop: Set to abandon prefilling early
+        :return: Number of frames encoded
+        """
+        # Newest versions first: they are what peers catching up will ask for
+        with self.package.io_lock:
+            chunks = sorted(
+                ((version, file_path, block_number)
+                 for file_path, blocks in self.package.manifest.files.items()
+                 for block_number, version in blocks.items()),
+                reverse=True
+            )
+        encoded = 0
+        for version, file_path, block_number in chunks:
+            if stop is not None and stop.is_set() or self.frames.size >= self.frames.max_bytes:
+                break
+            # Runs beside transfers and garbage collection, one frame at a time
+            with self.package.io_lock:
+                length = self.package.get_chunk_length(file_path, block_number, version) or 0
+            key = (file_path, block_number, version, self.codec)
+            if self.subframe_bytes and length > self.subframe_bytes:
+                # Streamed chunks are cached as the parts stream_chunk sends
+                offsets = range(0, length, self.subframe_bytes)
+            else:
+                offsets = [None]
+            for offset in offsets:
+                frame_key = key if offset is None else key + (offset,)
+                if frame_key in self.frames:
+                    continue
+                with self.package.io_lock:
+                    if offset is None:
+                        frame = self.encode_frame(file_path, block_number, version)
+                    else:
+                        frame = self.encode_part(file_path, block_number, version, offset, length)
+                if frame is None:
+                    break
+                self.frames.put(frame_key, frame)
+                encoded += 1
+                if self.frames.size >= self.frames.max_bytes:
+                    break
+        logger.info(f"[prefill_frames] Encoded {encoded} frames, cache: {self.frames.stats()}")
+        return encoded
 
     def setup_client_event_handlers(self, client):
         """
         Set up SocketIO event handlers for the client side.
-        This is similar in spirit to the server handlers, 
+        This is similar in spirit to the server handlers,
         but uses the 'client' object and defines handlers for server-initiated events.
         """
-        print("[setup_client_event_handlers] Setting up client event handlers")
+        logger.info("[setup_client_event_handlers] Setting up client event handlers")
 
         @client.on('connect')
         def on_connect():
-            print("[client.on_connect] Client connected to server")
-            self.connection_active = True
-            self.last_activity_time = time.time()
-            print("[client.on_connect] Connection state updated")
+            logger.info("[client.on_connect] Client connected to server")
+            session = self.open_session(CLIENT_SESSION, self.diff, client)
+            session.peer_parts = self._server_parts
 
             # If we have a diff, process it after connection
-            if self.diff:
-                self.remaining_chunks = set(
-                    (chunk.file_path, chunk.block_number, chunk.version) 
-                    for chunk in self.diff
-                )
-                print(f"[client.on_connect] Remaining chunks set: {self.remaining_chunks}")
-
+            if session.diff:
+                logger.debug(f"[client.on_connect] Remaining chunks set: {len(session.remaining_chunks)}")
                 # Request out-of-sync chunks from the server
-                self.process_diff(client=client)
+                self.pool.spawn_n(self.process_diff, session)
+            self.check_complete(session)
 
-                # Start inactivity monitor
-                self.start_inactivity_monitor(client.sid)
+        @client.on('hello')
+        def on_server_hello(data):
+            """
+            Handle the server's side of the handshake. Events are handled on
+            their own threads, so this can come before on_connect has run.
+            """
+            self._server_parts = bool(data['content'].get(PARTS_FLAG))
+            session = self.sessions.get(CLIENT_SESSION)
+            if session is not None:
+                session.peer_parts = self._server_parts
 
         @client.on('request')
         def on_server_request(data):
@@ -176,35 +683,12 @@ class FileTransferServer:
             Handle 'request' event sent by the server.
             The server is requesting a file chunk from the client.
             """
-            print("[client.on_server_request] Received request from server:", data)
-            self.last_activity_time = time.time()
-
-            file_path = data['content']['file_path']
-            block_number = data['content']['block_number']
-            version = data['content'].get('version', 1)
-
-            # If the client can provide chunks (assuming `self.package` exists on client)
-            chunk_data = self.package.read_chunk(file_path, block_number, version) if self.package else None
-
-            if chunk_data:
-                print(f"[client.on_server_request] Sending chunk: {file_path}, block {block_number}, version {version}")
-                response = {
-                    'type': 'file',
-                    'content': {
-                        'file_path': file_path,
-                        'block_number': block_number,
-                        'version': version,
-                        'data': base64.b64encode(chunk_data).decode('utf-8')
-                    }
-                }
-                client.emit('file', response)
-            else:
-                print(f"[client.on_server_request] Chunk not found: {file_path}, block {block_number}")
-                error_response = {
-                    'type': 'error',
-                    'content': f"Chunk not found: {file_path}, block {block_number}"
-                }
-                client.emit('error', error_response)
+            logger.debug(f"[client.on_server_request] Received request from server: {data}")
+            session = self.sessions.get(CLIENT_SESSION)
+            if session is None:
+                return
+            session.touch()
+            self.pool.spawn_n(self.serve_request, session, data)
 
         @client.on('file')
         def on_server_file(data):
@@ -212,124 +696,127 @@ class FileTransferServer:
             Handle 'file' event from the server.
             The server has sent a file chunk to this client.
             """
-            self.last_activity_time = time.time()
+            session = self.sessions.get(CLIENT_SESSION)
+            if session is not None:
+                self.receive_file(session, data)
 
-            file_path = data['content']['file_path']
-            block_number = data['content']['block_number']
-            version = data['content'].get('version', 1)
-            print(f'[client.on_server_file] Processing chunk - File Path: {file_path}, Block: {block_number}, Version: {version}')
-            chunk_data = base64.b64decode(data['content']['data'])
-
-            # If the client also stores chunks (assuming `self.package` is present)
-            self.package.write_chunk(file_path, block_number, chunk_data, version)
-            print(f"[client.on_server_file] Chunk '{file_path}' received and saved.")
-
-            # Remove this chunk from remaining chunks if applicable
-            remaining_key = (file_path, block_number, version)
-            if remaining_key in self.remaining_chunks:
-                self.remaining_chunks.remove(remaining_key)
-                print(f"[client.on_server_file] Remaining chunks: {len(self.remaining_chunks)}")
+        @client.on('part')
+        def on_server_part(data):
+            """
+            Handle 'part' event from the server: part of a streamed chunk.
+            """
+            session = self.sessions.get(CLIENT_SESSION)
+            if session is not None:
+                self.receive_part(session, data)
+
+        @client.on('ack')
+        def on_server_ack(data):
+            session = self.sessions.get(CLIENT_SESSION)
+            if session is not None:
+                self.receive_ack(session, data)
+
+        @client.on('done')
+        def on_server_done(data):
+            logger.info("[client.on_server_done] Server has all of its chunks")
+            session = self.sessions.get(CLIENT_SESSION)
+            if session is not None:
+                session.peer_done = True
+                self.check_complete(session)
 
         @client.on('error')
         def on_server_error(data):
             """
             Handle 'error' event from server.
             """
-            print("[client.on_server_error] Received error from server:", data)
+            logger.warning(f"[client.on_server_error] Received error from server: {data}")
 
         @client.on('disconnect')
         def on_server_disconnect():
-            print("[client.on_server_disconnect] Disconnected from server")
-            self.connection_active = False
-            self.finalize_transfer(client)
+            logger.info("[client.on_server_disconnect] Disconnected from server")
+            session = self.sessions.get(CLIENT_SESSION)
+            if session is not None:
+                session.connection_active = False
+                self.finalize_session(session)
 
 
-    def start_inactivity_monitor(self, sid):
+    def start_inactivity_monitor(self):
         """
-        Monitor connection for inactivity and potential closure.
-        If no clients are connected and all chunks are processed, stop the server.
+        Watch every open session for inactivity or a broken connection, and
+        end the ones that stall. One monitor serves all sessions.
         """
-        print("[start_inactivity_monitor] Starting inactivity monitor")
+        if self._monitor_thread is not None and self._monitor_thread.is_alive():
+            return
+        logger.info("[start_inactivity_monitor] Starting inactivity monitor")
 
         def monitor():
-            while True:
-                # Check for inactivity or broken connection
+            while self.sessions:
                 current_time = time.time()
-                if not self.connection_active:
-                    print("[monitor] Connection broken. Shutting down server.")
-                    self.finalize_transfer()
-                    break
-                elif current_time - self.last_activity_time > self.inactivity_timeout:
-                    print("[monitor] Inactivity timeout reached. Shutting down server.")
-                    self.finalize_transfer()
-                    break
-
-                print("[monitor] Monitoring activity...")
+                for session in list(self.sessions.values()):
+                    if not session.connection_active:
+                        logger.warning(f"[monitor] Connection to {session.key} broken. Ending session.")
+                        self.finalize_session(session)
+                    elif current_time - session.last_activity_time > self.inactivity_timeout:
+                        logger.warning(f"[monitor] Inactivity timeout reached for {session.key}. Ending session.")
+                        self.end_session(session)
+                logger.debug("[monitor] Monitoring activity...")
                 time.sleep(1)
 
         # Start monitoring in a separate thread
-        threading.Thread(target=monitor, daemon=True).start()
+        self._monitor_thread = threading.Thread(target=monitor, daemon=True)
+        self._monitor_thread.start()
 
-    def finalize_transfer(self, client=None):
+    def finalize_session(self, session: Session):
         """
-        Finalize the transfer, stop the server if running, and call the callback.
+        Finalize a session and call the callback with its result. Other
+        sessions and the server carry on.
         """
-        print("[finalize_transfer] Finalizing transfer")
-        # Ensure this is only called once
-        if not hasattr(self, '_finalized'):
-            self._finalized = True
-            self.success = len(self.remaining_chunks) == 0
-            print(f"[finalize_transfer] Transfer {'successful' if self.success else 'failed'}. "
-                f"Remaining chunks: {len(self.remaining_chunks)}")
-            self.callback(self.success)
-
-        if client:
-            print("[finalize_transfer] Disconnecting client")
-            client.disconnect()
-        else:
-            print("[finalize_transfer] Stopping the server")
-            # Stop the server by closing the listener socket
-            if hasattr(self, '_server_socket') and self._server_socket:
-                self._server_socket.close()
-                print("[finalize_transfer] Server socket closed")
-            if hasattr(self, '_server_thread') and self._server_thread.is_alive():
-                self._server_thread.join()
-                print("[finalize_transfer] Server thread stopped")
-
-            
-        
-
-    def process_diff(self, sid=None, client=None):
+        # Ensure this is only called once per session
+        if not session.finalized:
+            session.finalized = True
+            with session.acks:
+                session.acks.notify_all()  # Streams to this peer give up
+            if session.remaining_chunks:
+                # Chunks that already arrived may still be on their way to disk
+                self.io.drain(timeout=self.inactivity_timeout)
+            # Streamed blocks that never got all their parts
+            for incoming in list(session.incoming.values()):
+                incoming.close()
+            session.incoming.clear()
+            logger.info(f"[finalize_session] Finalizing session {session.key}")
+            with get_metrics().span("finalize"):
+                session.success = session.success and len(session.remaining_chunks) == 0
+                logger.info(f"[finalize_session] Transfer {'successful' if session.success else 'failed'}. "
+                    f"Remaining chunks: {len(session.remaining_chunks)}, "
+                    f"files completed: {len(session.scheduler.completed)}")
+                logger.info(f"[finalize_session] Session stats: {session.stats}")
+                get_metrics().inc('sessions', result='success' if session.success else 'failure')
+                self.success = self.success and session.success
+                self.completed_sessions.append(session)
+                self.callback(session.success)
+            if self.sessions.get(session.key) is session:
+                del self.sessions[session.key]
+            get_metrics().set('sessions_active', len(self.sessions))
+            if not self.sessions:
+                self._done.set()
+
+        if session.client:
+            logger.info("[finalize_session] Disconnecting client")
+            session.client.disconnect()
+
+    def process_diff(self, session: Session):
         """
-        Process the diff by requesting chunks
+        Process a session's diff by requesting chunks
         """
-        print("[process_diff] Processing diff")
-        if not self.diff:
-            print("[process_diff] No diff to process")
+        logger.info(f"[process_diff] Processing diff for {session.key}")
+        if not session.diff:
+            logger.info("[process_diff] No diff to process")
             return
 
-        # Determine if we are on the server or client
-        on_server = sid is not None
-
-        # Debug: Print whether we're client or server
-        if on_server:
-            print("[process_diff] Running on server side.")
-            # On the server side, we have self.sio.eio.sockets, so we can check if sid is connected
-            if hasattr(self.sio, 'eio') and hasattr(self.sio.eio, 'sockets'):
-                print(f"[Debug - Server] Sockets connected: {list(self.sio.eio.sockets.keys())}")
-                print(f"[Debug - Server] Is sid {sid} connected? {sid in self.sio.eio.sockets}")
-            else:
-                print("[Debug - Server] Unable to verify sid connection state (no eio.sockets).")
-        else:
-            print("[process_diff] Running on client side.")
-            # On the client side, self.sio is typically a client instance
-            print(f"[Debug - Client] Client namespaces: {getattr(self.sio, 'namespaces', 'N/A')}")
-            print(f"[Debug - Client] Client SID: {getattr(self.sio, 'sid', 'N/A')}")
-            print(f"[Debug - Client] Is client connected? {getattr(self.sio, 'connected', 'N/A')}")
-
-        # Request out-of-sync chunks
-        for chunk in self.diff:
-            print(f"[process_diff] Requesting chunk: {chunk}")
+        # Request out-of-sync chunks, a whole file at a time, most urgent first
+        for chunk in session.scheduler.order():
+            if session.finalized:
+                break
+            logger.debug(f"[process_diff] Requesting chunk: {chunk}")
             request_msg = {
                 'type': 'request',
                 'content': {
@@ -339,80 +826,138 @@ class FileTransferServer:
                 }
             }
 
-            # If on server, use room=sid to emit
-            # If on client, just emit directly
-            if on_server:
-                print(f"[Debug - Server] Emitting 'request' to sid {sid}")
-                self.sio.emit('request', request_msg, room=sid)
-            else:
-                print("[Debug - Client] Emitting 'request' directly to server (no room)")
-                client.emit('request', request_msg)
-            # delay 2 seconds between requests
-            time.sleep(2)
-
+            self._emit(session, 'request', request_msg)
+            # pace requests
+            if self.request_delay:
+                time.sleep(self.request_delay)
 
-    def start_client(self, diff: List['ChunkVersion']):
+    def fail_round(self):
+        """Report a round that never got a session going (e.g. we couldn't connect)."""
+        if self.completed_sessions or self.sessions:
+            return
+        self.success = False
+        get_metrics().inc('sessions', result='failure')
+        self.callback(False)
+        self._done.set()
+
+    def expire_round(self):
+        """End the sessions still open when a round runs out of time, as failures."""
+        for session in list(self.sessions.values()):
+            session.success = False
+            self.end_session(session)
+
+    def start_client(self, diff: List['ChunkVersion']) -> bool:
         """
-        Start the client and request out-of-sync chunks.
+        Start the client and request out-of-sync chunks, blocking until the
+        session ends or round_timeout runs out.
         :param diff: The remaining packages to get
+        :return: True if the session got every chunk it asked for
         """
-        print("[start_client] Starting client")
+        logger.info("[start_client] Starting client")
+        client = None
         try:
             # Store diff for later processing
-            self.diff = diff
-            print("[start_client] Diff stored for processing")
+            self.reset(diff)
+            logger.info("[start_client] Diff stored for processing")
 
-            # Connect to server
-            client = socketio.Client(reconnection=True)  # 100 MB
+            # Connect to server; until it says otherwise, it only takes whole frames
+            client = socketio.Client(reconnection=True)
+            self._server_parts = False
 
             # Set up client event handlers before connecting
             self.setup_client_event_handlers(client)
 
-            print(f"[start_client] Connecting to server at {self.host}:{self.port}")
-            client.connect(f'http://{self.host}:{self.port}', wait_timeout=25, transports=['websocket'])
-            
-            # Keep the client running
-            client.wait()
+            logger.info(f"[start_client] Connecting to server at {self.host}:{self.port}")
+            client.connect(f'http://{self.host}:{self.port}?{PARTS_FLAG}=1', wait_timeout=self.connect_timeout,
+                           transports=['websocket'])
+
+            # Keep the client running until the session ends
+            if not self._done.wait(self.round_timeout):
+                logger.warning(f"[start_client] Round took over {self.round_timeout}s; giving up")
+                self.expire_round()
         except Exception as e:
-            print(f"[start_client] Client error: {e}")
-            self.success = False
-            self.finalize_transfer()
+            logger.error(f"[start_client] Client error: {e}")
+            session = self.sessions.get(CLIENT_SESSION)
+            if session is not None:
+                session.success = False
         finally:
             # Ensure callback is called
-            self.finalize_transfer()
-
-    def start_server(self, diff: List['ChunkVersion'] = None):
+            session = self.sessions.get(CLIENT_SESSION)
+            if session is not None:
+                self.finalize_session(session)
+            if client is not None:
+                client.disconnect()
+            self.fail_round()
+        return self.success
+
+    def serve(self):
+        """
+        Start listening, if we aren't already. The server keeps accepting
+        sessions until stop() is called.
+        """
+        if self._server_socket is not None:
+            return
+        # Create a listener socket and save it for stopping the server
+        self._server_socket = eventlet.listen((self.host, self.port))
+        logger.info(f"[serve] Hosting server on {self.host}:{self.port}")
+
+        # Run the server in its own green thread; stop() kills it, since
+        # closing the listener doesn't wake a pending accept
+        self._server_thread = eventlet.spawn(eventlet.wsgi.server, self._server_socket, self.app,
+                                             log_output=False)
+
+    def stop(self):
+        """End every open session and stop the server."""
+        for session in list(self.sessions.values()):
+            if not session.client:
+                self.end_session(session)
+        self.io.drain()
+        logger.info(f"[stop] Disk writes: {self.io.stats}")
+        logger.info("[stop] Stopping the server")
+        server_thread = self._server_thread
+        if server_thread is not None and not server_thread.dead:
+            server_thread.kill()
+            logger.info("[stop] Server thread stopped")
+        self._server_thread = None
+        if self._server_socket:
+            self._server_socket.close()
+            self._server_socket = None
+            logger.info("[stop] Server socket closed")
+
+    def start_server(self, diff: List['ChunkVersion'] = None) -> bool:
         """
-        Start the SocketIO server and listen for connections.
+        Serve a round of sessions: start the server if needed and block until
+        the sessions that connect have all ended, no peer connects within
+        connect_timeout, or round_timeout runs out. The server keeps running.
         :param diff: Optional diff to process when a client connects
+        :return: True if a peer connected and every session of the round succeeded
         """
-        print("[start_server] Starting server")
+        logger.info("[start_server] Starting server")
         try:
             # Store diff for later processing if provided
+            self.reset(diff)
             if diff:
-                self.diff = diff
-                print(f"[start_server] Diff set for processing: {self.diff}")
+                logger.debug(f"[start_server] Diff set for processing: {len(self.diff)} chunks")
             else:
-                print("[start_server] No diff provided for processing")
-
-            # Import WSGI server (eventlet or threading)
-            import eventlet
-            # Create a listener socket and save it for stopping the server
-            self._server_socket = eventlet.listen((self.host, self.port))
-            print(f"[start_server] Hosting server on {self.host}:{self.port}")
-
-            # Run the server in a separate thread
-            self._server_thread = threading.Thread(
-                target=eventlet.wsgi.server,
-                args=(self._server_socket, self.app),
-                daemon=True
-            )
-            self._server_thread.start()
+                logger.info("[start_server] No diff provided for processing")
+
+            self.serve()
+            started = time.monotonic()
+
+            # Wait for a peer, then for the clients to finish (disconnect or
+            # inactivity timeout); the inactivity monitor only runs once one connects
+            if not self._connected.wait(self.connect_timeout):
+                logger.warning(f"[start_server] No peer connected within {self.connect_timeout}s")
+                self.fail_round()
+                self.success = False
+            else:
+                remaining = None
+                if self.round_timeout is not None:
+                    remaining = max(0.0, self.round_timeout - (time.monotonic() - started))
+                if not self._done.wait(remaining):
+                    logger.warning(f"[start_server] Round took over {self.round_timeout}s; ending open sessions")
+                    self.expire_round()
         except Exception as e:
-            print(f"[start_server] Server error: {e}")
-            self.success = False
-            self.finalize_transfer()
-        finally:
-            # Ensure callback is called
-            print("[start_server] Finalizing transfer")
-            self.finalize_transfer()
+            logger.error(f"[start_server] Server error: {e}")
+            self.fail_round()
+        return self.success
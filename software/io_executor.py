@@ -0,0 +1,154 @@
+"""
+Background executor for disk writes, so network handlers don't wait on the
+SD card.
+
+Work is submitted under a key (the file a chunk belongs to). Each key has
+its own queue, committed in submission order, while different keys are
+committed by different workers at once. A worker takes everything queued
+for a key as one batch, runs it, then calls the flush hook once (e.g.
+fsync the chunks and the manifest) before reporting any of the batch as
+done, so callers only hear about writes that are durable, and a burst of
+chunks for one file costs one fsync rather than one each.
+
+Submitting blocks while more than max_pending_bytes are queued, which
+pushes back on whatever is producing the writes (the socket reader).
+"""
+import logging
+import threading
+from collections import deque
+from typing import Any, Callable, Deque, Dict, Hashable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_WORKERS = 2
+DEFAULT_MAX_PENDING_BYTES = 32 * 1048576
+
+# (work, size, on_done)
+_Job = Tuple[Callable[[], Any], int, Optional[Callable[[Any, Optional[BaseException]], None]]]
+
+
+class IOExecutor:
+    def __init__(self, workers: int = DEFAULT_WORKERS, max_pending_bytes: int = DEFAULT_MAX_PENDING_BYTES,
+                 flush: Optional[Callable[[], None]] = None):
+        """
+        Args:
+            workers (int): Keys committed at once
+            max_pending_bytes (int): Bytes queued or being written beyond which
+                                     submit() blocks
+            flush (Callable, optional): Makes everything written so far
+                                        durable; called after each batch
+        """
+        self.max_pending_bytes = max_pending_bytes
+        self.flush = flush
+        self.pending_bytes = 0
+        self.pending_jobs = 0
+        self.stats = {'submitted': 0, 'committed': 0, 'failed': 0, 'batches': 0, 'stalls': 0}
+
+        self._queues: Dict[Hashable, Deque[_Job]] = {}
+        self._ready: Deque[Hashable] = deque()  # Keys with work and no worker on them
+        self._active = set()
+        self._closed = False
+        self._cond = threading.Condition()
+        self._workers = [threading.Thread(target=self._run, daemon=True, name=f"io-{n}") for n in range(workers)]
+        for worker in self._workers:
+            worker.start()
+
+    def submit(self, key: Hashable, work: Callable[[], Any], size: int = 0,
+               on_done: Optional[Callable[[Any, Optional[BaseException]], None]] = None):
+        """
+        Queue `work` behind everything already queued for `key`.
+
+        Args:
+            key (Hashable): Ordering key; work for one key runs in order
+            work (Callable): Does the write; its return value goes to on_done
+            size (int): Bytes the job holds, counted against max_pending_bytes
+            on_done (Callable, optional): Called as on_done(result, error) once
+                                          the work is durable (or failed)
+        """
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("IOExecutor is closed")
+            # A single job bigger than the limit still goes through on an empty queue
+            if self.pending_bytes and self.pending_bytes + size > self.max_pending_bytes:
+                self.stats['stalls'] += 1
+                while self.pending_bytes and self.pending_bytes + size > self.max_pending_bytes:
+                    self._cond.wait()
+            self.pending_bytes += size
+            self.pending_jobs += 1
+            self.stats['submitted'] += 1
+            queue = self._queues.get(key)
+            if queue is None:
+                queue = self._queues[key] = deque()
+            queue.append((work, size, on_done))
+            if key not in self._active and key not in self._ready:
+                self._ready.append(key)
+            self._cond.notify_all()
+
+    def drain(self, timeout: Optional[float] = None) -> bool:
+        """
+        Wait until everything submitted so far is committed and its
+        on_done has run. Not to be called from an on_done callback.
+
+        Returns:
+            bool: False if `timeout` ran out first
+        """
+        with self._cond:
+            return self._cond.wait_for(lambda: not self.pending_jobs, timeout)
+
+    def close(self):
+        """Commit what's queued, then stop the workers."""
+        self.drain()
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        for worker in self._workers:
+            if worker is not threading.current_thread():
+                worker.join()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._ready and not self._closed:
+                    self._cond.wait()
+                if not self._ready:
+                    return
+                key = self._ready.popleft()
+                self._active.add(key)
+                batch: List[_Job] = list(self._queues.pop(key))
+            outcomes = self._commit(batch)
+            with self._cond:
+                self.pending_bytes -= sum(size for _, size, _ in batch)
+                self._cond.notify_all()
+            # Outside the lock: callbacks may submit more work
+            for on_done, result, error in outcomes:
+                if on_done is not None:
+                    try:
+                        on_done(result, error)
+                    except Exception as e:
+                        logger.error(f"[io] Completion callback failed: {e}")
+            with self._cond:
+                self._active.discard(key)
+                if key in self._queues:
+                    self._ready.append(key)
+                self.pending_jobs -= len(batch)
+                self._cond.notify_all()
+
+    def _commit(self, batch: List[_Job]) -> List[Tuple[Optional[Callable], Any, Optional[BaseException]]]:
+        outcomes = []
+        for work, _, on_done in batch:
+            try:
+                outcomes.append((on_done, work(), None))
+            except Exception as e:
+                logger.error(f"[io] Write failed: {e}")
+                outcomes.append((on_done, None, e))
+        if self.flush is not None:
+            try:
+                self.flush()
+            except Exception as e:
+                # Nothing in the batch is known to be durable
+                logger.error(f"[io] Flush failed: {e}")
+                outcomes = [(on_done, None, error or e) for on_done, _, error in outcomes]
+        self.stats['batches'] += 1
+        for _, _, error in outcomes:
+            self.stats['failed' if error else 'committed'] += 1
+        return outcomes
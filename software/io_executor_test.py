@@ -0,0 +1,59 @@
+import json
+import tempfile
+import threading
+import time
+
+from io_executor import IOExecutor
+from sync import *
+
+
+def test_ordered_per_key_and_done_only_after_flush():
+    committed, flushed, done = [], [], []
+    gate = threading.Event()
+
+    def flush():
+        gate.wait()
+        flushed.append(len(committed))
+
+    io = IOExecutor(workers=2, max_pending_bytes=10, flush=flush)
+    for n in range(5):
+        io.submit("/a", lambda n=n: committed.append(("/a", n)), size=1,
+                  on_done=lambda result, error, n=n: done.append(("/a", n, len(flushed))))
+    io.submit("/b", lambda: committed.append(("/b", 0)), size=1)
+    time.sleep(0.1)
+    assert not done  # written, but nothing is durable yet
+
+    # The queue is full, so the next submit waits for a batch to land
+    blocked = threading.Thread(target=io.submit, args=("/c", lambda: committed.append(("/c", 0)), 5))
+    blocked.start()
+    time.sleep(0.1)
+    assert blocked.is_alive()
+    gate.set()
+    blocked.join(timeout=5)
+    assert io.drain(timeout=5)
+
+    assert [n for path, n in committed if path == "/a"] == list(range(5))
+    assert all(flushes >= 1 for _, _, flushes in done)
+    assert io.stats["stalls"] == 1 and io.stats["committed"] == 7
+    io.close()
+
+
+def test_deferred_manifest_is_saved_by_flush():
+    base = tempfile.mkdtemp()
+    pkg = Package("my-package", 1, base_path=base)
+    with pkg.deferred_manifest():
+        pkg.write_chunk("/etc/motd", 0, b"hello\n", version=1)
+    assert not os.path.exists(os.path.join(base, "manifest.json"))
+
+    pkg.flush()
+    with open(os.path.join(base, "manifest.json")) as f:
+        assert json.load(f)["files"]["/etc/motd"] == {"0": 1}
+    reloaded = Package("my-package", 1, base_path=base)
+    reloaded.load_from_filesystem()
+    assert reloaded.read_chunk("/etc/motd", 0, padded=False) == b"hello\n"
+
+
+if __name__ == "__main__":
+    test_ordered_per_key_and_done_only_after_flush()
+    test_deferred_manifest_is_saved_by_flush()
+    print("tests passed")
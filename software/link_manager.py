@@ -0,0 +1,285 @@
+"""
+Async Wi-Fi link manager talking to NetworkManager over D-Bus.
+
+Replaces the nmcli subprocesses and fixed sleeps when bringing up the data
+link: connection profiles are cached (and kept fresh from NetworkManager's
+signals), scans are targeted at the peer's SSID, and the link is reported
+ready as soon as the active connection is up and has an IPv4 address.
+"""
+import asyncio
+import logging
+from typing import Dict, Optional
+
+from dbus_next import BusType, Variant
+from dbus_next.aio import MessageBus
+from dbus_next.errors import DBusError
+
+logger = logging.getLogger(__name__)
+
+NM_BUS_NAME = 'org.freedesktop.NetworkManager'
+NM_PATH = '/org/freedesktop/NetworkManager'
+NM_SETTINGS_PATH = '/org/freedesktop/NetworkManager/Settings'
+NM_IFACE = 'org.freedesktop.NetworkManager'
+NM_DEVICE_IFACE = 'org.freedesktop.NetworkManager.Device'
+NM_WIRELESS_IFACE = 'org.freedesktop.NetworkManager.Device.Wireless'
+NM_AP_IFACE = 'org.freedesktop.NetworkManager.AccessPoint'
+NM_SETTINGS_IFACE = 'org.freedesktop.NetworkManager.Settings'
+NM_CONNECTION_IFACE = 'org.freedesktop.NetworkManager.Settings.Connection'
+NM_ACTIVE_IFACE = 'org.freedesktop.NetworkManager.Connection.Active'
+NM_IP4_IFACE = 'org.freedesktop.NetworkManager.IP4Config'
+
+SYSTEMD_BUS_NAME = 'org.freedesktop.systemd1'
+SYSTEMD_PATH = '/org/freedesktop/systemd1'
+SYSTEMD_MANAGER_IFACE = 'org.freedesktop.systemd1.Manager'
+
+NM_DEVICE_TYPE_WIFI = 2
+NM_ACTIVE_CONNECTION_STATE_ACTIVATED = 2
+NM_ACTIVE_CONNECTION_STATE_DEACTIVATED = 4
+
+
+class LinkManager:
+    """
+    Brings the Wi-Fi interface up as an access point or as a client of a
+    peer's access point.
+
+    Call connect() once; it looks up the device and loads the connection
+    profiles, so every later mode switch is only the D-Bus calls it needs.
+    """
+    def __init__(self, interface: str = 'wlan0', bus_address: Optional[str] = None,
+                 dhcp_unit: Optional[str] = 'dnsmasq.service', timeout: float = 30.0):
+        """
+        Args:
+            interface (str): Wi-Fi interface to manage
+            bus_address (str, optional): D-Bus address to use instead of the system bus
+            dhcp_unit (str, optional): systemd unit serving DHCP in AP mode, if any
+            timeout (float): Seconds to wait for a scan or for the link to come up
+        """
+        self.interface = interface
+        self.bus_address = bus_address
+        self.dhcp_unit = dhcp_unit
+        self.timeout = timeout
+
+        self.bus: Optional[MessageBus] = None
+        self.device_path: Optional[str] = None
+        # Profile caches: connection id -> settings path, SSID -> settings path
+        self.profiles_by_id: Dict[str, str] = {}
+        self.profiles_by_ssid: Dict[str, str] = {}
+        self.address: Optional[str] = None
+
+        # Introspection data per object kind, so each new object costs no extra round trip
+        self._introspection = {}
+        self._nm = None
+        self._wireless = None
+        self._ap_added: Optional[asyncio.Queue] = None
+
+    async def _interface(self, bus_name: str, path: str, interface: str, kind: Optional[str] = None):
+        kind = kind or interface
+        if kind not in self._introspection:
+            self._introspection[kind] = await self.bus.introspect(bus_name, path)
+        return self.bus.get_proxy_object(bus_name, path, self._introspection[kind]).get_interface(interface)
+
+    async def connect(self):
+        """Connect to the bus, find the Wi-Fi device and cache the connection profiles."""
+        if self.bus_address:
+            self.bus = await MessageBus(bus_address=self.bus_address).connect()
+        else:
+            self.bus = await MessageBus(bus_type=BusType.SYSTEM).connect()
+
+        self._nm = await self._interface(NM_BUS_NAME, NM_PATH, NM_IFACE)
+        for path in await self._nm.call_get_devices():
+            device = await self._interface(NM_BUS_NAME, path, NM_DEVICE_IFACE, kind='device')
+            if await device.get_device_type() == NM_DEVICE_TYPE_WIFI and await device.get_interface() == self.interface:
+                self.device_path = path
+                break
+        if self.device_path is None:
+            raise RuntimeError(f"No Wi-Fi device {self.interface} known to NetworkManager")
+
+        self._wireless = await self._interface(NM_BUS_NAME, self.device_path, NM_WIRELESS_IFACE, kind='device')
+        self._ap_added = asyncio.Queue()
+        self._wireless.on_access_point_added(self._ap_added.put_nowait)
+
+        settings = await self._interface(NM_BUS_NAME, NM_SETTINGS_PATH, NM_SETTINGS_IFACE)
+        settings.on_new_connection(lambda path: asyncio.ensure_future(self._cache_profile(path)))
+        settings.on_connection_removed(self._forget_profile)
+        for path in await settings.call_list_connections():
+            await self._cache_profile(path)
+        logger.info(f"[link_manager] Using {self.interface} ({self.device_path}), "
+                    f"{len(self.profiles_by_id)} connection profiles cached")
+
+    async def _cache_profile(self, path: str):
+        connection = await self._interface(NM_BUS_NAME, path, NM_CONNECTION_IFACE, kind='connection')
+        settings = await connection.call_get_settings()
+        profile_id = settings.get('connection', {}).get('id')
+        if profile_id is not None:
+            self.profiles_by_id[profile_id.value] = path
+        ssid = settings.get('802-11-wireless', {}).get('ssid')
+        if ssid is not None:
+            self.profiles_by_ssid[bytes(ssid.value).decode('utf-8', 'replace')] = path
+
+    def _forget_profile(self, path: str):
+        for cache in (self.profiles_by_id, self.profiles_by_ssid):
+            for key in [key for key, value in cache.items() if value == path]:
+                del cache[key]
+
+    async def _find_access_point(self, ssid: str, paths) -> Optional[str]:
+        for path in paths:
+            ap = await self._interface(NM_BUS_NAME, path, NM_AP_IFACE, kind='ap')
+            try:
+                if bytes(await ap.get_ssid()).decode('utf-8', 'replace') == ssid:
+                    return path
+            except DBusError:
+                # The access point vanished while we looked at it
+                continue
+        return None
+
+    async def scan_for(self, ssid: str, timeout: Optional[float] = None) -> Optional[str]:
+        """
+        Wait until an access point with `ssid` is visible, scanning only for that SSID.
+
+        Returns:
+            str: D-Bus path of the access point, or None on timeout
+        """
+        # Drop notifications from before this scan
+        while not self._ap_added.empty():
+            self._ap_added.get_nowait()
+
+        found = await self._find_access_point(ssid, await self._wireless.call_get_all_access_points())
+        if found:
+            return found
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + (timeout or self.timeout)
+        while loop.time() < deadline:
+            try:
+                await self._wireless.call_request_scan({'ssids': Variant('aay', [ssid.encode('utf-8')])})
+            except DBusError as e:
+                # NetworkManager refuses scans while one is running; wait for its results instead
+                logger.debug(f"[link_manager] Scan request refused: {e.text}")
+            try:
+                path = await asyncio.wait_for(self._ap_added.get(), min(2.0, deadline - loop.time()))
+            except asyncio.TimeoutError:
+                continue
+            found = await self._find_access_point(ssid, [path])
+            if found:
+                return found
+        logger.warning(f"[link_manager] {ssid} not seen within {timeout or self.timeout}s")
+        return None
+
+    async def wait_ready(self, active_path: str, timeout: Optional[float] = None) -> Optional[str]:
+        """
+        Wait for an activating connection to come up with an IPv4 address.
+
+        Returns:
+            str: The interface's IPv4 address, or None if activation failed or timed out
+        """
+        active = await self._interface(NM_BUS_NAME, active_path, NM_ACTIVE_IFACE, kind='active')
+        changed = asyncio.Event()
+        def on_state_changed(state, reason):
+            changed.set()
+        active.on_state_changed(on_state_changed)
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + (timeout or self.timeout)
+        try:
+            while loop.time() < deadline:
+                changed.clear()
+                try:
+                    state = await active.get_state()
+                except DBusError:
+                    # The active connection object is gone: activation failed
+                    return None
+                if state == NM_ACTIVE_CONNECTION_STATE_DEACTIVATED:
+                    return None
+                if state == NM_ACTIVE_CONNECTION_STATE_ACTIVATED:
+                    address = await self._ip4_address(await active.get_ip4_config())
+                    if address:
+                        return address
+                try:
+                    # Addresses can land after the state change, so poll those briefly too
+                    await asyncio.wait_for(changed.wait(), 0.1 if state == NM_ACTIVE_CONNECTION_STATE_ACTIVATED
+                                           else deadline - loop.time())
+                except asyncio.TimeoutError:
+                    pass
+            return None
+        finally:
+            active.off_state_changed(on_state_changed)
+
+    async def _ip4_address(self, config_path: str) -> Optional[str]:
+        if not config_path or config_path == '/':
+            return None
+        config = await self._interface(NM_BUS_NAME, config_path, NM_IP4_IFACE, kind='ip4')
+        for entry in await config.get_address_data():
+            if 'address' in entry:
+                return entry['address'].value
+        return None
+
+    async def _set_unit(self, running: bool):
+        """Start or stop the DHCP server unit through systemd."""
+        if not self.dhcp_unit:
+            return
+        manager = await self._interface(SYSTEMD_BUS_NAME, SYSTEMD_PATH, SYSTEMD_MANAGER_IFACE)
+        try:
+            if running:
+                await manager.call_restart_unit(self.dhcp_unit, 'replace')
+            else:
+                await manager.call_stop_unit(self.dhcp_unit, 'replace')
+        except DBusError as e:
+            logger.warning(f"[link_manager] Could not {'start' if running else 'stop'} {self.dhcp_unit}: {e.text}")
+
+    async def start_ap(self, profile_id: str = 'AP_Mode') -> Optional[str]:
+        """
+        Bring up our access point from its saved profile.
+
+        Returns:
+            str: Our IPv4 address once the AP is up, or None on failure
+        """
+        profile = self.profiles_by_id.get(profile_id)
+        if profile is None:
+            logger.error(f"[link_manager] No connection profile named {profile_id}")
+            return None
+        logger.info(f"[link_manager] Starting access point {profile_id}")
+        active_path = await self._nm.call_activate_connection(profile, self.device_path, '/')
+        self.address = await self.wait_ready(active_path)
+        if self.address:
+            await self._set_unit(True)
+        return self.address
+
+    async def join(self, ssid: str, password: str) -> Optional[str]:
+        """
+        Connect to a peer's access point, reusing a saved profile for it if we have one.
+
+        Returns:
+            str: Our IPv4 address once connected, or None on failure
+        """
+        await self._set_unit(False)
+        ap_path = await self.scan_for(ssid)
+        if ap_path is None:
+            return None
+
+        logger.info(f"[link_manager] Joining {ssid}")
+        try:
+            profile = self.profiles_by_ssid.get(ssid)
+            if profile:
+                active_path = await self._nm.call_activate_connection(profile, self.device_path, ap_path)
+            else:
+                settings = {
+                    'connection': {'id': Variant('s', ssid), 'type': Variant('s', '802-11-wireless')},
+                    '802-11-wireless': {'ssid': Variant('ay', ssid.encode('utf-8')), 'mode': Variant('s', 'infrastructure')},
+                    '802-11-wireless-security': {'key-mgmt': Variant('s', 'wpa-psk'), 'psk': Variant('s', password)},
+                }
+                profile, active_path = await self._nm.call_add_and_activate_connection(settings, self.device_path, ap_path)
+                # Cache it now rather than waiting for the NewConnection signal
+                self.profiles_by_ssid[ssid] = profile
+        except DBusError as e:
+            logger.error(f"[link_manager] Failed to activate connection to {ssid}: {e.text}")
+            return None
+
+        self.address = await self.wait_ready(active_path)
+        if self.address:
+            logger.info(f"[link_manager] Connected to {ssid} as {self.address}")
+        return self.address
+
+    def close(self):
+        if self.bus:
+            self.bus.disconnect()
+            self.bus = None
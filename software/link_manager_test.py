@@ -0,0 +1,237 @@
+import asyncio
+import subprocess
+
+from dbus_next import Variant
+from dbus_next.aio import MessageBus
+from dbus_next.constants import PropertyAccess
+from dbus_next.service import ServiceInterface, dbus_property, method, signal
+
+from link_manager import (NM_ACTIVE_CONNECTION_STATE_ACTIVATED, NM_BUS_NAME, NM_PATH, NM_SETTINGS_PATH,
+                          LinkManager)
+
+# A stand-in for the slice of NetworkManager's D-Bus API the link manager uses,
+# served on a private bus
+
+
+class FakeNM(ServiceInterface):
+    def __init__(self, stand_in):
+        super().__init__('org.freedesktop.NetworkManager')
+        self.stand_in = stand_in
+
+    @method()
+    def GetDevices(self) -> 'ao':
+        return ['/org/freedesktop/NetworkManager/Devices/1']
+
+    @method()
+    def ActivateConnection(self, connection: 'o', device: 'o', specific_object: 'o') -> 'o':
+        self.stand_in.activations.append(connection)
+        return self.stand_in.activate()
+
+    @method()
+    def AddAndActivateConnection(self, connection: 'a{sa{sv}}', device: 'o', specific_object: 'o') -> 'oo':
+        path = self.stand_in.add_profile(connection)
+        self.stand_in.activations.append(path)
+        return [path, self.stand_in.activate()]
+
+
+class FakeDevice(ServiceInterface):
+    def __init__(self):
+        super().__init__('org.freedesktop.NetworkManager.Device')
+
+    @dbus_property(access=PropertyAccess.READ)
+    def DeviceType(self) -> 'u':
+        return 2
+
+    @dbus_property(access=PropertyAccess.READ)
+    def Interface(self) -> 's':
+        return 'wlan0'
+
+
+class FakeWireless(ServiceInterface):
+    def __init__(self, stand_in):
+        super().__init__('org.freedesktop.NetworkManager.Device.Wireless')
+        self.stand_in = stand_in
+        self.access_points = []
+
+    @method()
+    def GetAllAccessPoints(self) -> 'ao':
+        return self.access_points
+
+    @method()
+    def RequestScan(self, options: 'a{sv}'):
+        self.stand_in.scans.append([bytes(ssid) for ssid in options['ssids'].value])
+        asyncio.get_running_loop().call_later(0.05, self.stand_in.reveal_peer)
+
+    @signal()
+    def AccessPointAdded(self, path) -> 'o':
+        return path
+
+
+class FakeAccessPoint(ServiceInterface):
+    def __init__(self, ssid):
+        super().__init__('org.freedesktop.NetworkManager.AccessPoint')
+        self.ssid = ssid
+
+    @dbus_property(access=PropertyAccess.READ)
+    def Ssid(self) -> 'ay':
+        return self.ssid
+
+
+class FakeSettings(ServiceInterface):
+    def __init__(self, stand_in):
+        super().__init__('org.freedesktop.NetworkManager.Settings')
+        self.stand_in = stand_in
+
+    @method()
+    def ListConnections(self) -> 'ao':
+        return list(self.stand_in.profiles)
+
+    @signal()
+    def NewConnection(self, path) -> 'o':
+        return path
+
+    @signal()
+    def ConnectionRemoved(self, path) -> 'o':
+        return path
+
+
+class FakeConnection(ServiceInterface):
+    def __init__(self, settings):
+        super().__init__('org.freedesktop.NetworkManager.Settings.Connection')
+        self.settings = settings
+
+    @method()
+    def GetSettings(self) -> 'a{sa{sv}}':
+        return self.settings
+
+
+class FakeActive(ServiceInterface):
+    def __init__(self):
+        super().__init__('org.freedesktop.NetworkManager.Connection.Active')
+        self.state = 1
+        self.ip4_config = '/'
+
+    @dbus_property(access=PropertyAccess.READ)
+    def State(self) -> 'u':
+        return self.state
+
+    @dbus_property(access=PropertyAccess.READ)
+    def Ip4Config(self) -> 'o':
+        return self.ip4_config
+
+    @signal()
+    def StateChanged(self) -> 'uu':
+        return [self.state, 0]
+
+
+class FakeIP4Config(ServiceInterface):
+    def __init__(self, address):
+        super().__init__('org.freedesktop.NetworkManager.IP4Config')
+        self.address = address
+
+    @dbus_property(access=PropertyAccess.READ)
+    def AddressData(self) -> 'aa{sv}':
+        return [{'address': Variant('s', self.address), 'prefix': Variant('u', 24)}]
+
+
+class StandInNetworkManager:
+    def __init__(self, bus, peer_ssid):
+        self.bus = bus
+        self.peer_ssid = peer_ssid
+        self.profiles = {}
+        self.activations = []
+        self.scans = []
+        self._next_id = 0
+
+        bus.export(NM_PATH, FakeNM(self))
+        bus.export('/org/freedesktop/NetworkManager/Devices/1', FakeDevice())
+        self.wireless = FakeWireless(self)
+        bus.export('/org/freedesktop/NetworkManager/Devices/1', self.wireless)
+        self.settings = FakeSettings(self)
+        bus.export(NM_SETTINGS_PATH, self.settings)
+        self.add_profile({'connection': {'id': Variant('s', 'AP_Mode'), 'type': Variant('s', '802-11-wireless')},
+                          '802-11-wireless': {'ssid': Variant('ay', b'rpi0'), 'mode': Variant('s', 'ap')}})
+
+    def _path(self, kind):
+        self._next_id += 1
+        return f'/org/freedesktop/NetworkManager/{kind}/{self._next_id}'
+
+    def add_profile(self, settings):
+        path = self._path('Settings')
+        self.profiles[path] = settings
+        self.bus.export(path, FakeConnection(settings))
+        self.settings.NewConnection(path)
+        return path
+
+    def reveal_peer(self):
+        if self.wireless.access_points:
+            return
+        path = self._path('AccessPoint')
+        self.bus.export(path, FakeAccessPoint(self.peer_ssid.encode()))
+        self.wireless.access_points.append(path)
+        self.wireless.AccessPointAdded(path)
+
+    def activate(self):
+        path = self._path('ActiveConnection')
+        active = FakeActive()
+        self.bus.export(path, active)
+
+        def up():
+            config_path = self._path('IP4Config')
+            self.bus.export(config_path, FakeIP4Config('192.168.4.2'))
+            active.state = NM_ACTIVE_CONNECTION_STATE_ACTIVATED
+            active.ip4_config = config_path
+            active.StateChanged()
+        asyncio.get_running_loop().call_later(0.05, up)
+        return path
+
+
+async def with_stand_in(test):
+    daemon = subprocess.Popen(['dbus-daemon', '--session', '--nofork', '--print-address=1'],
+                              stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    try:
+        address = daemon.stdout.readline().strip()
+        service_bus = await MessageBus(bus_address=address).connect()
+        stand_in = StandInNetworkManager(service_bus, 'rpi1')
+        await service_bus.request_name(NM_BUS_NAME)
+
+        links = LinkManager(bus_address=address, dhcp_unit=None, timeout=5)
+        await links.connect()
+        try:
+            await test(links, stand_in)
+        finally:
+            links.close()
+            service_bus.disconnect()
+    finally:
+        daemon.terminate()
+        daemon.wait()
+
+
+def test_start_ap():
+    async def test(links, stand_in):
+        assert 'AP_Mode' in links.profiles_by_id
+        assert await links.start_ap('AP_Mode') == '192.168.4.2'
+        assert stand_in.activations == [links.profiles_by_id['AP_Mode']]
+        assert await links.start_ap('Missing') is None
+    asyncio.run(with_stand_in(test))
+
+
+def test_join_scans_for_peer_and_caches_profile():
+    async def test(links, stand_in):
+        assert await links.join('rpi1', 'password') == '192.168.4.2'
+        # Only the peer's SSID was scanned for
+        assert stand_in.scans == [[b'rpi1']]
+        profile = links.profiles_by_ssid['rpi1']
+
+        # Second time round the saved profile and the known access point are reused
+        assert await links.join('rpi1', 'password') == '192.168.4.2'
+        assert stand_in.scans == [[b'rpi1']]
+        assert stand_in.activations == [profile, profile]
+        assert len(stand_in.profiles) == 2
+    asyncio.run(with_stand_in(test))
+
+
+if __name__ == "__main__":
+    test_start_ap()
+    test_join_scans_for_peer_and_caches_profile()
+    print("tests passed")
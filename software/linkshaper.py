@@ -0,0 +1,306 @@
+"""
+Link-shaping TCP proxy for testing the transport on degraded links.
+
+Sits between a transfer client and server on loopback and forwards bytes in
+both directions, adding a bandwidth cap, one-way latency and jitter,
+loss-induced stalls, scheduled link stalls and mid-transfer disconnects.
+
+The proxy works on a TCP stream, so packet loss can't drop bytes: as on a
+real link, a lost segment shows up as a head-of-line stall of one
+retransmission timeout, and everything behind it waits.
+
+Usage:
+    python linkshaper.py --scenario wifi-poor --listen-port 65433 --target-port 65432
+    python linkshaper.py --list
+"""
+import argparse
+import logging
+import queue
+import random
+import socket
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+SEGMENT_SIZE = 16 * 1024
+
+
+@dataclass
+class LinkProfile:
+    """
+    How to degrade a link. Times are in seconds; stall and disconnect times
+    are measured from the first connection through the proxy.
+
+    Attributes:
+        bandwidth (float, optional): Cap in bytes/s, per direction
+        latency (float): One-way delay added to every segment
+        jitter (float): Extra uniform random delay of up to this much per segment
+        loss (float): Probability that a segment is "lost" and delayed by retransmit_timeout
+        retransmit_timeout (float): Stall caused by a lost segment
+        stalls (list): (start, duration) windows during which nothing is delivered
+        disconnect_at (float, optional): Drop all connections at this time
+        disconnect_after_bytes (int, optional): Drop all connections once this many bytes were forwarded
+        down_for (float): After a disconnect, refuse new connections for this long
+    """
+    bandwidth: Optional[float] = None
+    latency: float = 0.0
+    jitter: float = 0.0
+    loss: float = 0.0
+    retransmit_timeout: float = 0.2
+    stalls: List[Tuple[float, float]] = field(default_factory=list)
+    disconnect_at: Optional[float] = None
+    disconnect_after_bytes: Optional[int] = None
+    down_for: float = 0.0
+
+
+# Scripted scenarios, roughly modelled on links seen between Pis
+SCENARIOS: Dict[str, LinkProfile] = {
+    "clean": LinkProfile(),
+    "wifi-good": LinkProfile(bandwidth=20e6, latency=0.002, jitter=0.002),
+    "wifi-poor": LinkProfile(bandwidth=2e6, latency=0.020, jitter=0.015, loss=0.01),
+    "congested": LinkProfile(bandwidth=500e3, latency=0.080, jitter=0.040, loss=0.03),
+    "stalling": LinkProfile(bandwidth=5e6, latency=0.010, jitter=0.005, stalls=[(0.5, 1.0), (2.5, 2.0)]),
+    "drop-mid": LinkProfile(bandwidth=5e6, latency=0.010, disconnect_after_bytes=4 * 1024 * 1024, down_for=1.0),
+    "drop-early": LinkProfile(bandwidth=5e6, latency=0.010, disconnect_at=0.5, down_for=1.0),
+}
+
+
+class _TokenBucket:
+    """Shared rate limit for one direction of the link."""
+    def __init__(self, rate: Optional[float]):
+        self.rate = rate
+        self.tokens = 0.0
+        self.burst = max(SEGMENT_SIZE, rate / 20) if rate else 0
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, n: int):
+        if not self.rate:
+            return
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= n
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+
+class LinkShaper:
+    """
+    Proxy from listen_host:listen_port to target_host:target_port through a
+    shaped link. Use as a context manager, or call start() and stop().
+    """
+    def __init__(self, listen_port: int, target_port: int, profile: LinkProfile = None,
+                 listen_host: str = "127.0.0.1", target_host: str = "127.0.0.1", seed: int = 0):
+        self.listen = (listen_host, listen_port)
+        self.target = (target_host, target_port)
+        self.profile = profile or LinkProfile()
+        self.rng = random.Random(seed)
+        self.buckets = {"up": _TokenBucket(self.profile.bandwidth), "down": _TokenBucket(self.profile.bandwidth)}
+
+        self._listener: Optional[socket.socket] = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._connections: List[Tuple[socket.socket, socket.socket]] = []
+        self._started_at: Optional[float] = None
+        self._down_until = 0.0
+        self._disconnected = False
+
+        # Counters
+        self.bytes_forwarded = {"up": 0, "down": 0}
+        self.connections = 0
+        self.refused = 0
+        self.lost_segments = 0
+        self.disconnects = 0
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def start(self):
+        self._listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._listener.bind(self.listen)
+        self._listener.listen(8)
+        self._listener.settimeout(0.2)
+        threading.Thread(target=self._accept_loop, daemon=True).start()
+        logger.info(f"[linkshaper] {self.listen[0]}:{self.listen[1]} -> {self.target[0]}:{self.target[1]} {self.profile}")
+
+    def stop(self):
+        self._stop.set()
+        if self._listener:
+            self._listener.close()
+            self._listener = None
+        self._drop_all()
+
+    def stats(self) -> Dict:
+        return {
+            "bytes_up": self.bytes_forwarded["up"],
+            "bytes_down": self.bytes_forwarded["down"],
+            "connections": self.connections,
+            "refused": self.refused,
+            "lost_segments": self.lost_segments,
+            "disconnects": self.disconnects,
+        }
+
+    def _elapsed(self) -> float:
+        return time.monotonic() - self._started_at if self._started_at is not None else 0.0
+
+    def _accept_loop(self):
+        while not self._stop.is_set():
+            try:
+                downstream, _ = self._listener.accept()
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            if time.monotonic() < self._down_until:
+                self.refused += 1
+                downstream.close()
+                continue
+            try:
+                upstream = socket.create_connection(self.target)
+            except OSError as e:
+                logger.warning(f"[linkshaper] Could not reach target: {e}")
+                downstream.close()
+                continue
+            for sock in (downstream, upstream):
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            with self._lock:
+                if self._started_at is None:
+                    self._started_at = time.monotonic()
+                    if self.profile.disconnect_at is not None:
+                        threading.Thread(target=self._disconnect_later, daemon=True).start()
+                self._connections.append((downstream, upstream))
+                self.connections += 1
+            self._pipe(downstream, upstream, "up")
+            self._pipe(upstream, downstream, "down")
+
+    def _pipe(self, src: socket.socket, dst: socket.socket, direction: str):
+        """Forward src -> dst; one thread reads and timestamps, one delivers in order."""
+        segments: "queue.Queue[Optional[Tuple[float, bytes]]]" = queue.Queue()
+
+        def read():
+            last_due = 0.0
+            while True:
+                try:
+                    data = src.recv(SEGMENT_SIZE)
+                except OSError:
+                    data = b""
+                if not data:
+                    segments.put(None)
+                    return
+                delay = self.profile.latency + self.rng.uniform(0, self.profile.jitter)
+                if self.profile.loss and self.rng.random() < self.profile.loss:
+                    self.lost_segments += 1
+                    delay += self.profile.retransmit_timeout
+                # A stream can't reorder, so a late segment holds back the ones after it
+                last_due = max(last_due, time.monotonic() + delay)
+                segments.put((last_due, data))
+
+        def deliver():
+            while True:
+                item = segments.get()
+                if item is None:
+                    break
+                due, data = item
+                self._wait_until(due)
+                self._wait_out_stalls()
+                self.buckets[direction].consume(len(data))
+                try:
+                    dst.sendall(data)
+                except OSError:
+                    break
+                self._count(direction, len(data))
+            try:
+                dst.shutdown(socket.SHUT_WR)
+            except OSError:
+                pass
+
+        threading.Thread(target=read, daemon=True).start()
+        threading.Thread(target=deliver, daemon=True).start()
+
+    @staticmethod
+    def _wait_until(due: float):
+        wait = due - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+
+    def _wait_out_stalls(self):
+        for start, duration in self.profile.stalls:
+            elapsed = self._elapsed()
+            if start <= elapsed < start + duration:
+                time.sleep(start + duration - elapsed)
+
+    def _count(self, direction: str, n: int):
+        with self._lock:
+            self.bytes_forwarded[direction] += n
+            total = self.bytes_forwarded["up"] + self.bytes_forwarded["down"]
+        limit = self.profile.disconnect_after_bytes
+        if limit is not None and total >= limit:
+            self._disconnect()
+
+    def _disconnect_later(self):
+        self._wait_until(self._started_at + self.profile.disconnect_at)
+        self._disconnect()
+
+    def _disconnect(self):
+        """Drop every connection once, as if the link went away."""
+        with self._lock:
+            if self._disconnected:
+                return
+            self._disconnected = True
+            self.disconnects += 1
+            self._down_until = time.monotonic() + self.profile.down_for
+        logger.info(f"[linkshaper] Dropping link after {self._elapsed():.2f}s")
+        self._drop_all()
+
+    def _drop_all(self):
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for pair in connections:
+            for sock in pair:
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+                sock.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenario", choices=sorted(SCENARIOS), default="clean")
+    parser.add_argument("--listen-host", default="127.0.0.1")
+    parser.add_argument("--listen-port", type=int, default=65433)
+    parser.add_argument("--target-host", default="127.0.0.1")
+    parser.add_argument("--target-port", type=int, default=65432)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--list", action="store_true", help="print the scenarios and exit")
+    args = parser.parse_args()
+
+    if args.list:
+        for name, profile in SCENARIOS.items():
+            print(f"{name:<12} {profile}")
+        return
+
+    logging.basicConfig(level=logging.INFO)
+    with LinkShaper(args.listen_port, args.target_port, SCENARIOS[args.scenario],
+                    args.listen_host, args.target_host, args.seed) as shaper:
+        try:
+            while True:
+                time.sleep(5)
+                print(shaper.stats())
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == "__main__":
+    main()
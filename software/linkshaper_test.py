@@ -0,0 +1,86 @@
+import socket
+import threading
+import time
+
+from linkshaper import LinkProfile, LinkShaper
+
+
+def echo_server():
+    listener = socket.create_server(("127.0.0.1", 0))
+
+    def serve():
+        while True:
+            try:
+                conn, _ = listener.accept()
+            except OSError:
+                return
+            def echo(conn=conn):
+                with conn:
+                    try:
+                        while data := conn.recv(65536):
+                            conn.sendall(data)
+                    except OSError:
+                        pass
+            threading.Thread(target=echo, daemon=True).start()
+
+    threading.Thread(target=serve, daemon=True).start()
+    return listener
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def round_trip(port, payload):
+    with socket.create_connection(("127.0.0.1", port)) as sock:
+        started = time.monotonic()
+        try:
+            sock.sendall(payload)
+        except OSError:
+            pass
+        received = b""
+        while len(received) < len(payload):
+            try:
+                data = sock.recv(65536)
+            except ConnectionResetError:
+                break
+            if not data:
+                break
+            received += data
+        return received, time.monotonic() - started
+
+
+def test_latency_and_bandwidth():
+    server = echo_server()
+    profile = LinkProfile(bandwidth=1e6, latency=0.05)
+    with LinkShaper(free_port(), server.getsockname()[1], profile) as shaper:
+        received, elapsed = round_trip(shaper.listen[1], b"x" * 200_000)
+    server.close()
+
+    assert received == b"x" * 200_000
+    # 0.2 MB at 1 MB/s (the two directions overlap), plus latency both ways
+    assert elapsed >= 0.25
+    assert shaper.stats()["bytes_up"] == shaper.stats()["bytes_down"] == 200_000
+
+
+def test_disconnect_after_bytes():
+    server = echo_server()
+    profile = LinkProfile(disconnect_after_bytes=100_000, down_for=0.5)
+    with LinkShaper(free_port(), server.getsockname()[1], profile) as shaper:
+        received, _ = round_trip(shaper.listen[1], b"x" * 1_000_000)
+        # The link stays down for a while
+        reconnected, _ = round_trip(shaper.listen[1], b"y")
+    server.close()
+
+    assert len(received) < 1_000_000
+    assert reconnected == b""
+    assert shaper.stats()["disconnects"] == 1
+    assert shaper.stats()["refused"] == 1
+
+
+if __name__ == "__main__":
+    test_latency_and_bandwidth()
+    test_disconnect_after_bytes()
+    print("tests passed")
@@ -1,126 +1,378 @@
+if __name__ == "__main__":
+    # The Wi-Fi transfer runs on eventlet green threads alongside asyncio, so
+    # the standard library is patched before anything else is imported:
+    # socketio's client keeps the threading primitives it sees at import time.
+    # This can't wait for the first Wi-Fi round: the asyncio loop's selector
+    # would already be the native one, so the hub would never get to run the
+    # green threads created after the patch (asyncio.to_thread workers, the
+    # transfer). Only the entry point does this; importing this module doesn't.
+    import eventlet
+    eventlet.monkey_patch()
+
 import asyncio
-from advertiser import ble_server
-from config import FILE_DIR
-from file_server import FileTransferServer
-from scanner import BLEServiceScanner
+from config import *
+from discovery import DutyCycle
+from metrics import configure_metrics, get_metrics
+from peers import GossipCache, PeerManifests
+from retention import GarbageCollector, RetentionPolicy
 from enum import IntEnum
-from sync import Package
-from wifi import connect_to_wifi
-import os
-import subprocess
-import random
+from sync import ChunkVersion, Package, chunks_to_offer
+import logging
+import threading
 import socket  # To get the hostname
 import time
+from typing import TYPE_CHECKING, List, Optional
+
+# The BLE stacks (bluez_peripheral, bleak), the transfer server (socketio)
+# and the link manager (dbus_next) are imported when first used, not at
+# startup; the BLE fast path and multicast only if BLE_FAST_PATH and
+# MULTICAST_ENABLED are on. eventlet itself is loaded at startup by the patch
+# above, and discovery runs the advertiser and the scanner together, so both
+# BLE stacks load in the first round.
+if TYPE_CHECKING:
+    from advertiser import BLEAdvertiser
+    from ble_transfer import TransferCosts
+    from file_server import FileTransferServer
+    from link_manager import LinkManager
+    from scanner import BLEServiceScanner
+
+logger = logging.getLogger(__name__)
 
 class State(IntEnum):
     STARTUP = 0
-    BT_ADVERT = 1
-    BT_SCAN = 2
+    BT_DISCOVERY = 1
     BT_COMPLETE = 3
     WIFI_AP = 4
     WIFI_CLIENT = 5
     WIFI_COMPLETE = 6
 
 
-async def main():
-    while True:
+class Node:
+    """
+    Long-lived node runtime.
+
+    The package (with its loaded chunks and manifest), the BLE service
+    registration, the scanner and the transfer server are built once and kept
+    warm across sync rounds. Only per-round state is reset between rounds.
+    The BLE services and the transfer server are built (and their modules
+    imported) the first time a round needs them rather than at startup.
+    """
+    def __init__(self, package_name: str = "my-package", base_path: str = FILE_DIR):
         # Initialize state of package and chunks
-        pkg = Package("my-package", 1, FILE_DIR)
-        pkg.load_from_filesystem()
-        
-        manifest_path = FILE_DIR + '/manifest.json'
-        if not os.path.exists(manifest_path):
-            with open(manifest_path, 'w') as manifest_file:
-                manifest_file.write('{"name":"my-package","version":1,"files":{}}')
-
-        our_manifest = pkg.load_manifest(manifest_path)
-
-        packages = {
-            "SamplePackage": pkg
+        self.pkg = Package(package_name, 1, base_path, use_index=USE_CHUNK_INDEX,
+                           cache_bytes=BLOCK_CACHE_BYTES, pack_small_files=PACK_SMALL_FILES,
+                           use_segments=USE_SEGMENT_STORE)
+        self.pkg.load_from_filesystem()
+
+        if not self.pkg.manifest_path.exists():
+            self.pkg.save_manifest()
+
+        self.packages = {
+            "SamplePackage": self.pkg
         }
 
+        # Shared between rounds so the duty cycle and latency history carry over
+        self.duty = DutyCycle()
+
+        # Old block versions are collected in the background between transfers
+        self.gc = GarbageCollector(self.pkg, RetentionPolicy(
+            keep_latest=RETENTION_KEEP_LATEST,
+            keep_peer_versions=RETENTION_KEEP_PEER,
+            disk_quota=RETENTION_DISK_QUOTA,
+        ))
+
+        # BLE + Wi-Fi services
+        self.hostname = socket.gethostname()
+        # Last manifest seen from each peer, so repeat encounters only exchange deltas
+        self.peer_manifests = PeerManifests()
+        # What we've heard of other nodes' manifests, first or second hand, to pick who to sync with
+        self.gossip = GossipCache(GOSSIP_MAX_PEERS, GOSSIP_MAX_AGE, GOSSIP_SUMMARY_FILES)
+        self._advertiser: Optional['BLEAdvertiser'] = None
+        self._scanner: Optional['BLEServiceScanner'] = None
+        self._transfer: Optional['FileTransferServer'] = None
+        self._links: Optional['LinkManager'] = None
+        self.costs: Optional['TransferCosts'] = None
+        if BLE_FAST_PATH:
+            from ble_transfer import TransferCosts
+            self.costs = TransferCosts()
+
+        self.metrics = get_metrics()
+        self.state = State.STARTUP
+        self.state_since = time.perf_counter()
+        self.reset_round()
+
+    @property
+    def advertiser(self) -> 'BLEAdvertiser':
+        if self._advertiser is None:
+            from advertiser import BLEAdvertiser
+            self._advertiser = BLEAdvertiser(self.hostname, self.packages, on_manifest=self.on_manifest_received,
+                                             peers=self.peer_manifests, gossip=self.gossip)
+        return self._advertiser
+
+    @property
+    def scanner(self) -> 'BLEServiceScanner':
+        if self._scanner is None:
+            from scanner import BLEServiceScanner
+            self._scanner = BLEServiceScanner(self.hostname, self.pkg.manifest, packages=self.packages,
+                                              on_manifest=self.on_manifest_received, peers=self.peer_manifests,
+                                              gossip=self.gossip)
+        return self._scanner
+
+    @property
+    def links(self) -> 'LinkManager':
+        if self._links is None:
+            from link_manager import LinkManager
+            self._links = LinkManager(WIFI_INTERFACE, dhcp_unit=DHCP_UNIT, timeout=LINK_TIMEOUT)
+        return self._links
+
+    @property
+    def transfer(self) -> 'FileTransferServer':
+        if self._transfer is None:
+            from file_server import FileTransferServer
+            self._transfer = FileTransferServer(self.pkg, callback=self.on_wifi_finished,
+                                                priorities=TRANSFER_PRIORITIES,
+                                                on_file_complete=self.on_file_complete)
+        return self._transfer
+
+    def set_state(self, state: State):
+        """Move the state machine, recording how long we spent in the previous state."""
+        now = time.perf_counter()
+        self.metrics.observe("state_seconds", now - self.state_since, state=self.state.name)
+        logger.debug(f'[main] {self.state.name} -> {state.name} after {(now - self.state_since) * 1000:.1f} ms')
+        self.state = state
+        self.state_since = now
+
+    def reset_round(self):
+        """Clear everything that belongs to a single sync round."""
         # state machine
-        state = State.STARTUP
+        self.set_state(State.STARTUP)
 
         # peer's manifest, in order to compare chunk versions
-        peer_manifest = {}
-        peer_ssid = ""
-        def on_manifest_received(metadata: dict):
-            nonlocal state, peer_manifest, peer_ssid
-            state = State.BT_COMPLETE
-            peer_manifest = metadata["manifest"]
-            peer_ssid = metadata["ssid"]
-            print('[main] Got package manifest + SSID')
-        
-        def on_wifi_finished(success: bool):
-            nonlocal state
-            if success:
-                print('[main] Wifi transferring completed successfully.')
-            else:
-                print('[main] Wifi transfer failed! Going back to BT scan...')
-            state = State.WIFI_COMPLETE
-        
-        # BLE + Wi-Fi services
-        hostname = socket.gethostname()
-        scanner = BLEServiceScanner(hostname, our_manifest, packages=packages, on_manifest=on_manifest_received)
+        self.peer_manifest = {}
+        self.peer_ssid = ""
+        # Set when our scanner (as central) did the exchange, to run a BLE transfer with the peer
+        self.peer_device = None
+        self.peer_pkg = "SamplePackage"
+        self.bt_done = asyncio.Event()
 
-        # arent these classes basically the same?
-        FileTransfer = FileTransferServer(pkg, callback=on_wifi_finished)
+        for service in (self._advertiser, self._scanner, self._transfer):
+            if service is not None:
+                service.reset()
 
-        # Determine if we are scanning or advertising (hardcoded fix)
-        if int(hostname[-1]) > 2:
-            state = State.BT_ADVERT
-        else:
-            state = State.BT_SCAN
-
-        while state == State.BT_ADVERT or state == State.BT_SCAN:
-            # hack: BT mode switching wasn't working
-            if state == State.BT_ADVERT:
-                await ble_server(packages, on_manifest_received)
-            elif state == State.BT_SCAN:
-                await scanner.scan_and_read(our_manifest)
-
-        print('[main] Checking differences between manifests')
-        # is there is no difference between manifests?
-        if not pkg.manifests_differ(our_manifest, peer_manifest):
-            print('[main] Manifests did not differ; starting over')
-            # TODO: temp blacklist this peer
-            continue
-
-        # simplest way to agree on who is AP/who is client
-        print(f'[main] Choosing WiFi mode, my hostname: {hostname}, peer SSID: {peer_ssid}')
-        if hostname < peer_ssid:
-            state = State.WIFI_AP
+    def on_manifest_received(self, metadata: dict):
+        if self.state != State.BT_DISCOVERY:
+            # the advertiser and the scanner can both finish an exchange, and
+            # a peer can still write its manifest while we're on Wi-Fi
+            logger.debug(f'[main] Ignoring manifest from {metadata.get("ssid")} in {self.state.name}')
+            return
+        self.set_state(State.BT_COMPLETE)
+        self.peer_manifest = metadata["manifest"]
+        self.peer_ssid = metadata["ssid"]
+        self.peer_device = metadata.get("device")
+        self.peer_pkg = metadata.get("pkg", self.peer_pkg)
+        self.gc.note_peer_manifest(self.peer_ssid, self.peer_manifest)
+        self.bt_done.set()
+        latency = self.duty.finish_round()
+        if latency is None:
+            logger.info('[main] Got package manifest + SSID')
+            return
+        self.metrics.observe("discovery_latency_seconds", latency)
+        logger.info(f'[main] Got package manifest + SSID after {latency:.1f}s of discovery')
+
+    def on_wifi_finished(self, success: bool):
+        if success:
+            logger.info('[main] Wifi transferring completed successfully.')
         else:
-            state = State.WIFI_CLIENT
-
-        # either start AP/connect to it
-        if state == State.WIFI_AP:
-            print('Choosing WiFi AP mode')
-            result = subprocess.run(["ap_mode.sh"], capture_output=True, text=True)
-        elif state == State.WIFI_CLIENT:
-            print('Choosing WiFi client mode')
-            result = subprocess.run(["client_mode.sh"], capture_output=True, text=True)
-            await asyncio.sleep(5)
-            print('Connecting to AP')
-            connect_to_wifi(peer_ssid, "password")
-
-        # get differing versions of chunks
-        print('Calculating missing chunks')
-        diff = pkg.get_missing_chunks(peer_manifest)
-        if not diff:
-            print('No missing chunks found')
-
-        # we know which chunks we need, now do WiFi transfer
-        while state != State.WIFI_COMPLETE:
-            if state == State.WIFI_AP:
-                print('Starting WiFi transmit - server')
-                FileTransfer.start_server(diff)
-            elif state == State.WIFI_CLIENT:
-                print('Starting WiFi transmit - client')
-                FileTransfer.start_client(diff)
-
-    print("All done! Starting over.")
+            logger.warning('[main] Wifi transfer failed! Going back to BT scan...')
+        self.set_state(State.WIFI_COMPLETE)
+
+    def on_file_complete(self, path: str):
+        """A file has all its blocks: it's usable now, even if the link drops before the rest."""
+        self.metrics.inc("files_completed")
+        if MATERIALIZE_DIR:
+            # Whole-file reads and writes: on a disk thread, under the package lock
+            self.transfer.run_io(self.pkg.materialize, MATERIALIZE_DIR, False, [path])
+
+    async def run_round(self):
+        pkg = self.pkg
+        # Live view of our manifest; updated in place as chunks arrive
+        our_manifest = pkg.manifest
+
+        # Advertise and scan at the same time; whichever role exchanges
+        # manifests with a peer first ends discovery
+        self.set_state(State.BT_DISCOVERY)
+        self.duty.start_round()
+        advertiser = asyncio.create_task(self.advertiser.advertise(duty=self.duty, stop=self.bt_done))
+
+        # Encode outbound frames for hot chunks while we're idle (once a
+        # transfer has loaded the server; the first round doesn't wait for it)
+        stop_prefill = threading.Event()
+        prefill = None
+        if self._transfer is not None:
+            prefill = asyncio.create_task(asyncio.to_thread(self._transfer.prefill_frames, stop_prefill))
+
+        with self.metrics.span("ble_discovery"):
+            while self.state == State.BT_DISCOVERY:
+                await self.scanner.scan_and_read(our_manifest, duty=self.duty, stop=self.bt_done)
+                if self.state == State.BT_DISCOVERY:
+                    try:
+                        await asyncio.wait_for(self.bt_done.wait(), self.duty.next_gap())
+                    except asyncio.TimeoutError:
+                        pass
+
+            self.bt_done.set()
+            stop_prefill.set()
+            await advertiser
+            if prefill:
+                await prefill
+        logger.info(f'[main] Discovery latency: {self.duty.latency_summary()}')
+
+        logger.info('[main] Checking differences between manifests')
+        with self.metrics.span("diff"):
+            # is there is no difference between manifests?
+            if not pkg.manifests_differ(our_manifest.to_dict(), self.peer_manifest):
+                logger.info('[main] Manifests did not differ; starting over')
+                # TODO: temp blacklist this peer
+                return
+
+            # get differing versions of chunks
+            logger.info('[main] Calculating missing chunks')
+            diff = pkg.get_missing_chunks(self.peer_manifest)
+            if not diff:
+                logger.info('[main] No missing chunks found')
+        self.metrics.inc("chunks_missing", len(diff))
+
+        if BLE_FAST_PATH and await self.ble_transfer(diff):
+            return
+        wifi_started = time.perf_counter()
+
+        with self.metrics.span("wifi_setup"):
+            # simplest way to agree on who is AP/who is client
+            peer_ssid = self.peer_ssid
+            logger.info(f'[main] Choosing WiFi mode, my hostname: {self.hostname}, peer SSID: {peer_ssid}')
+            if self.hostname < peer_ssid:
+                self.set_state(State.WIFI_AP)
+            else:
+                self.set_state(State.WIFI_CLIENT)
+
+            # either start AP/connect to it; both return once we have an address
+            if self.state == State.WIFI_AP:
+                logger.info('[main] Choosing WiFi AP mode')
+                with self.metrics.span("link_up", role="ap"):
+                    address = await self.links.start_ap(AP_PROFILE)
+            else:
+                logger.info('[main] Choosing WiFi client mode, connecting to AP')
+                with self.metrics.span("link_up", role="client"):
+                    address = await self.links.join(peer_ssid, WIFI_PASSWORD)
+        if address is None:
+            logger.warning('[main] Could not bring up the Wi-Fi link; starting over')
+            return
+
+        # we know which chunks we need, now do WiFi transfer. The transfer
+        # blocks until the round ends (or its deadlines pass), so it runs off
+        # the event loop to keep BLE and garbage collection going
+        success = False
+        with self.metrics.span("transfer"):
+            if self.state == State.WIFI_AP:
+                logger.info('[main] Starting WiFi transmit - server')
+                stop_broadcast = self.start_broadcast(address) if MULTICAST_ENABLED else None
+                try:
+                    success = await asyncio.to_thread(self.transfer.start_server, diff)
+                finally:
+                    if stop_broadcast:
+                        stop_broadcast.set()
+                    # The link goes down with the round, so stop listening on it
+                    await asyncio.to_thread(self.transfer.stop)
+            elif self.state == State.WIFI_CLIENT:
+                if MULTICAST_ENABLED and diff:
+                    with self.metrics.span("multicast_receive"):
+                        received = await asyncio.to_thread(self.receive_broadcast, diff, address)
+                    self.metrics.inc("chunks_multicast", len(received))
+                    diff = pkg.get_missing_chunks(self.peer_manifest)
+                logger.info('[main] Starting WiFi transmit - client')
+                success = await asyncio.to_thread(self.transfer.start_client, diff)
+        logger.info(f'[main] Wi-Fi path took {time.perf_counter() - wifi_started:.1f}s '
+                    f'({"done" if success else "failed"})')
+
+    async def ble_transfer(self, diff: List[ChunkVersion]) -> bool:
+        """
+        Move the diff (both ways) over BLE if the cost model says that beats
+        bringing Wi-Fi up. Both peers estimate from the same two manifests,
+        so they make the same call.
+
+        Returns:
+            bool: True if the round's transfer was done over BLE
+        """
+        from ble_transfer import estimate_bytes
+        offer = chunks_to_offer(self.pkg, self.peer_manifest)
+        size = estimate_bytes(diff) + estimate_bytes(offer)
+        choice = self.costs.choose(size)
+        logger.info(f'[main] Diff of ~{size} bytes: BLE {self.costs.ble_seconds(size):.1f}s vs '
+                    f'Wi-Fi {self.costs.wifi_seconds(size):.1f}s (threshold {self.costs.threshold_bytes()} bytes) '
+                    f'-> {choice}')
+        if choice != 'ble':
+            return False
+
+        started = time.perf_counter()
+        try:
+            with self.metrics.span("ble_transfer"):
+                if self.peer_device:
+                    success = await self.scanner.transfer_chunks(self.peer_device, self.peer_pkg, diff, offer)
+                else:
+                    # The peer connected to us, so it runs the transfer
+                    success = await self.advertiser.wait_for_ble_transfer(BLE_TRANSFER_TIMEOUT)
+                    success = success and not self.pkg.get_missing_chunks(self.peer_manifest)
+        except Exception as e:
+            logger.error(f'[main] BLE transfer failed: {e}')
+            success = False
+        logger.info(f'[main] BLE path took {time.perf_counter() - started:.1f}s '
+                    f'({"done" if success else "incomplete, falling back to Wi-Fi"})')
+        self.metrics.inc("ble_transfers", result='success' if success else 'failure')
+        return success
+
+    def start_broadcast(self, address: str) -> threading.Event:
+        """Stream what the peer lacks to the multicast group until the returned event is set."""
+        from multicast import MulticastSender
+        offer = chunks_to_offer(self.pkg, self.peer_manifest)
+        stop = threading.Event()
+
+        def stream():
+            sender = MulticastSender(MULTICAST_GROUP, MULTICAST_PORT, interface=address, rate=MULTICAST_RATE)
+            try:
+                sender.send_chunks(self.pkg, offer, passes=None, stop=stop)
+            finally:
+                sender.close()
+        if offer:
+            threading.Thread(target=stream, daemon=True).start()
+        return stop
+
+    def receive_broadcast(self, diff: List[ChunkVersion], address: str) -> List[ChunkVersion]:
+        from multicast import MulticastReceiver
+        receiver = MulticastReceiver(MULTICAST_GROUP, MULTICAST_PORT, interface=address)
+        try:
+            return receiver.receive_chunks(self.pkg, diff, timeout=MULTICAST_WINDOW)
+        finally:
+            receiver.close()
+
+    async def run_forever(self):
+        gc_task = asyncio.create_task(self.gc.run(interval=GC_INTERVAL))
+        await self.links.connect()
+        while True:
+            started = time.perf_counter()
+            self.reset_round()
+            logger.info(f'[main] Round setup took {(time.perf_counter() - started) * 1000:.1f} ms')
+
+            await self.run_round()
+            self.metrics.inc("rounds")
+            self.metrics.export()
+            logger.info("[main] All done! Starting over.")
+
+
+async def main():
+    logging.basicConfig(level=LOG_LEVEL, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    configure_metrics(METRICS_ENABLED, METRICS_TEXTFILE, METRICS_SOCKET)
+    node = Node()
+    await node.run_forever()
 
 if __name__ == "__main__":
     asyncio.run(main())
@@ -0,0 +1,116 @@
+import json
+import tempfile
+
+from peers import GossipCache, PeerManifests
+from sync import *
+
+
+def test_manifest_updates_incrementally():
+    pkg = Package("my-package", 1)
+    pkg.write_chunk("/src/file1.txt", 0, b"Hello World", version=1)
+    first = pkg.manifest.serialize()
+
+    # Older versions don't change the manifest, so the cache survives
+    pkg.write_chunk("/src/file1.txt", 0, b"Old content", version=1)
+    assert pkg.manifest.serialize() is first
+
+    pkg.write_chunk("/src/file1.txt", 0, b"Updated content", version=2)
+    assert pkg.manifest.serialize() is not first
+    assert json.loads(pkg.manifest.serialize())["files"] == {"/src/file1.txt": {"0": 2}}
+
+
+def test_manifest_round_trips_through_filesystem():
+    base = tempfile.mkdtemp()
+    pkg = Package("my-package", 1, base_path=base)
+    pkg.write_chunk("/src/file1.txt", 0, b"Hello World", version=1)
+    pkg.write_chunk("/src/file2.txt", 3, b"Some data", version=2)
+
+    reloaded = Package("my-package", 1, base_path=base)
+    reloaded.load_from_filesystem()
+    assert reloaded.manifest.digest() == pkg.manifest.digest()
+    assert not Package.manifests_differ(reloaded.manifest.to_dict(), pkg.manifest.to_dict())
+
+
+def test_serialize_with_embeds_manifest():
+    pkg = Package("my-package", 1)
+    pkg.write_chunk("/src/file1.txt", 0, b"Hello World", version=1)
+    wrapped = json.loads(pkg.manifest.serialize_with(ssid="rpi1"))
+    assert wrapped == {"ssid": "rpi1", "manifest": pkg.manifest.to_dict()}
+
+
+def test_delta_manifest_since_last_seen():
+    pkg = Package("my-package", 1)
+    for block in range(100):
+        pkg.write_chunk("/src/file1.txt", block, b"data", version=1)
+    peers = PeerManifests()
+
+    # First contact: nothing seen yet, so the full manifest goes over
+    first = json.loads(pkg.manifest.serialize_for(None, ssid="rpi0"))
+    assert "manifest" in first
+    assert peers.apply("rpi0", first) == pkg.manifest.to_dict()
+
+    pkg.write_chunk("/src/file1.txt", 7, b"new", version=2)
+    pkg.write_chunk("/src/file2.txt", 0, b"new", version=1)
+    second = json.loads(pkg.manifest.serialize_for(peers.seen("rpi0"), ssid="rpi0"))
+    assert second["delta"] == {"/src/file1.txt": {"7": 2}, "/src/file2.txt": {"0": 1}}
+    assert peers.apply("rpi0", second) == pkg.manifest.to_dict()
+
+    # Nothing changed since: an empty delta
+    third = json.loads(pkg.manifest.serialize_for(peers.seen("rpi0")))
+    assert third["delta"] == {}
+
+
+def test_full_manifest_once_history_is_compacted():
+    manifest = Manifest("my-package", 1, history=4)
+    manifest.update("/src/file1.txt", 0, 1)
+    peers = PeerManifests()
+    peers.apply("rpi0", json.loads(manifest.serialize_for(None)))
+    seen = peers.seen("rpi0")
+
+    for block in range(1, 10):
+        manifest.update("/src/file1.txt", block, 1)
+    assert manifest.delta_since(seen["seq"]) is None
+    payload = json.loads(manifest.serialize_for(seen))
+    assert "manifest" in payload
+    assert peers.apply("rpi0", payload) == manifest.to_dict()
+
+    # A delta against a base we don't have is refused, and the peer forgotten
+    assert peers.apply("rpi0", {"epoch": manifest.epoch, "seq": 20, "base": 15, "delta": {}}) is None
+    assert peers.seen("rpi0") is None
+
+
+def test_gossip_ranks_peers_by_what_they_likely_have():
+    now = [1000.0]
+    ours = Manifest("my-package", 1)
+    ours.update("/etc/hosts", 0, 1)
+    newer = Manifest("my-package", 1)
+    newer.update("/etc/hosts", 0, 3)
+    newer.update("/etc/motd", 0, 1)
+
+    # rpi1 talked to rpi2 directly, then gossips about it to us
+    rpi1 = GossipCache(clock=lambda: now[0])
+    rpi1.note("rpi2", newer.to_dict())
+    rpi1.note("rpi3", ours.to_dict())
+    now[0] += 30
+    gossip = json.loads(json.dumps(rpi1.export()))
+
+    cache = GossipCache(max_age=60, clock=lambda: now[0])
+    cache.merge(gossip, via="rpi1", us="rpi0")
+    assert cache.entries["rpi2"].hops == 1
+    assert cache.score("rpi2", ours.to_dict()) == 2
+    assert cache.score("rpi3", ours.to_dict()) == 0
+    assert cache.rank(["rpi3", "rpi4", "rpi2"], ours.to_dict()) == ["rpi2", "rpi4", "rpi3"]
+
+    # Ages carry over: what rpi1 heard 30 s ago is gone 31 s later here
+    now[0] += 31
+    assert cache.score("rpi2", ours.to_dict()) is None
+
+
+if __name__ == "__main__":
+    test_manifest_updates_incrementally()
+    test_manifest_round_trips_through_filesystem()
+    test_serialize_with_embeds_manifest()
+    test_delta_manifest_since_last_seen()
+    test_full_manifest_once_history_is_compacted()
+    test_gossip_ranks_peers_by_what_they_likely_have()
+    print("tests passed")
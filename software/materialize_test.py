@@ -0,0 +1,70 @@
+import os
+import tempfile
+
+from sync import *
+
+
+def test_materialize_rewrites_only_changed_blocks():
+    pkg = Package("my-package", 1, base_path=tempfile.mkdtemp())
+    target = tempfile.mkdtemp()
+    pkg.write_chunk("/img/disk.bin", 0, b"A" * DEFAULT_BLOCK_SIZE, version=1)
+    pkg.write_chunk("/img/disk.bin", 1, b"B" * 100, version=1)
+
+    stats = pkg.materialize(target)
+    assert stats["bytes_written"] == DEFAULT_BLOCK_SIZE + 100
+    assert os.path.getsize(os.path.join(target, "img/disk.bin")) == DEFAULT_BLOCK_SIZE + 100
+
+    # A shorter last block truncates the file, and only that block is written
+    pkg.write_chunk("/img/disk.bin", 1, b"C" * 10, version=2)
+    stats = pkg.materialize(target)
+    assert (stats["blocks"], stats["bytes_written"]) == (1, 10)
+    with open(os.path.join(target, "img/disk.bin"), "rb") as f:
+        content = f.read()
+    assert len(content) == DEFAULT_BLOCK_SIZE + 10
+    assert content.endswith(b"A" + b"C" * 10)
+
+    assert pkg.materialize(target)["files"] == 0
+
+
+def test_materialize_atomic_swap():
+    pkg = Package("my-package", 1)
+    target = tempfile.mkdtemp()
+    pkg.write_chunk("/etc/app.conf", 0, b"debug=false\n", version=1)
+    pkg.materialize(target)
+
+    pkg.write_chunk("/etc/app.conf", 0, b"debug=true\n", version=2)
+    pkg.materialize(target, atomic=True)
+    with open(os.path.join(target, "etc/app.conf"), "rb") as f:
+        assert f.read() == b"debug=true\n"
+    assert not os.path.exists(os.path.join(target, "etc/.app.conf.tmp"))
+
+
+def test_materialize_retries_missing_blocks_and_removes_files():
+    pkg = Package("my-package", 1, block_size=16)
+    target = tempfile.mkdtemp()
+    pkg.write_chunk("/a", 0, b"A" * 16, version=1)
+    pkg.write_chunk("/a", 1, b"B" * 4, version=1)
+    pkg.write_chunk("/b", 0, b"old", version=1)
+
+    # A block that can't be read yet is left for the next call
+    read_chunk = pkg.read_chunk
+    pkg.read_chunk = lambda path, block_number, *args, **kwargs: \
+        None if block_number == 1 else read_chunk(path, block_number, *args, **kwargs)
+    assert pkg.materialize(target)["blocks"] == 2
+    pkg.read_chunk = read_chunk
+    stats = pkg.materialize(target)
+    assert (stats["blocks"], stats["bytes_written"]) == (1, 4)
+    with open(os.path.join(target, "a"), "rb") as f:
+        assert f.read() == b"A" * 16 + b"B" * 4
+
+    pkg.manifest.remove_file("/b")
+    assert pkg.materialize(target)["removed"] == 1
+    assert not os.path.exists(os.path.join(target, "b"))
+    assert os.path.exists(os.path.join(target, "a"))
+
+
+if __name__ == "__main__":
+    test_materialize_rewrites_only_changed_blocks()
+    test_materialize_atomic_swap()
+    test_materialize_retries_missing_blocks_and_removes_files()
+    print("tests passed")
@@ -0,0 +1,154 @@
+import logging
+import os
+import socket
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from typing import Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+LabelKey = Tuple[str, Tuple[Tuple[str, str], ...]]
+
+
+def _key(name: str, labels: Dict[str, str]) -> LabelKey:
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def redact_frame(data):
+    """Copy of a transfer frame with its payload replaced by its size, for logging."""
+    if not isinstance(data, dict) or not isinstance(data.get('content'), dict) or 'data' not in data['content']:
+        return data
+    content = dict(data['content'])
+    content['data'] = f"<{len(content['data'])} bytes>"
+    return {**data, 'content': content}
+
+
+class Metrics:
+    """
+    Counters and timing spans for the node, exported in the Prometheus text
+    format to a file (for node_exporter's textfile collector) and/or served
+    on a Unix socket.
+    """
+    def __init__(self, textfile: Optional[str] = None, socket_path: Optional[str] = None):
+        self.textfile = textfile
+        self.socket_path = socket_path
+        self.counters: Dict[LabelKey, float] = {}
+        self.gauges: Dict[LabelKey, float] = {}
+        # name+labels -> [count, sum of seconds]
+        self.timings: Dict[LabelKey, list] = {}
+        self._lock = threading.Lock()
+        self._socket = None
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels):
+        with self._lock:
+            self.gauges[_key(name, labels)] = value
+
+    def observe(self, name: str, seconds: float, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            timing = self.timings.setdefault(key, [0, 0.0])
+            timing[0] += 1
+            timing[1] += seconds
+            self.gauges[_key(name + "_last", labels)] = seconds
+
+    @contextmanager
+    def span(self, name: str, **labels):
+        """Time a block of code as phase `name`."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            self.observe("phase_seconds", elapsed, phase=name, **labels)
+            logger.debug(f"[span] {name} took {elapsed * 1000:.1f} ms")
+
+    def render(self) -> str:
+        """All metrics in the Prometheus text exposition format."""
+        def fmt(name, labels, value):
+            label_str = ",".join(f'{k}="{v}"' for k, v in labels)
+            return f"p2p_{name}{{{label_str}}} {value}" if labels else f"p2p_{name} {value}"
+
+        lines = []
+        with self._lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                lines.append(fmt(name + "_total", labels, value))
+            for (name, labels), value in sorted(self.gauges.items()):
+                lines.append(fmt(name, labels, value))
+            for (name, labels), (count, total) in sorted(self.timings.items()):
+                lines.append(fmt(name + "_count", labels, count))
+                lines.append(fmt(name + "_sum", labels, total))
+        return "\n".join(lines) + "\n"
+
+    def export(self):
+        """Write the text file atomically, if one is configured."""
+        if not self.textfile:
+            return
+        tmp = self.textfile + ".tmp"
+        with open(tmp, "w") as f:
+            f.write(self.render())
+        os.replace(tmp, self.textfile)
+
+    def serve(self):
+        """Serve the current metrics to every connection on the Unix socket, in the background."""
+        if not self.socket_path or self._socket:
+            return
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._socket.bind(self.socket_path)
+        self._socket.listen(4)
+
+        def accept():
+            while True:
+                conn, _ = self._socket.accept()
+                with conn:
+                    conn.sendall(self.render().encode("utf-8"))
+
+        threading.Thread(target=accept, daemon=True).start()
+
+
+class NullMetrics:
+    """Drop-in for Metrics that records nothing, so disabled metrics cost ~nothing."""
+    _span = nullcontext()
+
+    def inc(self, name, value=1, **labels):
+        pass
+
+    def set(self, name, value, **labels):
+        pass
+
+    def observe(self, name, seconds, **labels):
+        pass
+
+    def span(self, name, **labels):
+        return self._span
+
+    def render(self) -> str:
+        return ""
+
+    def export(self):
+        pass
+
+    def serve(self):
+        pass
+
+
+_metrics = NullMetrics()
+
+
+def configure_metrics(enabled: bool, textfile: Optional[str] = None, socket_path: Optional[str] = None):
+    """Install the process-wide metrics sink."""
+    global _metrics
+    _metrics = Metrics(textfile, socket_path) if enabled else NullMetrics()
+    _metrics.serve()
+    return _metrics
+
+
+def get_metrics():
+    return _metrics
@@ -0,0 +1,220 @@
+"""
+One-to-many chunk delivery over UDP multicast with LT fountain codes.
+
+The AP streams coded symbols of the chunks its clients lack to a multicast
+group, round-robin across chunks, for as long as it's told to. Each client
+rebuilds a chunk from any sufficient subset of that chunk's symbols, so
+there are no per-packet ACKs, and one transmission serves every client on
+the AP. Whatever a client hasn't decoded when its listening window closes
+is fetched over the normal unicast transfer.
+
+Packets carry a header then one symbol:
+
+    magic "LT" (2) | object id (8) | seed (4) | data length (4) | symbol size (2)
+
+The object id is derived from (path, block, version), so clients match
+packets to the chunks in their own diff without any announcements.
+"""
+import hashlib
+import logging
+import random
+import socket
+import struct
+import threading
+import time
+from typing import Dict, List, Optional
+
+from fountain import DEFAULT_SYMBOL_SIZE, LTDecoder, LTEncoder
+from sync import ChunkVersion, Package, chunks_to_offer
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"LT"
+HEADER = struct.Struct(">2sQIIH")
+
+
+def object_id(file_path: str, block_number: int, version: int) -> int:
+    digest = hashlib.sha256(f"{file_path}:{block_number}:{version}".encode()).digest()
+    return int.from_bytes(digest[:8], 'big')
+
+
+class MulticastSender:
+    """Streams fountain-coded symbols of a set of chunks to a multicast group."""
+    def __init__(self, group: str, port: int, interface: Optional[str] = None, ttl: int = 1,
+                 symbol_size: int = DEFAULT_SYMBOL_SIZE, rate: Optional[float] = None,
+                 loss: float = 0.0, seed: Optional[int] = None):
+        """
+        Args:
+            group (str): Multicast group address
+            port (int): UDP port
+            interface (str, optional): Address of the interface to send from
+            ttl (int): Multicast TTL; 1 keeps packets on the local link
+            symbol_size (int): Bytes of coded data per packet
+            rate (float, optional): Bytes per second to send at most
+            loss (float): Share of packets to drop on purpose, for testing
+            seed (int, optional): Seed for the simulated loss
+        """
+        self.group = group
+        self.port = port
+        self.symbol_size = symbol_size
+        self.rate = rate
+        self.loss = loss
+        self._loss_rng = random.Random(seed)
+        self.packets_sent = 0
+        self.packets_dropped = 0
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, ttl)
+        self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+        if interface:
+            self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(interface))
+
+    def send(self, objects: Dict[int, bytes], overhead: float = 0.3, passes: Optional[int] = 1,
+             stop: Optional[threading.Event] = None) -> int:
+        """
+        Stream symbols for `objects` (object id -> data). Each pass sends
+        about (1 + overhead) x K fresh symbols per object, interleaved across
+        objects so a burst of loss costs each object a little.
+
+        Args:
+            objects (Dict): object id -> bytes
+            overhead (float): Extra symbols per pass, as a share of K
+            passes (int, optional): Passes to send; None to carry on until `stop` is set
+            stop (threading.Event, optional): Set to stop sending
+
+        Returns:
+            int: Packets sent
+        """
+        encoders = {oid: LTEncoder(data, self.symbol_size) for oid, data in objects.items()}
+        next_seed = {oid: 0 for oid in encoders}
+        started = time.monotonic()
+        sent_bytes = 0
+        done_passes = 0
+        while encoders and (passes is None or done_passes < passes):
+            quota = {oid: int(encoder.k * (1 + overhead)) + 1 for oid, encoder in encoders.items()}
+            while quota:
+                for oid in list(quota):
+                    if stop is not None and stop.is_set():
+                        return self.packets_sent
+                    encoder = encoders[oid]
+                    seed = next_seed[oid]
+                    next_seed[oid] = seed + 1
+                    packet = HEADER.pack(MAGIC, oid, seed, encoder.length, self.symbol_size) + encoder.symbol(seed)
+                    self._send(packet)
+                    sent_bytes += len(packet)
+                    quota[oid] -= 1
+                    if not quota[oid]:
+                        del quota[oid]
+                    if self.rate:
+                        # Pace to the configured rate
+                        ahead = sent_bytes / self.rate - (time.monotonic() - started)
+                        if ahead > 0:
+                            time.sleep(ahead)
+            done_passes += 1
+        return self.packets_sent
+
+    def _send(self, packet: bytes):
+        if self.loss and self._loss_rng.random() < self.loss:
+            self.packets_dropped += 1
+            return
+        self.sock.sendto(packet, (self.group, self.port))
+        self.packets_sent += 1
+
+    def send_chunks(self, package: Package, chunks: List[ChunkVersion], **kwargs) -> int:
+        """Stream the given chunks of `package` (see send for the options)."""
+        objects = {}
+        for chunk in chunks:
+            data = package.read_chunk(chunk.file_path, chunk.block_number, chunk.version, padded=False)
+            if data is not None:
+                objects[object_id(chunk.file_path, chunk.block_number, chunk.version)] = data
+        logger.info(f"[multicast] Streaming {len(objects)} chunks to {self.group}:{self.port}")
+        return self.send(objects, **kwargs)
+
+    def close(self):
+        self.sock.close()
+
+
+class MulticastReceiver:
+    """Joins a multicast group and decodes the chunks it's asked for."""
+    def __init__(self, group: str, port: int, interface: str = '0.0.0.0',
+                 loss: float = 0.0, seed: Optional[int] = None):
+        """
+        Args:
+            group (str): Multicast group address
+            port (int): UDP port
+            interface (str): Address of the interface to join the group on
+            loss (float): Share of packets to drop on purpose, for testing
+            seed (int, optional): Seed for the simulated loss
+        """
+        self.loss = loss
+        self._loss_rng = random.Random(seed)
+        self.packets_received = 0
+        self.packets_dropped = 0
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1048576)
+        self.sock.bind(('', port))
+        membership = socket.inet_aton(group) + socket.inet_aton(interface)
+        self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+
+    def receive(self, wanted: Dict[int, object], timeout: float) -> Dict[object, bytes]:
+        """
+        Decode objects until all of `wanted` are in or `timeout` seconds pass.
+
+        Args:
+            wanted (Dict): object id -> key to return its data under
+
+        Returns:
+            Dict: key -> data, for the objects that were decoded
+        """
+        decoders: Dict[int, LTDecoder] = {}
+        results: Dict[object, bytes] = {}
+        deadline = time.monotonic() + timeout
+        while len(results) < len(wanted):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            self.sock.settimeout(remaining)
+            try:
+                packet = self.sock.recv(65536)
+            except socket.timeout:
+                break
+            if len(packet) < HEADER.size:
+                continue
+            magic, oid, seed, length, symbol_size = HEADER.unpack_from(packet)
+            if magic != MAGIC or oid not in wanted or wanted[oid] in results:
+                continue
+            if self.loss and self._loss_rng.random() < self.loss:
+                self.packets_dropped += 1
+                continue
+            self.packets_received += 1
+
+            decoder = decoders.get(oid)
+            if decoder is None:
+                decoder = decoders[oid] = LTDecoder(length, symbol_size)
+            if decoder.add(seed, packet[HEADER.size:]):
+                results[wanted[oid]] = decoder.data()
+                del decoders[oid]
+        return results
+
+    def receive_chunks(self, package: Package, chunks: List[ChunkVersion], timeout: float) -> List[ChunkVersion]:
+        """
+        Decode as many of `chunks` as arrive within `timeout` seconds and
+        write them to `package`.
+
+        Returns:
+            list: The chunks received
+        """
+        wanted = {object_id(chunk.file_path, chunk.block_number, chunk.version): n for n, chunk in enumerate(chunks)}
+        received = []
+        for n, data in self.receive(wanted, timeout).items():
+            chunk = chunks[n]
+            if package.write_chunk(chunk.file_path, chunk.block_number, data, chunk.version, chunk.block_size):
+                received.append(chunk)
+        logger.info(f"[multicast] Decoded {len(received)} of {len(chunks)} chunks "
+                    f"from {self.packets_received} packets")
+        return received
+
+    def close(self):
+        self.sock.close()
@@ -0,0 +1,60 @@
+import random
+import socket
+import threading
+
+from multicast import MulticastReceiver, MulticastSender, chunks_to_offer
+from sync import Package
+
+GROUP = "239.255.42.99"
+
+
+def free_udp_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+        s.bind(("", 0))
+        return s.getsockname()[1]
+
+
+def test_clients_rebuild_chunks_over_lossy_multicast():
+    rng = random.Random(0)
+    source = Package("my-package", 1)
+    source.add_file("/img/disk.bin", rng.randbytes(300_000), block_size=64 * 1024)
+    source.add_file("/etc/app.conf", b"debug=true\n")
+
+    port = free_udp_port()
+    # Two clients on the AP, losing different packets
+    clients = [Package("my-package", 1) for _ in range(2)]
+    receivers = [MulticastReceiver(GROUP, port, interface="127.0.0.1", loss=0.2, seed=n) for n in range(2)]
+    diff = chunks_to_offer(source, clients[0].manifest.to_dict())
+    assert len(diff) == 6
+
+    stop = threading.Event()
+    sender = MulticastSender(GROUP, port, interface="127.0.0.1", loss=0.1, seed=0, rate=20e6)
+    streaming = threading.Thread(target=sender.send_chunks, args=(source, diff),
+                                 kwargs={"passes": None, "stop": stop}, daemon=True)
+    streaming.start()
+    try:
+        results = []
+        threads = [threading.Thread(target=lambda c=client, r=receiver: results.append(
+                       r.receive_chunks(c, c.get_missing_chunks(source.manifest.to_dict()), timeout=10)))
+                   for client, receiver in zip(clients, receivers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        stop.set()
+        streaming.join()
+        sender.close()
+        for receiver in receivers:
+            receiver.close()
+
+    assert [len(received) for received in results] == [6, 6]
+    for client, receiver in zip(clients, receivers):
+        assert client.get_missing_chunks(source.manifest.to_dict()) == []
+        assert receiver.packets_dropped > 0
+    assert sender.packets_dropped > 0
+
+
+if __name__ == "__main__":
+    test_clients_rebuild_chunks_over_lossy_multicast()
+    print("tests passed")
@@ -0,0 +1,76 @@
+import tempfile
+
+from peers import PeerManifests
+from sync import *
+
+
+def configs(count, tag=b""):
+    return {f"/etc/app{n}.conf": tag + f"setting={n}\n".encode() * 100 for n in range(count)}
+
+
+def test_small_files_share_packs_and_changes_go_to_a_delta_pack():
+    with tempfile.TemporaryDirectory() as source_dir, tempfile.TemporaryDirectory() as peer_dir:
+        source = Package("my-package", 1, source_dir, use_index=True, pack_small_files=True)
+        files = configs(200)
+        assert len(source.add_files(files)) == 200
+        packs = [path for path in source.manifest.files if path.startswith(PACK_PREFIX)]
+        assert len(packs) == 1 and len(source.manifest.packed) == 200
+        assert source.add_files(files) == []
+
+        # One request fetches all 200 files
+        peer = Package("my-package", 1, peer_dir, use_index=True)
+        missing = peer.get_missing_chunks(source.manifest.to_dict())
+        assert [chunk.file_path for chunk in missing] == packs
+        peer.sync_chunks(source, missing)
+        assert peer.read_file("/etc/app7.conf") == files["/etc/app7.conf"]
+
+        # Two edits go into a new pack; the first one is left as it is
+        edited = dict(files, **configs(2, tag=b"#"))
+        assert sorted(source.add_files(edited)) == ["/etc/app0.conf", "/etc/app1.conf"]
+        assert packs[0] in source.manifest.files
+        missing = peer.get_missing_chunks(source.manifest.to_dict())
+        assert len(missing) == 1 and missing[0].file_path != packs[0]
+        assert source.get_chunk_length(missing[0].file_path, 0) < source.get_chunk_length(packs[0], 0) / 50
+        peer.sync_chunks(source, missing)
+        assert peer.read_file("/etc/app0.conf") == edited["/etc/app0.conf"]
+        assert peer.read_file("/etc/app9.conf") == files["/etc/app9.conf"]
+        assert peer.get_missing_chunks(source.manifest.to_dict()) == []
+
+        # A file that outgrows packing moves to blocks; fully replaced packs are deleted
+        source.add_files({"/etc/app0.conf": bytes(PACK_THRESHOLD + 1)})
+        assert "/etc/app0.conf" in source.manifest.files and "/etc/app0.conf" not in source.manifest.packed
+        source.add_files({"/etc/app1.conf": b"small"})
+        assert len([path for path in source.manifest.files if path.startswith(PACK_PREFIX)]) == 2
+
+        # Packed files survive a restart and are written out whole
+        restarted = Package("my-package", 1, source_dir, use_index=True, pack_small_files=True)
+        restarted.load_from_filesystem()
+        assert not Package.manifests_differ(restarted.manifest.to_dict(), source.manifest.to_dict())
+        with tempfile.TemporaryDirectory() as target:
+            restarted.materialize(target)
+            with open(f"{target}/etc/app1.conf", "rb") as f:
+                assert f.read() == b"small"
+            with open(f"{target}/etc/app0.conf", "rb") as f:
+                assert f.read() == bytes(PACK_THRESHOLD + 1)
+            assert restarted.materialize(target)["files"] == 0
+
+
+def test_delta_manifest_carries_pack_entries():
+    source = Package("my-package", 1, pack_small_files=True)
+    source.add_files(configs(10))
+    peers = PeerManifests()
+    peers.apply("source", json.loads(source.manifest.serialize_for(None)))
+    seen = {"epoch": source.manifest.epoch, "seq": source.manifest.seq}
+
+    source.add_files(configs(1, tag=b"#"))
+    payload = json.loads(source.manifest.serialize_for(seen))
+    assert list(payload["packed"]) == ["/etc/app0.conf"]
+    # The first pack is still in use, so nothing was removed
+    assert "removed" not in payload
+    assert peers.apply("source", payload) == source.manifest.to_dict()
+
+
+if __name__ == "__main__":
+    test_small_files_share_packs_and_changes_go_to_a_delta_pack()
+    test_delta_manifest_carries_pack_entries()
+    print("tests passed")
@@ -0,0 +1,226 @@
+import hashlib
+import json
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional
+
+from sync import Manifest
+
+
+@dataclass
+class PeerState:
+    """
+    What we last heard from a peer.
+
+    Attributes:
+        epoch (str, optional): The peer's manifest epoch (None for peers that don't send one)
+        seq (int): The peer's manifest sequence number we're up to date with
+        manifest (Manifest): Our copy of the peer's manifest
+    """
+    epoch: Optional[str]
+    seq: int
+    manifest: Manifest
+
+
+class PeerManifests:
+    """
+    Last manifest and sequence number seen from each peer, so manifest
+    exchanges after the first can carry only what changed since.
+    """
+    def __init__(self, max_peers: int = 32):
+        self.max_peers = max_peers
+        self.peers: "OrderedDict[str, PeerState]" = OrderedDict()
+
+    def seen(self, peer: Optional[str]) -> Optional[Dict]:
+        """What we've seen of `peer`'s manifest, as sent back to it: {"epoch", "seq"}."""
+        state = self.peers.get(peer)
+        if state is None or state.epoch is None:
+            return None
+        return {"epoch": state.epoch, "seq": state.seq}
+
+    def forget(self, peer: str):
+        self.peers.pop(peer, None)
+
+    def apply(self, peer: str, payload: Dict) -> Optional[Dict]:
+        """
+        Take in a manifest payload from `peer`, full or delta.
+
+        Returns:
+            dict: The peer's full manifest, or None if a delta didn't match
+                  what we have (the peer is forgotten, so it sends a full one next)
+        """
+        if "delta" in payload:
+            state = self.peers.get(peer)
+            if state is None or state.epoch != payload.get("epoch") or state.seq != payload.get("base"):
+                self.forget(peer)
+                return None
+            manifest = state.manifest
+            manifest.set_version(payload.get("version", manifest.version))
+            for path, block_size in payload.get("block_sizes", {}).items():
+                manifest.set_block_size(path, block_size)
+            for path in payload.get("removed", []):
+                manifest.remove_file(path)
+            for path, blocks in payload["delta"].items():
+                for block_number, version in blocks.items():
+                    manifest.update(path, int(block_number), version)
+            for path, entry in payload.get("packed", {}).items():
+                manifest.set_packed(path, *entry)
+            for path, size in payload.get("file_sizes", {}).items():
+                manifest.set_file_size(path, size)
+            state.seq = payload.get("seq", state.seq)
+        elif "manifest" in payload:
+            state = PeerState(payload.get("epoch"), payload.get("seq", 0), Manifest.from_dict(payload["manifest"]))
+            self.peers[peer] = state
+        else:
+            return None
+
+        self.peers.move_to_end(peer)
+        while len(self.peers) > self.max_peers:
+            self.peers.popitem(last=False)
+        return state.manifest.to_dict()
+
+
+def _path_key(path: str) -> str:
+    """Short stand-in for a path in gossip summaries."""
+    return hashlib.sha1(path.encode('utf-8')).hexdigest()[:6]
+
+
+def summarize(manifest: Dict, max_files: Optional[int] = None) -> Dict[str, int]:
+    """
+    Compact summary of a manifest (in its dict form): hashed path -> newest
+    version of any of the file's blocks, keeping the `max_files` files with
+    the newest versions.
+    """
+    newest = {path: max(blocks.values(), default=0) for path, blocks in manifest.get("files", {}).items()}
+    for path, entry in manifest.get("packed", {}).items():
+        newest[path] = max(newest.get(path, 0), entry[3])
+    ordered = sorted(newest.items(), key=lambda item: (-item[1], item[0]))
+    if max_files is not None:
+        ordered = ordered[:max_files]
+    return {_path_key(path): version for path, version in ordered}
+
+
+@dataclass
+class GossipEntry:
+    """
+    What we've heard about a peer's manifest, first or second hand.
+
+    Attributes:
+        digest (str): The manifest's digest
+        summary (Dict): Hashed path -> newest version (see summarize)
+        heard_at (float): When the information was fresh, on our clock
+        hops (int): 0 if we exchanged manifests with the peer ourselves
+    """
+    digest: str
+    summary: Dict[str, int]
+    heard_at: float
+    hops: int
+
+
+class GossipCache:
+    """
+    Summaries of the manifests of peers we've heard about, passed along in
+    BLE exchanges, so a node can tell which nearby peers likely have blocks
+    newer than its own before it picks one to sync with.
+
+    Bounded in peers and in age; ages rather than timestamps go over the
+    air, so peers' clocks don't need to agree.
+    """
+    def __init__(self, max_peers: int = 32, max_age: float = 600, summary_files: int = 32,
+                 clock: Callable[[], float] = time.monotonic):
+        """
+        Args:
+            max_peers (int): Peers to remember, least recently heard of dropped first
+            max_age (float): Seconds after which what we heard is dropped
+            summary_files (int): Files kept per summary
+            clock (Callable): Time source, for tests
+        """
+        self.max_peers = max_peers
+        self.max_age = max_age
+        self.summary_files = summary_files
+        self.clock = clock
+        self.entries: "OrderedDict[str, GossipEntry]" = OrderedDict()
+
+    def _expire(self):
+        cutoff = self.clock() - self.max_age
+        for peer in [peer for peer, entry in self.entries.items() if entry.heard_at < cutoff]:
+            del self.entries[peer]
+
+    def _put(self, peer: str, entry: GossipEntry):
+        current = self.entries.get(peer)
+        # First-hand or fresher news replaces what we have
+        if current is not None and (current.heard_at, -current.hops) > (entry.heard_at, -entry.hops):
+            return
+        self.entries[peer] = entry
+        self.entries.move_to_end(peer)
+        while len(self.entries) > self.max_peers:
+            self.entries.popitem(last=False)
+
+    def note(self, peer: str, manifest: Dict):
+        """Record the full manifest (dict form) we just got from `peer` directly."""
+        digest = hashlib.sha256(json.dumps(manifest, sort_keys=True).encode('utf-8')).hexdigest()
+        self._put(peer, GossipEntry(digest, summarize(manifest, self.summary_files), self.clock(), 0))
+
+    def merge(self, gossip: Optional[Dict], via: str, us: Optional[str] = None):
+        """
+        Take in the gossip `via` sent us (see export). Entries about `via`
+        itself and about us are skipped: we hear those first hand.
+        """
+        if not isinstance(gossip, dict):
+            return
+        now = self.clock()
+        for peer, item in gossip.items():
+            if peer in (via, us):
+                continue
+            try:
+                entry = GossipEntry(item["d"], dict(item["s"]), now - float(item["age"]), int(item["hops"]) + 1)
+            except (KeyError, TypeError, ValueError):
+                continue
+            if now - entry.heard_at <= self.max_age:
+                self._put(peer, entry)
+        self._expire()
+
+    def export(self, exclude: Optional[str] = None, max_peers: int = 4) -> Dict:
+        """The freshest `max_peers` entries, compactly, to send to a peer (other than `exclude`)."""
+        self._expire()
+        now = self.clock()
+        freshest = sorted((item for item in self.entries.items() if item[0] != exclude),
+                          key=lambda item: (item[1].hops, -item[1].heard_at))[:max_peers]
+        return {
+            peer: {"d": entry.digest, "s": entry.summary, "age": round(now - entry.heard_at, 1), "hops": entry.hops}
+            for peer, entry in freshest
+        }
+
+    def score(self, peer: str, manifest: Dict) -> Optional[int]:
+        """
+        Files `peer` is likely to have newer versions of than `manifest`
+        (ours, in dict form), or None if we know nothing about it.
+        """
+        self._expire()
+        entry = self.entries.get(peer)
+        if entry is None:
+            return None
+        return self._score(entry, summarize(manifest))
+
+    @staticmethod
+    def _score(entry: GossipEntry, ours: Dict[str, int]) -> int:
+        return sum(1 for key, version in entry.summary.items() if version > ours.get(key, 0))
+
+    def rank(self, peers: List[str], manifest: Dict) -> List[str]:
+        """
+        `peers` ordered by how likely they are to have what we lack: those
+        known to have newer files first (most first), then the unknown ones
+        in their given order, then those known to have nothing for us.
+        """
+        self._expire()
+        ours = summarize(manifest)
+
+        def key(item):
+            n, peer = item
+            entry = self.entries.get(peer)
+            if entry is None:
+                return (1, 0, n)
+            score = self._score(entry, ours)
+            return (0 if score else 2, -score, n)
+        return [peer for _, peer in sorted(enumerate(peers), key=key)]
@@ -0,0 +1,165 @@
+import asyncio
+import logging
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Set, Tuple
+
+from metrics import get_metrics
+from sync import Package, run_native
+
+logger = logging.getLogger(__name__)
+
+@dataclass
+class RetentionPolicy:
+    """
+    Which old block versions to keep. The latest version of a block is
+    always kept.
+
+    Attributes:
+        keep_latest (int): Number of most recent versions to keep per block
+        keep_peer_versions (bool): Also keep versions that a known peer's
+                                   manifest still references
+        disk_quota (int, optional): Chunk storage budget in bytes; while over
+                                    it, only the latest versions are kept
+    """
+    keep_latest: int = 2
+    keep_peer_versions: bool = True
+    disk_quota: Optional[int] = None
+
+
+class GarbageCollector:
+    """
+    Incremental garbage collector for old block versions.
+
+    Each step looks at a bounded number of blocks and deletes the versions the
+    retention policy doesn't keep, so collection can be interleaved with
+    transfers instead of walking the whole package at once. Every block is
+    collected under the package's io_lock, like the transfer's disk work.
+    """
+    def __init__(self, package: Package, policy: Optional[RetentionPolicy] = None, max_peers: int = 32):
+        self.package = package
+        self.policy = policy or RetentionPolicy()
+        self.max_peers = max_peers
+        # peer -> file path -> block number -> version
+        self.peer_versions: "OrderedDict[str, Dict[str, Dict[int, int]]]" = OrderedDict()
+
+        self._cursor: List[Tuple[str, int]] = []
+        self._over_quota_by = 0
+
+        # Metrics
+        self.bytes_reclaimed = 0
+        self.chunks_removed = 0
+        self.passes = 0
+        self.bytes_compacted = 0
+
+    def note_peer_manifest(self, peer: str, manifest: Dict):
+        """Remember which block versions a peer has, so we keep them around."""
+        self.peer_versions[peer] = {
+            path: {int(block): version for block, version in blocks.items()}
+            for path, blocks in manifest.get("files", {}).items()
+        }
+        self.peer_versions.move_to_end(peer)
+        while len(self.peer_versions) > self.max_peers:
+            self.peer_versions.popitem(last=False)
+
+    def _peer_referenced(self, path: str, block_number: int) -> Set[int]:
+        return {
+            files[path][block_number]
+            for files in self.peer_versions.values()
+            if block_number in files.get(path, {})
+        }
+
+    def _start_pass(self):
+        self._cursor = [
+            (path, block_number)
+            for path, blocks in self.package.manifest.files.items()
+            for block_number in blocks
+        ]
+        self._cursor.reverse()  # pop() from the end in manifest order
+
+        quota = self.policy.disk_quota
+        self._over_quota_by = 0
+        if quota is not None:
+            self._over_quota_by = max(0, self.package.storage_usage() - quota)
+
+    def _collect_block(self, path: str, block_number: int) -> int:
+        versions = self.package.get_block_versions(path, block_number)
+        if len(versions) <= 1:
+            return 0
+
+        if self._over_quota_by > 0:
+            keep = {versions[-1]}
+        else:
+            keep = set(versions[-max(1, self.policy.keep_latest):])
+            if self.policy.keep_peer_versions:
+                keep |= self._peer_referenced(path, block_number)
+
+        freed = 0
+        for version in versions:
+            if version in keep:
+                continue
+            reclaimed = self.package.delete_chunk_version(path, block_number, version)
+            if reclaimed is not None:
+                freed += reclaimed
+                self.chunks_removed += 1
+        self._over_quota_by = max(0, self._over_quota_by - freed)
+        return freed
+
+    def step(self, max_blocks: int = 64) -> int:
+        """
+        Examine up to `max_blocks` blocks, continuing where the last step left off.
+
+        Returns:
+            int: Bytes reclaimed by this step
+        """
+        if not self._cursor:
+            with self.package.io_lock:
+                self._start_pass()
+            self.passes += 1
+
+        freed = 0
+        for _ in range(min(max_blocks, len(self._cursor))):
+            path, block_number = self._cursor.pop()
+            with self.package.io_lock:
+                freed += self._collect_block(path, block_number)
+        self.bytes_reclaimed += freed
+        return freed
+
+    def pass_complete(self) -> bool:
+        return not self._cursor
+
+    def stats(self) -> Dict:
+        return {
+            "bytes_reclaimed": self.bytes_reclaimed,
+            "chunks_removed": self.chunks_removed,
+            "passes": self.passes,
+            "bytes_compacted": self.bytes_compacted,
+        }
+
+    def compact(self) -> int:
+        """Give back the space deleted versions leave in segment stores. Returns bytes reclaimed."""
+        with self.package.io_lock:
+            compacted = self.package.compact_storage()
+        self.bytes_compacted += compacted
+        return compacted
+
+    async def run(self, interval: float = 30.0, max_blocks: int = 64):
+        """
+        Collect in the background forever: one small step at a time, then
+        sleep `interval` seconds between full passes. Steps run off the event
+        loop, since they wait for the package lock behind transfer writes.
+        """
+        metrics = get_metrics()
+        while True:
+            removed = self.chunks_removed
+            freed = await asyncio.to_thread(run_native, self.step, max_blocks)
+            metrics.inc("gc_bytes_reclaimed", freed)
+            metrics.inc("gc_chunks_removed", self.chunks_removed - removed)
+            if self.pass_complete():
+                # Segment stores only give the space back when compacted
+                metrics.inc("gc_bytes_compacted", await asyncio.to_thread(run_native, self.compact))
+                metrics.inc("gc_passes")
+                logger.info(f"[gc] Pass {self.passes} done: {self.stats()}")
+                await asyncio.sleep(interval)
+            else:
+                await asyncio.sleep(0)
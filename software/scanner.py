@@ -4,12 +4,17 @@ import logging
 from bleak import BleakScanner, BleakClient
 from typing import Callable, Dict, List, Optional
 
+from ble_transfer import finish, pull_chunks, push_chunks
 from config import *
+from discovery import DutyCycle
+from metrics import get_metrics
+from peers import GossipCache, PeerManifests
 from sync import *
 
 
 class BLEServiceScanner:
-    def __init__(self, ssid: str, manifest: dict, packages: Optional[Dict[str, Package]] = {}, on_manifest: Optional[Callable] = None):
+    def __init__(self, ssid: str, manifest: Manifest, packages: Optional[Dict[str, Package]] = {}, on_manifest: Optional[Callable] = None,
+                 peers: Optional[PeerManifests] = None, gossip: Optional[GossipCache] = None):
         self.discovered_devices = []
         # Setup logging
         logging.basicConfig(level=logging.INFO)
@@ -17,15 +22,31 @@ class BLEServiceScanner:
         self.packages: Dict[str, Package] = packages
         self.peers: Dict[str, List[str]] = {}   # MAC address and what packages each peer has
         self.ssid = ssid                        # hostname for wifi
-        self.manifest = manifest                # Our manifest
+        self.manifest = manifest                # Our manifest (kept up to date by our Package)
         self.on_manifest = on_manifest          # Callback for processing manifest
+        self.duty: Optional[DutyCycle] = None   # Adaptive duty cycle, if any
+        self.peer_manifests = peers if peers is not None else PeerManifests()  # Shared with the advertiser
+        self.gossip = gossip if gossip is not None else GossipCache()         # Shared with the advertiser
+
+    def reset(self):
+        """Clear per-round discovery state."""
+        self.discovered_devices = []
 
     def detection_callback(self, device, advertisement_data):
         """Callback for when a device is detected during scanning"""
-        if device not in self.discovered_devices:
+        if self.duty:
+            self.duty.observe(device.address, self.advertisement_key(advertisement_data))
+        if device.address not in {d.address for d in self.discovered_devices}:
             self.discovered_devices.append(device)
             self.logger.info(f"Found device: {device.name} ({device.address})")
 
+    @staticmethod
+    def advertisement_key(advertisement_data):
+        """What a peer advertised, in a form that can be compared between windows."""
+        return (advertisement_data.local_name,
+                tuple(sorted((uuid, bytes(data)) for uuid, data in advertisement_data.service_data.items())),
+                tuple(sorted((company, bytes(data)) for company, data in advertisement_data.manufacturer_data.items())))
+
     async def connection_callback(self, client):
         """Callback for when a device is paired"""
         self.logger.info(f"Reading characteristics for service")
@@ -50,42 +71,48 @@ class BLEServiceScanner:
                     elif char.uuid == PKG_REQUEST_W:
                         pkg_request_write_handle = char.handle
                     else:
-                        print(f"[char in services] Found characteristic: {char.handle} {char.uuid}")
-            print(f"[connection_callback] Found handles: {pkg_list_read_handle}, {pkg_request_write_handle}, {pkg_manifest_read_handle}, {pkg_manifest_write_handle}")
+                        self.logger.debug(f"[char in services] Found characteristic: {char.handle} {char.uuid}")
+            self.logger.debug(f"[connection_callback] Found handles: {pkg_list_read_handle}, {pkg_request_write_handle}, {pkg_manifest_read_handle}, {pkg_manifest_write_handle}")
             if not pkg_manifest_write_handle:
                 self.logger.error(f"Characteristic with UUID {PKG_MANIFEST_W} not found.")
                 return
 
-            # Prepare data to write
-            our_data = {
-                "ssid": self.ssid,
-                "manifest": self.manifest,
-            }
-            our_data_str = json.dumps(our_data)
-
-            # Write to the characteristic using the handle
-            await client.write_gatt_char(pkg_manifest_write_handle, our_data_str.encode('utf-8'), response=False)
-            self.logger.info(f"Sent our package manifest using handle {pkg_manifest_write_handle}")
-
-
-            # read their manifest
+            # read their package list
             pkg_list_raw = await client.read_gatt_char(pkg_list_read_handle)
             pkg_list = json.loads(pkg_list_raw)
             self.logger.info(f"Got package list: {pkg_list_raw}")
+            peer = pkg_list["ssid"]
+            self.gossip.merge(pkg_list.get("gossip"), via=peer, us=self.ssid)
 
             self.peers[pkg_list["mac"]] = pkg_list["pkgs"]
             for pkg_name in pkg_list["pkgs"]:
-                await client.write_gatt_char(pkg_request_write_handle, pkg_name.encode('utf-8'))
-                print(f"[connection_callback] Requested package manifest: {pkg_name}")
-                pkg_manifest_raw = await client.read_gatt_char(pkg_manifest_read_handle)
-                self.logger.info(f"Got package manifest: {pkg_manifest_raw}")
-                pkg_manifest = json.loads(pkg_manifest_raw)
+                # Tell them what we've seen of their manifest, so they only send what changed
+                payload = await self.request_manifest(client, pkg_request_write_handle, pkg_manifest_read_handle,
+                                                      pkg_name, self.peer_manifests.seen(peer))
+                pkg_manifest = self.peer_manifests.apply(peer, payload)
+                if pkg_manifest is None:
+                    # Their delta doesn't fit what we remember; ask for the full manifest
+                    payload = await self.request_manifest(client, pkg_request_write_handle, pkg_manifest_read_handle,
+                                                          pkg_name, None)
+                    pkg_manifest = self.peer_manifests.apply(peer, payload)
+
+                # Send ours, as a delta from what they've seen of it if possible
+                our_data = self.manifest.serialize_for(payload.get("seen"), ssid=self.ssid,
+                                                       gossip=self.gossip.export(exclude=peer))
+                await client.write_gatt_char(pkg_manifest_write_handle, our_data, response=False)
+                self.logger.info(f"Sent our package manifest ({len(our_data)} bytes) using handle {pkg_manifest_write_handle}")
+
+                if pkg_manifest is None:
+                    self.logger.error(f"Could not get a usable manifest for {pkg_name} from {peer}")
+                    break
+                self.gossip.note(peer, pkg_manifest)
 
                 if pkg_name not in self.packages:
                     self.packages[pkg_name] = Package(name, 1)
 
-                # include peer ssid in response, so we can connect to wifi
-                response = {"ssid": pkg_list["ssid"], "manifest": pkg_manifest}
+                # include peer ssid in response, so we can connect to wifi; as the
+                # central, we're also the one to run a BLE transfer with the peer
+                response = {"ssid": peer, "manifest": pkg_manifest, "pkg": pkg_name, "device": client.address}
                 self.on_manifest(response)
 
                 # TODO: support multiple pkgs, for now break after the first one
@@ -95,22 +122,95 @@ class BLEServiceScanner:
             self.logger.error(f"Failed to interact with characteristics: {str(e)}")
 
 
-    async def scan_and_read(self, manifest: dict, scan_duration=15):
-        """Scan for devices and read characteristics of matching ones"""
-        self.logger.info(f"Scanning for devices with service UUID: {UUID}")
+    async def request_manifest(self, client, request_handle, manifest_handle, pkg_name: str,
+                               seen: Optional[Dict]) -> Dict:
+        """Request a package manifest (a delta from `seen`, if given) and read it back."""
+        request = {"pkg": pkg_name, "ssid": self.ssid, "seen": seen}
+        await client.write_gatt_char(request_handle, json.dumps(request).encode('utf-8'))
+        self.logger.debug(f"[connection_callback] Requested package manifest: {pkg_name}")
+        pkg_manifest_raw = await client.read_gatt_char(manifest_handle)
+        self.logger.info(f"Got package manifest ({len(pkg_manifest_raw)} bytes)")
+        payload = json.loads(pkg_manifest_raw)
+        # Unknown packages come back as an empty list
+        return payload if isinstance(payload, dict) else {}
+
+    def rank_devices(self, devices: List) -> List:
+        """Order discovered devices so peers that gossip says have newer files come first."""
+        names = [(device.name or "").removeprefix("FileShare-") for device in devices]
+        order = self.gossip.rank(names, self.manifest.to_dict())
+        ranked = [devices[names.index(name)] for name in dict.fromkeys(order)]
+        ranked += [device for device in devices if device not in ranked]
+        if ranked != devices:
+            self.logger.info(f"Gossip reordered peers: {[device.name for device in ranked]}")
+        return ranked
+
+    async def transfer_chunks(self, address: str, pkg_name: str, wanted: List[ChunkVersion],
+                              offer: List[ChunkVersion]) -> bool:
+        """
+        Move a small diff over BLE: fetch the chunks we want from the peer,
+        then send it the chunks it lacks.
+
+        Returns:
+            bool: Whether we got every chunk we wanted and sent every one offered
+        """
+        package = self.packages[pkg_name]
+        async with BleakClient(address) as client:
+            chunk_write_handle = chunk_read_handle = None
+            for service in client.services:
+                for char in service.characteristics:
+                    if char.uuid == PKG_CHUNK_W:
+                        chunk_write_handle = char.handle
+                    elif char.uuid == PKG_CHUNK_R:
+                        chunk_read_handle = char.handle
+            if not chunk_write_handle or not chunk_read_handle:
+                self.logger.error("Peer has no chunk characteristics; it can't transfer over BLE")
+                return False
+
+            async def write(value: bytes):
+                await client.write_gatt_char(chunk_write_handle, value, response=True)
+
+            async def read() -> bytes:
+                return await client.read_gatt_char(chunk_read_handle)
+
+            received = await pull_chunks(write, read, package, pkg_name, wanted)
+            sent = await push_chunks(write, package, pkg_name, offer)
+            await finish(write)
+        self.logger.info(f"BLE transfer: received {len(received)}/{len(wanted)} chunks, sent {sent} bytes")
+        return len(received) == len(wanted)
+
+    async def scan_and_read(self, manifest: Manifest, scan_duration=None, duty: Optional[DutyCycle] = None,
+                            stop: Optional[asyncio.Event] = None):
+        """
+        Scan for devices and read characteristics of matching ones.
+
+        The scan window comes from `duty` when given (and `scan_duration` is
+        not), which also learns from whether anything new was heard.
+        """
+        self.duty = duty
+        if scan_duration is None:
+            scan_duration = duty.next_window() if duty else 15
+        self.discovered_devices = []
+        self.logger.info(f"Scanning for devices with service UUID: {UUID} for {scan_duration:.1f}s")
         
         # Start scanning with callback
         scanner = BleakScanner(detection_callback=self.detection_callback, service_uuids=[UUID])
         await scanner.start()
         await asyncio.sleep(scan_duration)
         await scanner.stop()
+
+        if duty:
+            duty.end_window()
         
-        # Process discovered devices
-        for device in self.discovered_devices:
+        # Process discovered devices, most promising first
+        for device in self.rank_devices(self.discovered_devices):
+            if stop and stop.is_set():
+                # A peer already exchanged manifests with our advertiser
+                break
             self.logger.info(device)
             try:
                 self.logger.info(f"Connecting to device: {device.name} ({device.address}) ({device.rssi})")
                 async with BleakClient(device) as client:
-                    await self.connection_callback(client)
+                    with get_metrics().span("manifest_exchange"):
+                        await self.connection_callback(client)
             except Exception as e:
                 self.logger.error(f"Error connecting to device: {str(e)}")
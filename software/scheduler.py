@@ -0,0 +1,106 @@
+import logging
+from fnmatch import fnmatch
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+from sync import PACK_PREFIX, ChunkVersion
+
+logger = logging.getLogger(__name__)
+
+ChunkKey = Tuple[str, int, int]
+
+
+class TransferScheduler:
+    """
+    Orders the chunks of a diff so that whole files complete as early as
+    possible, and reports each file as complete when its last chunk lands.
+
+    Files are requested one after another rather than interleaved: highest
+    priority first, then smallest remaining transfer first, so a link that
+    drops partway leaves as many usable files behind as it can. Blocks within
+    a file go in order.
+    """
+    def __init__(self, chunks: List[ChunkVersion], priorities: Optional[Dict[str, int]] = None,
+                 package: Optional['Package'] = None, on_file_complete: Optional[Callable[[str], None]] = None):
+        """
+        Args:
+            chunks (list): The diff, as returned by Package.get_missing_chunks
+            priorities (Dict, optional): Glob pattern -> priority; a file gets the
+                                         highest priority of the patterns it
+                                         matches, 0 if none. Higher goes first.
+            package (Package, optional): The receiving package, used to size
+                                         blocks and to list the files in packs
+            on_file_complete (Callable, optional): Called with each file's path
+                                                   once all its chunks are in
+        """
+        self.priorities = priorities or {}
+        self.package = package
+        self.on_file_complete = on_file_complete
+
+        self.by_file: Dict[str, List[ChunkVersion]] = {}
+        for chunk in chunks:
+            self.by_file.setdefault(chunk.file_path, []).append(chunk)
+        self.remaining: Dict[str, Set[ChunkKey]] = {
+            path: {(chunk.file_path, chunk.block_number, chunk.version) for chunk in file_chunks}
+            for path, file_chunks in self.by_file.items()
+        }
+        self.completed: List[str] = []
+
+    def priority(self, path: str) -> int:
+        return max((priority for pattern, priority in self.priorities.items() if fnmatch(path, pattern)),
+                   default=0)
+
+    def _transfer_bytes(self, path: str) -> int:
+        total = 0
+        for chunk in self.by_file[path]:
+            if chunk.block_size:
+                total += chunk.block_size
+            elif self.package is not None:
+                total += self.package.get_block_size(path)
+            else:
+                total += 1
+        return total
+
+    def order(self) -> List[ChunkVersion]:
+        """The chunks still missing, in the order to request them."""
+        files = sorted(
+            (path for path in self.by_file if self.remaining[path]),
+            key=lambda path: (-self.priority(path), self._transfer_bytes(path), path)
+        )
+        return [
+            chunk
+            for path in files
+            for chunk in sorted(self.by_file[path], key=lambda chunk: chunk.block_number)
+            if (chunk.file_path, chunk.block_number, chunk.version) in self.remaining[path]
+        ]
+
+    def received(self, file_path: str, block_number: int, version: int) -> List[str]:
+        """
+        Note that a chunk arrived.
+
+        Returns:
+            list: Files that this chunk completed: the file itself, or for a
+                  pack, the files that now live in it
+        """
+        remaining = self.remaining.get(file_path)
+        if not remaining or (file_path, block_number, version) not in remaining:
+            return []
+        remaining.discard((file_path, block_number, version))
+        if remaining:
+            return []
+
+        done = [file_path]
+        if file_path.startswith(PACK_PREFIX) and self.package is not None:
+            done = sorted(path for path, entry in self.package.manifest.packed.items() if entry[0] == file_path)
+        for path in done:
+            self.completed.append(path)
+            logger.info(f"[scheduler] {path} complete")
+            if self.on_file_complete:
+                try:
+                    self.on_file_complete(path)
+                except Exception as e:
+                    # The file is complete either way
+                    logger.error(f"[scheduler] Completion hook for {path} failed: {e}")
+        return done
+
+    def files_remaining(self) -> int:
+        return sum(1 for remaining in self.remaining.values() if remaining)
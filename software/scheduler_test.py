@@ -0,0 +1,59 @@
+import tempfile
+
+from scheduler import TransferScheduler
+from sync import *
+
+
+def test_whole_files_first_smallest_and_most_urgent_first():
+    source = Package("my-package", 1)
+    source.add_file("/img/disk.bin", bytes(range(256)) * 4096, block_size=64 * 1024)  # 16 blocks
+    source.add_file("/lib/libfoo.so", b"f" * 200_000, block_size=64 * 1024)          # 4 blocks
+    source.add_file("/etc/security/fix.conf", b"patched\n" * 20_000, block_size=64 * 1024)
+    source.add_file("/etc/motd", b"hello\n")
+
+    peer = Package("my-package", 1)
+    completed = []
+    scheduler = TransferScheduler(peer.get_missing_chunks(source.manifest.to_dict()),
+                                  priorities={"/etc/security/*": 10}, package=peer,
+                                  on_file_complete=completed.append)
+    order = scheduler.order()
+    files = [path for n, path in enumerate(chunk.file_path for chunk in order)
+             if n == 0 or order[n - 1].file_path != path]
+    assert files == ["/etc/security/fix.conf", "/etc/motd", "/lib/libfoo.so", "/img/disk.bin"]
+    assert [chunk.block_number for chunk in order if chunk.file_path == "/img/disk.bin"] == list(range(16))
+
+    # The link drops after 8 chunks: every file but the image is usable
+    for chunk in order[:8]:
+        peer.write_chunk(chunk.file_path, chunk.block_number,
+                         source.read_chunk(chunk.file_path, chunk.block_number, padded=False),
+                         chunk.version, chunk.block_size)
+        scheduler.received(chunk.file_path, chunk.block_number, chunk.version)
+    assert completed == ["/etc/security/fix.conf", "/etc/motd", "/lib/libfoo.so"]
+    assert scheduler.files_remaining() == 1
+    assert {chunk.file_path for chunk in scheduler.order()} == {"/img/disk.bin"}
+
+    with tempfile.TemporaryDirectory() as target:
+        assert peer.materialize(target, paths=completed)["files"] == 3
+        with open(f"{target}/lib/libfoo.so", "rb") as f:
+            assert f.read() == b"f" * 200_000
+
+
+def test_pack_completes_the_files_in_it():
+    source = Package("my-package", 1, pack_small_files=True)
+    source.add_files({"/etc/a.conf": b"a", "/etc/b.conf": b"b"})
+    peer = Package("my-package", 1)
+    def failing_hook(path):
+        raise OSError("disk full")
+    scheduler = TransferScheduler(peer.get_missing_chunks(source.manifest.to_dict()), package=peer,
+                                  on_file_complete=failing_hook)
+    [chunk] = scheduler.order()
+    peer.sync_chunks(source, [chunk])
+    # A failing hook doesn't stop the files from counting as complete
+    assert scheduler.received(chunk.file_path, 0, chunk.version) == ["/etc/a.conf", "/etc/b.conf"]
+    assert scheduler.completed == ["/etc/a.conf", "/etc/b.conf"]
+
+
+if __name__ == "__main__":
+    test_whole_files_first_smallest_and_most_urgent_first()
+    test_pack_completes_the_files_in_it()
+    print("tests passed")
@@ -0,0 +1,302 @@
+"""
+Append-only segment store for chunk data.
+
+Chunks are appended to large segment files instead of getting a file each,
+so writes are sequential and the directory holds a handful of entries
+rather than one per chunk version. Each record is
+
+    magic (4) | kind (1) | name length (2) | data length (4) | name | data
+
+and an in-memory offset index (chunk name -> segment, offset, length) is
+rebuilt by scanning the record headers at startup. Deleting a chunk appends
+a small tombstone record; compaction copies the live chunks out of mostly
+dead segments and removes them.
+"""
+import logging
+import os
+import struct
+import threading
+from pathlib import Path
+from typing import BinaryIO, Dict, Iterator, List, Optional, Set, Tuple
+
+from chunk_store import ChunkStore
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SEGMENT_BYTES = 64 * 1048576
+DEFAULT_COMPACT_RATIO = 0.5  # Compact segments once this share of them is dead
+
+COPY_BYTES = 1048576  # Chunks written from files are copied in this much at a time
+
+MAGIC = b"SEG1"
+HEADER = struct.Struct(">4sBHI")
+PUT = 0
+DELETE = 1
+
+
+class SegmentStore(ChunkStore):
+    """
+    Chunk store packing many chunks into `<n>.seg` segment files.
+
+    Reads use os.pread on a cached descriptor per segment.
+    """
+    def __init__(self, directory: str, segment_bytes: int = DEFAULT_SEGMENT_BYTES,
+                 compact_ratio: float = DEFAULT_COMPACT_RATIO, fsync: bool = False):
+        """
+        Args:
+            directory (str): Directory holding the segment files; created if missing
+            segment_bytes (int): Start a new segment once the current one reaches this size
+            compact_ratio (float): Share of dead bytes from which compact() rewrites a segment
+            fsync (bool): fdatasync the segment after every write
+        """
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.segment_bytes = segment_bytes
+        self.compact_ratio = compact_ratio
+        self.fsync = fsync
+
+        # Chunk name -> (segment, data offset, length)
+        self.entries: Dict[str, Tuple[int, int, int]] = {}
+        # Segment -> bytes in it, and bytes of them no longer needed
+        self.sizes: Dict[int, int] = {}
+        self.dead: Dict[int, int] = {}
+        self._fds: Dict[int, int] = {}
+        self._unsynced: Set[int] = set()  # Segments appended to since the last sync()
+        self._new_segment = False          # A segment file was created since the last sync()
+        self._lock = threading.RLock()
+
+        for segment in sorted(int(path.stem) for path in self.directory.glob("*.seg") if path.stem.isdigit()):
+            self._load_segment(segment)
+        self.active = max(self.sizes, default=0)
+        if self.active == 0:
+            self._start_segment()
+
+    def _path(self, segment: int) -> Path:
+        return self.directory / f"{segment:08d}.seg"
+
+    def _fd(self, segment: int) -> int:
+        fd = self._fds.get(segment)
+        if fd is None:
+            fd = os.open(self._path(segment), os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+            self._fds[segment] = fd
+        return fd
+
+    def _scan(self, segment: int) -> Iterator[Tuple[int, str, int, int, int]]:
+        """
+        Walk a segment's records, stopping at the first incomplete or corrupt one.
+
+        Yields:
+            tuple: (kind, name, data offset, data length, end of record)
+        """
+        size = os.fstat(self._fd(segment)).st_size
+        with open(self._path(segment), 'rb') as f:
+            position = 0
+            while position + HEADER.size <= size:
+                magic, kind, name_length, length = HEADER.unpack(f.read(HEADER.size))
+                end = position + HEADER.size + name_length + length
+                if magic != MAGIC or kind not in (PUT, DELETE) or end > size:
+                    return
+                name = f.read(name_length).decode('utf-8')
+                f.seek(length, os.SEEK_CUR)
+                yield kind, name, position + HEADER.size + name_length, length, end
+                position = end
+
+    def _load_segment(self, segment: int):
+        self.sizes[segment] = 0
+        self.dead[segment] = 0
+        valid = 0
+        for kind, name, offset, length, end in self._scan(segment):
+            self._forget(name)
+            if kind == PUT:
+                self.entries[name] = (segment, offset, length)
+            else:
+                self.dead[segment] += end - valid
+            self.sizes[segment] = valid = end
+
+        size = os.fstat(self._fd(segment)).st_size
+        if valid < size:
+            # A write that was cut short (power loss); later records can't be trusted
+            logger.warning(f"[segments] Truncating {self._path(segment)} from {size} to {valid} bytes")
+            os.ftruncate(self._fd(segment), valid)
+
+    def _forget(self, name: str):
+        """Drop a chunk from the index, counting its record as dead."""
+        entry = self.entries.pop(name, None)
+        if entry is not None:
+            segment, offset, length = entry
+            if segment in self.dead:
+                self.dead[segment] += HEADER.size + len(name.encode('utf-8')) + length
+
+    def _start_segment(self):
+        self.active = max(self.sizes, default=0) + 1
+        self.sizes[self.active] = 0
+        self.dead[self.active] = 0
+        self._fd(self.active)
+        self._new_segment = True
+
+    def _append(self, kind: int, name: str, data: bytes, source: Optional[BinaryIO] = None,
+                length: int = 0) -> Tuple[int, int]:
+        """
+        Append a record holding `data`, or the `length` bytes read from `source`
+        (a piece at a time) if given. Returns the record's (segment, data offset).
+        """
+        if source is None:
+            length = len(data)
+        encoded = name.encode('utf-8')
+        record_size = HEADER.size + len(encoded) + length
+        if self.sizes[self.active] and self.sizes[self.active] + record_size > self.segment_bytes:
+            self._start_segment()
+
+        fd = self._fd(self.active)
+        start = self.sizes[self.active]
+        os.writev(fd, [HEADER.pack(MAGIC, kind, len(encoded), length), encoded, data])
+        copied = 0
+        while source is not None and copied < length:
+            piece = source.read(min(COPY_BYTES, length - copied))
+            if not piece:
+                os.ftruncate(fd, start)
+                raise ValueError(f"{name}: source ended after {copied} of {length} bytes")
+            os.write(fd, piece)
+            copied += len(piece)
+        if self.fsync:
+            os.fdatasync(fd)
+        else:
+            self._unsynced.add(self.active)
+        self.sizes[self.active] = start + record_size
+        return self.active, start + HEADER.size + len(encoded)
+
+    def write(self, name: str, data: bytes):
+        with self._lock:
+            self._forget(name)
+            segment, offset = self._append(PUT, name, data)
+            self.entries[name] = (segment, offset, len(data))
+
+    def write_file(self, name: str, path: str):
+        with self._lock, open(path, 'rb') as source:
+            self._forget(name)
+            length = os.fstat(source.fileno()).st_size
+            segment, offset = self._append(PUT, name, b"", source, length)
+            self.entries[name] = (segment, offset, length)
+
+    def read(self, name: str) -> Optional[bytes]:
+        with self._lock:
+            entry = self.entries.get(name)
+            if entry is None:
+                return None
+            segment, offset, length = entry
+            fd = self._fd(segment)
+        return os.pread(fd, length, offset)
+
+    def read_range(self, name: str, offset: int, length: int) -> Optional[bytes]:
+        with self._lock:
+            entry = self.entries.get(name)
+            if entry is None:
+                return None
+            segment, start, size = entry
+            fd = self._fd(segment)
+        offset = min(offset, size)
+        return os.pread(fd, min(length, size - offset), start + offset)
+
+    def length(self, name: str) -> Optional[int]:
+        entry = self.entries.get(name)
+        return entry[2] if entry else None
+
+    def delete(self, name: str) -> int:
+        with self._lock:
+            entry = self.entries.get(name)
+            if entry is None:
+                return 0
+            self._forget(name)
+            self._append(DELETE, name, b"")
+            # The tombstone itself is only needed until the segments before it are compacted
+            self.dead[self.active] += HEADER.size + len(name.encode('utf-8'))
+            return entry[2]
+
+    def usage(self) -> int:
+        return sum(self.sizes.values())
+
+    def sync(self):
+        with self._lock:
+            for segment in sorted(self._unsynced):
+                if segment in self.sizes:
+                    os.fdatasync(self._fd(segment))
+            self._unsynced.clear()
+            if self._new_segment:
+                fd = os.open(self.directory, os.O_RDONLY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+                self._new_segment = False
+
+    def compact(self, ratio: Optional[float] = None) -> int:
+        """
+        Rewrite sealed segments with at least `ratio` (default compact_ratio)
+        dead bytes: their live chunks are appended to the active segment, which
+        is synced before the old segments are removed.
+
+        Returns:
+            int: Bytes of disk reclaimed
+        """
+        ratio = self.compact_ratio if ratio is None else ratio
+        with self._lock:
+            victims: List[int] = [
+                segment for segment in sorted(self.sizes)
+                if segment != self.active and self.sizes[segment]
+                and self.dead[segment] >= ratio * self.sizes[segment]
+            ]
+            if not victims:
+                return 0
+
+            before = self.usage()
+            for segment in victims:
+                # Tombstones still matter while an older segment might hold the chunk
+                keep_tombstones = any(other < segment and other not in victims for other in self.sizes)
+                fd = self._fd(segment)
+                for kind, name, offset, length, _ in list(self._scan(segment)):
+                    if kind == PUT and self.entries.get(name) == (segment, offset, length):
+                        data = os.pread(fd, length, offset)
+                        self.entries[name] = (*self._append(PUT, name, data), length)
+                    elif kind == DELETE and keep_tombstones and name not in self.entries:
+                        self._append(DELETE, name, b"")
+                        self.dead[self.active] += HEADER.size + len(name.encode('utf-8'))
+
+            for segment in sorted(self.sizes):
+                if segment not in victims:
+                    os.fsync(self._fd(segment))
+            for segment in victims:
+                self._close_segment(segment)
+                self._path(segment).unlink()
+                del self.sizes[segment]
+                del self.dead[segment]
+            reclaimed = before - self.usage()
+        logger.info(f"[segments] Compacted {len(victims)} segments, reclaimed {reclaimed} bytes")
+        return reclaimed
+
+    def import_files(self, suffix: str = ".chunk") -> int:
+        """
+        Move chunks stored one per file (by FileChunkStore) in our directory
+        into segments.
+
+        Returns:
+            int: Number of chunks imported
+        """
+        paths = sorted(self.directory.glob(f"*{suffix}"))
+        for path in paths:
+            self.write(path.name, path.read_bytes())
+        if paths:
+            os.fsync(self._fd(self.active))
+            for path in paths:
+                path.unlink()
+            logger.info(f"[segments] Imported {len(paths)} chunk files")
+        return len(paths)
+
+    def _close_segment(self, segment: int):
+        fd = self._fds.pop(segment, None)
+        if fd is not None:
+            os.close(fd)
+
+    def close(self):
+        with self._lock:
+            for segment in list(self._fds):
+                self._close_segment(segment)
@@ -0,0 +1,75 @@
+import os
+import tempfile
+
+from segments import HEADER, SegmentStore
+from sync import Package
+
+
+def test_reopen_compact_and_torn_tail():
+    with tempfile.TemporaryDirectory() as directory:
+        store = SegmentStore(directory, segment_bytes=4096)
+        for n in range(40):
+            store.write(f"chunk{n}", bytes([n]) * 500)
+        store.write("chunk0", b"rewritten")
+        for n in range(1, 30):
+            store.delete(f"chunk{n}")
+        assert len(list(os.scandir(directory))) == 6
+        usage = store.usage()
+
+        # Mostly dead segments are rewritten; what's left reads the same
+        assert store.compact() > 0
+        assert store.usage() < usage / 2
+        assert store.read("chunk0") == b"rewritten"
+        assert store.read("chunk35") == bytes([35]) * 500
+        assert store.read("chunk5") is None
+        assert store.read_range("chunk31", 490, 100) == bytes([31]) * 10
+        assert store.read_range("chunk5", 0, 100) is None
+
+        # A write cut short is dropped when the store is opened again
+        store.write("partial", b"x" * 1000)
+        segment = store.active
+        store.close()
+        path = os.path.join(directory, f"{segment:08d}.seg")
+        os.truncate(path, os.path.getsize(path) - 10)
+
+        store = SegmentStore(directory, segment_bytes=4096)
+        assert store.read("partial") is None
+        assert store.read("chunk5") is None
+        assert store.read("chunk0") == b"rewritten"
+        assert sorted(store.entries) == ["chunk0"] + [f"chunk{n}" for n in range(30, 40)]
+        assert os.path.getsize(path) == store.sizes[segment]
+        store.close()
+
+
+def test_package_on_segments():
+    with tempfile.TemporaryDirectory() as base:
+        # Chunk files from before segments are moved into them
+        pkg = Package("my-package", 1, base)
+        pkg.write_chunk("/src/file1.txt", 0, b"Hello World", version=1)
+        pkg = Package("my-package", 1, base, use_index=True, use_segments=True)
+        pkg.load_from_filesystem()
+        assert not any(name.endswith(".chunk") for name in os.listdir(pkg.chunk_storage))
+        assert pkg.read_chunk("/src/file1.txt", 0, padded=False) == b"Hello World"
+
+        pkg.write_chunk("/src/file1.txt", 0, b"Updated content", version=2)
+        assert pkg.read_chunk_range("/src/file1.txt", 0, 2, 8, 100) == b"content"
+        source = os.path.join(base, "received")
+        with open(source, "wb") as f:
+            f.write(b"x" * 3000)
+        assert pkg.write_chunk_file("/src/file2.txt", 0, source, version=1)
+        assert pkg.read_chunk("/src/file2.txt", 0, padded=False) == b"x" * 3000
+        assert pkg.delete_chunk_version("/src/file1.txt", 0, 1) == len(b"Hello World")
+        # Without the index, the package is opened from a manifest snapshot
+        pkg.save_manifest()
+        pkg.store.close()
+
+        pkg = Package("my-package", 1, base, use_segments=True)
+        pkg.load_from_filesystem()
+        assert pkg.read_chunk("/src/file1.txt", 0, padded=False) == b"Updated content"
+        assert pkg.storage_usage() == pkg.store.usage() > HEADER.size
+
+
+if __name__ == "__main__":
+    test_reopen_compact_and_torn_tail()
+    test_package_on_segments()
+    print("tests passed")
@@ -1,18 +1,116 @@
+from collections import OrderedDict
+from contextlib import contextmanager
 from dataclasses import dataclass
 import hashlib
-from typing import Dict, Set, List, Optional, Tuple
+from typing import Dict, Iterable, Set, List, Optional, Tuple
 from pathlib import Path
 import json
+import os
+import sys
+import threading
+import time
+
+DEFAULT_BLOCK_SIZE = 1048576 * 4  # 4 MB
+DEFAULT_MANIFEST_HISTORY = 4096  # Block changes remembered for delta manifests
+FILE_READ_BYTES = 1048576  # Chunks written from files are hashed this much at a time
+
+# Per-file block sizes are picked from this range (powers of two)
+MIN_BLOCK_SIZE = 16 * 1024
+MAX_BLOCK_SIZE = 16 * 1048576
+TARGET_BLOCKS_PER_FILE = 256
+HOT_CHANGES_PER_DAY = 24        # Files edited more often get finer blocks
+COLD_CHANGES_PER_DAY = 1 / 30   # Files edited less often get coarser blocks
+MANIFEST_BYTES_PER_BLOCK = 10   # A block's entry in the JSON manifest, e.g. '"1234":5,'
+MANIFEST_SENDS_PER_DAY = 24     # Full manifests sent to peers in a day, about one per round
+EDIT_HISTORY = 8                # add_file times kept per file to estimate how often it changes
+
+# Pack mode: small files are stored together in content-addressed pack chunks
+PACK_PREFIX = "/.packs/"
+PACK_THRESHOLD = 64 * 1024      # Files up to this size are packed
+PACK_SIZE = 1048576             # Target size of a pack
+
+# Change log entries that aren't blocks
+_PACKED = -1
+_REMOVED = -2
+
+
+def _native_lock() -> threading.Lock:
+    """
+    A lock that blocks the OS thread even once eventlet has patched
+    threading, so it works across eventlet's tpool threads and the hub.
+    Without eventlet loaded, threading isn't patched and any lock will do.
+    """
+    patcher = sys.modules.get('eventlet.patcher')
+    if patcher is not None:
+        return patcher.original('threading').Lock()
+    return threading.Lock()
+
+
+def run_native(fn, *args):
+    """
+    Call `fn` on a native thread (eventlet's tpool) if eventlet has patched
+    threading, so waiting on a native lock such as Package.io_lock holds up
+    only that thread rather than the hub. Otherwise just call it.
+    """
+    patcher = sys.modules.get('eventlet.patcher')
+    if patcher is not None and patcher.is_monkey_patched('thread'):
+        from eventlet import tpool
+        return tpool.execute(fn, *args)
+    return fn(*args)
+
+
+def choose_block_size(file_size: int, changes_per_day: float = 0.0) -> int:
+    """
+    Pick a block size for a file from its size and how often it changes.
+
+    Aims for about TARGET_BLOCKS_PER_FILE blocks, 4x finer for frequently
+    edited files (so an edit retransmits less) and 4x coarser for rarely
+    edited ones (fewer chunks to track and request), within
+    [MIN_BLOCK_SIZE, MAX_BLOCK_SIZE].
+
+    Every block also costs an entry in each manifest we send. A change
+    retransmits about one block and the file's entries go out once per
+    manifest sent in between, so blocks are never made smaller than
+    sqrt(file_size * MANIFEST_BYTES_PER_BLOCK * sends per change), where the
+    two costs balance.
+    """
+    target = file_size / TARGET_BLOCKS_PER_FILE
+    if changes_per_day >= HOT_CHANGES_PER_DAY:
+        target /= 4
+    elif changes_per_day <= COLD_CHANGES_PER_DAY:
+        target *= 4
+    if changes_per_day > 0:
+        sends_per_change = max(1.0, MANIFEST_SENDS_PER_DAY / changes_per_day)
+        target = max(target, (file_size * MANIFEST_BYTES_PER_BLOCK * sends_per_change) ** 0.5)
+    block_size = MIN_BLOCK_SIZE
+    while block_size < target and block_size < MAX_BLOCK_SIZE:
+        block_size *= 2
+    return block_size
+
+
+def layout_is_newer(size_a: int, max_version_a: int, size_b: int, max_version_b: int) -> bool:
+    """
+    Whether a file laid out in `size_a` blocks supersedes the same file in
+    `size_b` blocks. Re-chunking a file writes every block at a version above
+    all the old ones, so the layout with the highest block version is the
+    newer one; ties go to the smaller block size so peers converge.
+    """
+    if max_version_a != max_version_b:
+        return max_version_a > max_version_b
+    return size_a < size_b
 
 class ChunkedFile:
-    def __init__(self, block_size=1048576 * 4):  # 4 MB default block size
+    def __init__(self, block_size=DEFAULT_BLOCK_SIZE):  # 4 MB default block size
         self.block_size = block_size
         self.blocks = {}  # Dictionary to store blocks with their version history
+        self.lengths = {}  # Unpadded length of each stored block version
         self.total_blocks = 0
     
     def write_block(self, block_number: int, data: bytes, version: int = 1) -> bool:
         if len(data) > self.block_size:
             return False
+
+        self.lengths.setdefault(block_number, {})[version] = len(data)
             
         # Pad blocks that are too short
         if len(data) < self.block_size:
@@ -34,6 +132,14 @@ class ChunkedFile:
             
         return self.blocks[block_number].get(version)
     
+    def get_block_length(self, block_number: int, version: int = None) -> int:
+        """Length of a block version before padding, or None if it isn't stored."""
+        if block_number not in self.blocks:
+            return None
+        if version is None:
+            version = max(self.blocks[block_number].keys())
+        return self.lengths.get(block_number, {}).get(version)
+
     def get_block_versions(self, block_number: int) -> List[int]:
         if block_number not in self.blocks:
             return []
@@ -42,6 +148,14 @@ class ChunkedFile:
     def get_latest_version(self, block_number: int) -> int:
         versions = self.get_block_versions(block_number)
         return max(versions) if versions else None
+
+    def delete_block_version(self, block_number: int, version: int) -> bool:
+        """Drop one stored version of a block. Returns False if it wasn't stored."""
+        if version not in self.blocks.get(block_number, {}):
+            return False
+        del self.blocks[block_number][version]
+        self.lengths.get(block_number, {}).pop(version, None)
+        return True
     
     def get_version_map(self) -> Dict[int, int]:
         """
@@ -50,14 +164,352 @@ class ChunkedFile:
         return {block: max(versions.keys()) 
                 for block, versions in self.blocks.items()}
 
+def _copy_file(src_fd: int, dst_fd: int, length: int):
+    """Copy `length` bytes between file descriptors, in the kernel if possible."""
+    offset = 0
+    if hasattr(os, "copy_file_range"):
+        try:
+            while offset < length:
+                copied = os.copy_file_range(src_fd, dst_fd, length - offset, offset, offset)
+                if copied == 0:
+                    break
+                offset += copied
+            return
+        except OSError:
+            pass
+    while offset < length:
+        data = os.pread(src_fd, min(DEFAULT_BLOCK_SIZE, length - offset), offset)
+        if not data:
+            break
+        os.pwrite(dst_fd, data, offset)
+        offset += len(data)
+
+class Manifest:
+    """
+    In-memory package manifest, updated incrementally as chunks are written.
+
+    The serialized JSON and its digest are cached, and only rebuilt after
+    something changes, so readers (GATT reads, the scanner, save_manifest)
+    can ask for them as often as they like.
+
+    Every change also bumps a sequence number, and the most recent changes are
+    kept so a peer that has seen sequence N can be sent only what changed
+    since. Sequence numbers are only meaningful within one epoch (one run of
+    the node); once a change falls out of the history, older sequence numbers
+    get the full manifest instead.
+    """
+    def __init__(self, name: str, version: int, files: Optional[Dict[str, Dict[int, int]]] = None,
+                 history: int = DEFAULT_MANIFEST_HISTORY, block_sizes: Optional[Dict[str, int]] = None,
+                 packed: Optional[Dict[str, Tuple[str, int, int, int]]] = None,
+                 file_sizes: Optional[Dict[str, int]] = None):
+        self.name = name
+        self.version = version
+        self.files: Dict[str, Dict[int, int]] = files if files is not None else {}
+        # Block size each file is laid out in
+        self.block_sizes: Dict[str, int] = block_sizes if block_sizes is not None else {}
+        # Packed small files: path -> (pack path, offset, length, version)
+        self.packed: Dict[str, Tuple[str, int, int, int]] = packed if packed is not None else {}
+        # Size in bytes of each file, from the length of its last block, where known
+        self.file_sizes: Dict[str, int] = file_sizes if file_sizes is not None else {}
+        self._dict: Optional[Dict] = None
+        self._serialized: Optional[bytes] = None
+        self._digest: Optional[str] = None
+
+        self.epoch = os.urandom(4).hex()
+        self.seq = 0
+        self.history = history
+        # (path, block number) -> sequence number of its last change, oldest first;
+        # packed entries and removed files are logged with block _PACKED / _REMOVED
+        self._changes: "OrderedDict[Tuple[str, int], int]" = OrderedDict()
+        # Deltas can only be computed from this sequence number on
+        self._compacted_seq = 0
+
+    def _invalidate(self):
+        self._dict = None
+        self._serialized = None
+        self._digest = None
+
+    def update(self, path: str, block_number: int, version: int, length: Optional[int] = None) -> bool:
+        """
+        Record a block version, if it is newer than the one we know about.
+        A block for a packed file means it's stored in blocks again. Given the
+        chunk's `length`, the file's size is kept up to date as well.
+
+        Returns:
+            bool: True if the manifest changed
+        """
+        if path in self.packed:
+            del self.packed[path]
+            self._forget_changes(path)
+        blocks = self.files.setdefault(path, {})
+        if blocks.get(block_number, 0) >= version:
+            return False
+        blocks[block_number] = version
+        if length is not None:
+            block_size = self.block_sizes.get(path, DEFAULT_BLOCK_SIZE)
+            size = self.file_sizes.get(path)
+            if size is None or block_number >= (size - 1) // block_size:
+                self.file_sizes[path] = block_number * block_size + length
+        self._invalidate()
+        self._record_change((path, block_number))
+        return True
+
+    def set_file_size(self, path: str, size: int):
+        """Record a file's size, as a peer's manifest describes it."""
+        if self.file_sizes.get(path) != size:
+            self.file_sizes[path] = size
+            self._invalidate()
+
+    def _forget_changes(self, path: str):
+        for key in [key for key in self._changes if key[0] == path]:
+            del self._changes[key]
+
+    def _record_change(self, key: Optional[Tuple[str, int]] = None):
+        self.seq += 1
+        if key is None:
+            return
+        self._changes.pop(key, None)
+        self._changes[key] = self.seq
+        if len(self._changes) > self.history:
+            _, self._compacted_seq = self._changes.popitem(last=False)
+
+    def set_version(self, version: int):
+        if version != self.version:
+            self.version = version
+            self._invalidate()
+            self._record_change()
+
+    def get_block_size(self, path: str) -> Optional[int]:
+        return self.block_sizes.get(path)
+
+    def get_file_version(self, path: str) -> int:
+        """Version of a packed file, or of the newest block of a regular one (0 if unknown)."""
+        if path in self.packed:
+            return self.packed[path][3]
+        return max(self.files.get(path, {}).values(), default=0)
+
+    def set_packed(self, path: str, pack: str, offset: int, length: int, version: int) -> bool:
+        """
+        Record where a packed file's contents live. The file's blocks, if it
+        had any, are forgotten.
+
+        Returns:
+            bool: True if the manifest changed
+        """
+        entry = (pack, offset, length, version)
+        if self.packed.get(path) == entry:
+            return False
+        if path in self.files or path in self.block_sizes:
+            self.files.pop(path, None)
+            self.block_sizes.pop(path, None)
+            self.file_sizes.pop(path, None)
+            self._forget_changes(path)
+        self.packed[path] = entry
+        self._invalidate()
+        self._record_change((path, _PACKED))
+        return True
+
+    def remove_file(self, path: str):
+        """Forget a file (its blocks, block size and pack entry)."""
+        if path not in self.files and path not in self.packed:
+            return
+        self.files.pop(path, None)
+        self.block_sizes.pop(path, None)
+        self.file_sizes.pop(path, None)
+        self.packed.pop(path, None)
+        self._forget_changes(path)
+        self._invalidate()
+        self._record_change((path, _REMOVED))
+
+    def set_block_size(self, path: str, block_size: int) -> bool:
+        """
+        Record the block size a file is laid out in. Changing it starts a new
+        layout, so the file's old block versions are forgotten.
+
+        Returns:
+            bool: True if the manifest changed
+        """
+        current = self.block_sizes.get(path)
+        if current == block_size:
+            return False
+        if current is not None and self.files.get(path):
+            self.files[path] = {}
+            self.file_sizes.pop(path, None)
+            self._forget_changes(path)
+        self.block_sizes[path] = block_size
+        self._invalidate()
+        self._record_change()
+        return True
+
+    def get_version(self, path: str, block_number: int) -> int:
+        """Latest known version of a block, or 0 if we don't have it."""
+        return self.files.get(path, {}).get(block_number, 0)
+
+    def to_dict(self) -> Dict:
+        """
+        Manifest in its JSON form (block numbers as strings).
+        The returned dict is cached and shared, so don't modify it.
+        """
+        if self._dict is None:
+            self._dict = {
+                "name": self.name,
+                "version": self.version,
+                "files": {
+                    path: {str(block): version for block, version in blocks.items()}
+                    for path, blocks in self.files.items()
+                },
+                "block_sizes": dict(self.block_sizes),
+            }
+            if self.packed:
+                self._dict["packed"] = {path: list(entry) for path, entry in self.packed.items()}
+            if self.file_sizes:
+                self._dict["file_sizes"] = dict(self.file_sizes)
+        return self._dict
+
+    def serialize(self) -> bytes:
+        """Manifest as UTF-8 JSON bytes."""
+        if self._serialized is None:
+            self._serialized = json.dumps(self.to_dict(), separators=(',', ':')).encode('utf-8')
+        return self._serialized
+
+    def serialize_with(self, key: str = "manifest", **fields) -> bytes:
+        """
+        Wrap the cached serialized manifest in a JSON object alongside other
+        fields, without re-encoding the manifest itself.
+        """
+        head = json.dumps(fields, separators=(',', ':')).encode('utf-8')[:-1]
+        if fields:
+            head += b','
+        return head + json.dumps(key).encode('utf-8') + b':' + self.serialize() + b'}'
+
+    def digest(self) -> str:
+        """SHA-256 of the serialized manifest."""
+        if self._digest is None:
+            self._digest = hashlib.sha256(self.serialize()).hexdigest()
+        return self._digest
+
+    def delta_since(self, seq: int) -> Optional[Dict[str, Dict[str, int]]]:
+        """
+        Blocks changed after sequence number `seq`, in the JSON form of "files".
+
+        Returns:
+            dict: The changed entries, or None if the history no longer reaches back to `seq`
+        """
+        changes = self.changes_since(seq)
+        return changes[0] if changes is not None else None
+
+    def changes_since(self, seq: int) -> Optional[Tuple[Dict, Dict, List[str]]]:
+        """
+        Everything that changed after sequence number `seq`.
+
+        Returns:
+            tuple: (changed blocks as in "files", changed entries as in "packed",
+                   removed file paths), or None if the history no longer reaches back to `seq`
+        """
+        if seq < self._compacted_seq or seq > self.seq:
+            return None
+        files: Dict[str, Dict[str, int]] = {}
+        packed: Dict[str, List] = {}
+        removed: List[str] = []
+        for (path, block_number), changed in reversed(self._changes.items()):
+            if changed <= seq:
+                break
+            if block_number == _PACKED:
+                packed[path] = list(self.packed[path])
+            elif block_number == _REMOVED:
+                if path not in self.files and path not in self.packed:
+                    removed.append(path)
+            else:
+                files.setdefault(path, {})[str(block_number)] = self.files[path][block_number]
+        return files, packed, removed
+
+    def serialize_for(self, seen: Optional[Dict] = None, **fields) -> bytes:
+        """
+        Manifest payload for a peer, with other fields alongside.
+
+        Sends a delta if the peer has `seen` (as {"epoch", "seq"}) an earlier
+        sequence number of this manifest that the history still covers, and
+        the full manifest otherwise.
+        """
+        fields.update(epoch=self.epoch, seq=self.seq)
+        if seen and seen.get("epoch") == self.epoch:
+            changes = self.changes_since(seen.get("seq", -1))
+            if changes is not None:
+                delta, packed, removed = changes
+                block_sizes = {path: self.block_sizes[path] for path in delta if path in self.block_sizes}
+                file_sizes = {path: self.file_sizes[path] for path in delta if path in self.file_sizes}
+                fields.update(name=self.name, version=self.version, base=seen["seq"], delta=delta,
+                              block_sizes=block_sizes, file_sizes=file_sizes)
+                if packed:
+                    fields["packed"] = packed
+                if removed:
+                    fields["removed"] = removed
+                return json.dumps(fields, separators=(',', ':')).encode('utf-8')
+        return self.serialize_with(**fields)
+
+    @classmethod
+    def from_dict(cls, manifest: Dict) -> 'Manifest':
+        files = {
+            path: {int(block): version for block, version in blocks.items()}
+            for path, blocks in manifest.get("files", {}).items()
+        }
+        packed = {path: tuple(entry) for path, entry in manifest.get("packed", {}).items()}
+        return cls(manifest.get("name"), manifest.get("version"), files,
+                   block_sizes=dict(manifest.get("block_sizes", {})), packed=packed,
+                   file_sizes=dict(manifest.get("file_sizes", {})))
+
+
+def build_pack(entries: Dict[str, Tuple[bytes, int]]) -> Tuple[bytes, Dict[str, Tuple[int, int, int]]]:
+    """
+    Lay out small files in one pack: a 4-byte big-endian header length, a JSON
+    header mapping each path to [offset, length, version], then the contents.
+
+    Args:
+        entries (Dict): path -> (contents, version)
+
+    Returns:
+        tuple: The pack, and path -> (offset, length, version) for each file in it
+    """
+    index = {}
+    offset = 0
+    for path, (data, version) in entries.items():
+        index[path] = (offset, len(data), version)
+        offset += len(data)
+    header = json.dumps({"files": index}, separators=(',', ':')).encode('utf-8')
+    start = 4 + len(header)
+    index = {path: (start + offset, length, version) for path, (offset, length, version) in index.items()}
+    # Offsets are relative to the contents, so the header doesn't depend on its own length
+    body = b"".join(data for data, _ in entries.values())
+    return len(header).to_bytes(4, 'big') + header + body, index
+
+
+def read_pack_index(pack: bytes) -> Dict[str, Tuple[int, int, int]]:
+    """The files in a pack, as path -> (offset, length, version), offsets from the start of the pack."""
+    header_length = int.from_bytes(pack[:4], 'big')
+    header = json.loads(pack[4:4 + header_length])
+    start = 4 + header_length
+    return {path: (start + offset, length, version) for path, (offset, length, version) in header["files"].items()}
+
+
+def chunk_length(file_size: Optional[int], block_size: int, block_number: int) -> Optional[int]:
+    """Length of a block of a file of `file_size` bytes, or None if that isn't known."""
+    if file_size is None or block_number * block_size >= file_size:
+        return None
+    return min(block_size, file_size - block_number * block_size)
+
+
 @dataclass
 class ChunkVersion:
     block_number: int
     version: int
     file_path: str
+    block_size: Optional[int] = None  # Block size of the file's layout, if known
+    length: Optional[int] = None      # Length of the chunk, if the file's size is known
 
 class Package:
-    def __init__(self, name: str, version: int, base_path: Optional[str] = None):
+    def __init__(self, name: str, version: int, base_path: Optional[str] = None, use_index: bool = False,
+                 cache_bytes: int = 0, block_size: int = DEFAULT_BLOCK_SIZE, pack_small_files: bool = False,
+                 use_segments: bool = False):
         """
         Initialize a Package with optional filesystem storage.
         
@@ -65,10 +517,25 @@ class Package:
             name (str): Package name
             version (int): Package version
             base_path (str, optional): Base directory for storing package files
+            use_index (bool, optional): Keep the chunk index in SQLite under
+                                        base_path and read chunks from disk on
+                                        demand, instead of holding them in memory
+            cache_bytes (int, optional): Memory budget for caching chunks read
+                                         from disk; 0 disables the cache
+            block_size (int, optional): Block size for the package's files
+            pack_small_files (bool, optional): Store files of up to PACK_THRESHOLD
+                                               bytes added with add_files together
+                                               in shared pack chunks
+            use_segments (bool, optional): Append chunks to large segment files
+                                           under base_path instead of writing a
+                                           file per chunk version
         """
         self.name = name
         self.version = version
+        self.block_size = block_size
+        self.pack_small_files = pack_small_files
         self.files: Dict[str, ChunkedFile] = {}
+        self.manifest = Manifest(name, version)
         
         # Setup filesystem storage
         if base_path:
@@ -77,10 +544,53 @@ class Package:
             self.chunk_storage = self.base_path / "chunks"
             self.chunk_storage.mkdir(exist_ok=True)
             self.manifest_path = self.base_path / "manifest.json"
+            self.edits_path = self.base_path / "edits.json"
         else:
             self.base_path = None
             self.chunk_storage = None
             self.manifest_path = None
+            self.edits_path = None
+
+        # Where chunk data lives on disk
+        self.store = None
+        if self.chunk_storage and use_segments:
+            from segments import SegmentStore
+            self.store = SegmentStore(self.chunk_storage)
+            # Chunks stored before segments were used are moved over once
+            self.store.import_files()
+        elif self.chunk_storage:
+            from chunk_store import FileChunkStore
+            self.store = FileChunkStore(self.chunk_storage)
+
+        self.index = None
+        if use_index and self.base_path:
+            from chunk_index import ChunkIndex
+            self.index = ChunkIndex(self.base_path / "index.sqlite")
+            if self.index.package() is None:
+                self.index.set_package(name, version)
+
+        # Only chunks read from disk need caching
+        self.cache = None
+        if self.index is not None and cache_bytes:
+            from cache import BlockCache
+            self.cache = BlockCache(cache_bytes)
+
+        # When each file was last updated through add_file, to estimate how
+        # often it changes; kept on disk so restarts don't forget it
+        self._edit_times: Dict[str, List[float]] = {}
+        if self.edits_path is not None and self.edits_path.exists():
+            with open(self.edits_path) as f:
+                self._edit_times = json.load(f)
+
+        # Manifest saves held back by deferred_manifest(): whether one is
+        # owed, and whether the manifest on disk isn't fsynced yet
+        self._defer_manifest = 0
+        self._manifest_deferred = False
+        self._manifest_unsynced = False
+
+        # Package isn't thread-safe: whoever touches it off the main flow
+        # (transfer disk workers, frame prefill, garbage collection) holds this
+        self.io_lock = _native_lock()
     
     def _generate_chunk_filename(self, file_path: str, block_number: int, version: int) -> str:
         """
@@ -102,45 +612,157 @@ class Package:
     def load_from_filesystem(self):
         """
         Load package state from filesystem.
-        Reads existing manifest and chunk files.
+        Reads existing manifest and chunk files, or the chunk index if the
+        package uses one.
         """
+        if self.index is not None:
+            self._load_from_index()
+            return
         if not self.base_path or not self.manifest_path.exists():
             return
+        manifest = self._read_manifest()
         
-        # Load manifest
-        with open(self.manifest_path, 'r') as f:
-            manifest = json.load(f)
-        
-        # Validate manifest package details
-        if manifest['name'] != self.name or manifest['version'] != self.version:
-            raise ValueError("Manifest does not match package details")
-        
+        # Files from before per-file block sizes were all in the package's block size
+        block_sizes = manifest.get('block_sizes', {})
+
         # Reconstruct files from manifest
         for file_path, block_versions in manifest['files'].items():
-            chunked_file = ChunkedFile()
+            chunked_file = ChunkedFile(block_sizes.get(file_path, self.block_size))
+            self.manifest.set_block_size(file_path, chunked_file.block_size)
             
             for block_number_str, version in block_versions.items():
                 block_number = int(block_number_str)
                 
                 # Attempt to load chunk from filesystem
                 chunk_filename = self._generate_chunk_filename(file_path, block_number, version)
-                chunk_path = self.chunk_storage / chunk_filename
+                chunk_data = self.store.read(chunk_filename)
                 
-                if chunk_path.exists():
-                    with open(chunk_path, 'rb') as f:
-                        chunk_data = f.read()
-                    
+                if chunk_data is not None:
                     chunked_file.write_block(block_number, chunk_data, version)
+                    self.manifest.update(file_path, block_number, version, len(chunk_data))
             
             self.files[file_path] = chunked_file
+
+        self._load_packed(manifest)
+
+    def _load_packed(self, manifest: Dict):
+        """Restore the pack entries of a stored manifest whose packs we have."""
+        for file_path, entry in manifest.get('packed', {}).items():
+            if entry[0] in self.manifest.files:
+                self.manifest.set_packed(file_path, *entry)
     
-    def read_chunk(self, path: str, block_number: int, version: int = None) -> bytes:
-        """Read a chunk from a specific file in the package."""
+    def _read_manifest(self) -> Dict:
+        """Parse manifest.json, checking it belongs to this package."""
+        with open(self.manifest_path, 'r') as f:
+            manifest = json.load(f)
+        if manifest['name'] != self.name or manifest['version'] != self.version:
+            raise ValueError("Manifest does not match package details")
+        return manifest
+
+    def _load_from_index(self):
+        """
+        Rebuild the manifest from the SQLite index, without manifest.json or
+        any chunk data: the latest version of each block, each file's block
+        size or pack entry, and the length of each file's last block. A
+        package stored before the index existed is imported once.
+        """
+        if self.index.is_empty() and self.manifest_path.exists():
+            self._import_manifest(self._read_manifest())
+        stored = self.index.package()
+        if stored is None:
+            return
+        if tuple(stored) != (self.name, self.version):
+            raise ValueError("Chunk index does not match package details")
+
+        layouts = self.index.files()
+        for file_path, (block_size, _) in layouts.items():
+            if block_size is not None:
+                self.manifest.set_block_size(file_path, block_size)
+        for file_path, block_versions in self.index.latest_versions().items():
+            # Only the last block's length is needed for the file's size
+            last = max(block_versions)
+            for block_number, version in block_versions.items():
+                length = self.get_chunk_length(file_path, block_number, version) if block_number == last else None
+                self.manifest.update(file_path, block_number, version, length)
+        for file_path, (_, entry) in layouts.items():
+            if entry is not None and entry[0] in self.manifest.files:
+                self.manifest.set_packed(file_path, *entry)
+
+    def _import_manifest(self, manifest: Dict):
+        """Index the chunks and layouts of a package stored before the index existed."""
+        block_sizes = manifest.get('block_sizes', {})
+        for file_path, block_versions in manifest['files'].items():
+            self.index.set_block_size(file_path, block_sizes.get(file_path, self.block_size))
+            for block_number_str, version in block_versions.items():
+                block_number = int(block_number_str)
+                chunk_filename = self._generate_chunk_filename(file_path, block_number, version)
+                data = self.store.read(chunk_filename)
+                if data is not None:
+                    self.index.add(file_path, block_number, version, len(data),
+                                   hashlib.sha256(data).hexdigest(), chunk_filename)
+        for file_path, entry in manifest.get('packed', {}).items():
+            self.index.set_packed(file_path, *entry)
+        self.index.set_package(self.name, self.version)
+
+    def read_chunk(self, path: str, block_number: int, version: int = None, padded: bool = True) -> bytes:
+        """
+        Read a chunk from a specific file in the package.
+
+        Args:
+            path (str): File path
+            block_number (int): Block number
+            version (int, optional): Chunk version; latest if omitted
+            padded (bool, optional): Pad short blocks to the block size, like
+                                     ChunkedFile stores them. Pass False to
+                                     get exactly the bytes that were written.
+        """
+        if self.index is not None:
+            row = self.index.lookup(path, block_number, version)
+            if row is None:
+                return None
+            version, _, _, location = row
+            key = (path, block_number, version)
+            data = self.cache.get(key) if self.cache is not None else None
+            if data is None:
+                data = self.store.read(location)
+                if data is None:
+                    return None
+                if self.cache is not None:
+                    self.cache.put(key, data)
+            if not padded:
+                return data
+            # Match ChunkedFile, which pads short blocks
+            return data.ljust(self.get_block_size(path), b'\0')
+
         if path not in self.files:
             return None
-        return self.files[path].read_block(block_number, version)
+        data = self.files[path].read_block(block_number, version)
+        if data is not None and not padded:
+            data = data[:self.files[path].get_block_length(block_number, version)]
+        return data
     
-    def write_chunk(self, path: str, block_number: int, data: bytes, version: int = 1) -> bool:
+    @contextmanager
+    def pinned_chunk(self, path: str, block_number: int, version: int = None, padded: bool = True):
+        """
+        Read a chunk and keep it pinned in the block cache while it's in use,
+        e.g. while it is being sent to a peer.
+        """
+        key = None
+        if self.cache is not None:
+            row = self.index.lookup(path, block_number, version)
+            if row is not None:
+                version = row[0]
+                key = (path, block_number, version)
+        data = self.read_chunk(path, block_number, version, padded=padded)
+        pinned = key is not None and self.cache.pin(key)
+        try:
+            yield data
+        finally:
+            if pinned:
+                self.cache.unpin(key)
+
+    def write_chunk(self, path: str, block_number: int, data: bytes, version: int = 1,
+                    block_size: Optional[int] = None) -> bool:
         """
         Write a chunk to a specific file in the package, with optional filesystem storage.
         
@@ -149,49 +771,609 @@ class Package:
             block_number (int): Block number
             data (bytes): Chunk data
             version (int, optional): Chunk version
+            block_size (int, optional): Block size of the file's layout; a new
+                                        size replaces the file's stored blocks.
+                                        Defaults to the file's current block size.
         
         Returns:
             bool: True if successful, False otherwise
         """
-        # Ensure file exists in package
-        if path not in self.files:
-            self.files[path] = ChunkedFile()
-        
+        was_packed = path in self.manifest.packed
+        self._set_layout(path, block_size)
+
+        if self.index is not None:
+            success = self._write_indexed_chunk(path, block_number, data, version)
+        else:
+            success = self._write_memory_chunk(path, block_number, data, version)
+
+        if success and path.startswith(PACK_PREFIX):
+            self._adopt_pack(path, data)
+        elif success and was_packed:
+            # The file now lives in blocks, which may leave its old pack unused
+            self._drop_unreferenced_packs()
+        return success
+
+    def write_chunk_file(self, path: str, block_number: int, source: str, version: int = 1,
+                         block_size: Optional[int] = None) -> bool:
+        """
+        Write a chunk from a file, such as a block received in parts. With the
+        chunk index, the file is moved or copied into the store a piece at a
+        time instead of being read into memory.
+
+        Args:
+            path (str): File path
+            block_number (int): Block number
+            source (str): File holding exactly the chunk's data. It may be moved
+                          into the store; anything left there is the caller's
+                          to remove.
+            version (int, optional): Chunk version
+            block_size (int, optional): Block size of the file's layout (see write_chunk)
+
+        Returns:
+            bool: True if successful, False otherwise
+        """
+        if self.index is None or path.startswith(PACK_PREFIX) or path in self.manifest.packed:
+            # Kept in memory, or unpacked, so the data is needed anyway
+            with open(source, 'rb') as f:
+                return self.write_chunk(path, block_number, f.read(), version, block_size)
+
+        self._set_layout(path, block_size)
+        length = os.path.getsize(source)
+        if length > self.get_block_size(path):
+            return False
+        digest = hashlib.sha256()
+        with open(source, 'rb') as f:
+            for piece in iter(lambda: f.read(FILE_READ_BYTES), b""):
+                digest.update(piece)
+
+        chunk_filename = self._generate_chunk_filename(path, block_number, version)
+        self.store.write_file(chunk_filename, source)
+        if self.cache is not None:
+            self.cache.invalidate((path, block_number, version))
+        self._index_chunk(path, block_number, version, length, digest.hexdigest(), chunk_filename)
+        return True
+
+    def _write_memory_chunk(self, path: str, block_number: int, data: bytes, version: int) -> bool:
+        """Store a chunk in its ChunkedFile, and on disk if the package has a base path."""
         # Write chunk to in-memory file
         success = self.files[path].write_block(block_number, data, version)
+        if success:
+            self.manifest.update(path, block_number, version, len(data))
         
         # Store chunk in filesystem if base path is set
-        if success and self.chunk_storage:
+        if success and self.store:
             chunk_filename = self._generate_chunk_filename(path, block_number, version)
-            chunk_path = self.chunk_storage / chunk_filename
-            
-            with open(chunk_path, 'wb') as f:
-                f.write(data)
+            self.store.write(chunk_filename, data)
             
             # Update manifest
             self.save_manifest()
         
         return success
     
-    def save_manifest(self):
+    def _set_layout(self, path: str, block_size: Optional[int]):
+        """
+        Make sure `path` is laid out in `block_size` blocks (its current size,
+        or the package's for new files, if None), dropping the old layout's
+        blocks. Which layout wins is decided when diffing manifests (see
+        get_missing_chunks), so a chunk in a new block size always switches.
+        """
+        current = self.manifest.get_block_size(path)
+        if current is None and path in self.files:
+            current = self.files[path].block_size
+        if block_size is None:
+            block_size = current or self.block_size
+
+        if current is not None and block_size != current:
+            self._drop_file(path)
+
+        if self.index is None and path not in self.files:
+            self.files[path] = ChunkedFile(block_size)
+        if self.manifest.set_block_size(path, block_size) and self.index is not None:
+            self.index.set_block_size(path, block_size)
+
+    def _drop_file(self, path: str):
+        """Delete every stored chunk version of a file."""
+        stored = []
+        if self.index is not None:
+            for block_number, version, _, _, _ in self.index.blocks_of_file(path):
+                self.index.remove(path, block_number, version)
+                if self.cache is not None:
+                    self.cache.invalidate((path, block_number, version))
+                stored.append((block_number, version))
+        elif path in self.files:
+            chunked_file = self.files.pop(path)
+            stored = [(block_number, version)
+                      for block_number, versions in chunked_file.blocks.items() for version in versions]
+
+        if self.store:
+            for block_number, version in stored:
+                self.store.delete(self._generate_chunk_filename(path, block_number, version))
+
+    def add_file(self, path: str, data: bytes, changes_per_day: Optional[float] = None,
+                 block_size: Optional[int] = None) -> List[int]:
+        """
+        Store new contents for a whole file, writing only the blocks that changed.
+
+        The block size comes from choose_block_size. An existing file is only
+        re-chunked when that moves 4x or more away from its current block
+        size, since re-chunking means every peer fetches the whole file again.
+
+        Args:
+            path (str): File path
+            data (bytes): The file's contents
+            changes_per_day (float, optional): How often the file changes; estimated
+                                               from previous add_file calls if omitted
+            block_size (int, optional): Use this block size instead of choosing one
+
+        Returns:
+            list: Block numbers written
+        """
+        edits = self._edit_times.setdefault(path, [])
+        edits.append(time.time())
+        del edits[:-EDIT_HISTORY]
+        if changes_per_day is None:
+            span = edits[-1] - edits[0]
+            changes_per_day = (len(edits) - 1) * 86400 / span if span > 0 else 0.0
+
+        blocks = self.manifest.files.get(path, {})
+        current = self.manifest.get_block_size(path) if blocks else None
+        if block_size is None:
+            block_size = choose_block_size(len(data), changes_per_day)
+            relayout = current is None or block_size >= current * 4 or block_size * 4 <= current
+        else:
+            relayout = block_size != current
+        if not relayout:
+            block_size = current
+        new_layout_version = self.manifest.get_file_version(path) + 1
+
+        count = max(1, -(-len(data) // block_size))
+        # Blocks past the new end are overwritten with empty ones
+        last = max(count, max(blocks, default=-1) + 1) if not relayout else count
+        written = []
+        for block_number in range(last):
+            piece = data[block_number * block_size:(block_number + 1) * block_size]
+            if relayout:
+                version = new_layout_version
+            else:
+                if block_number in blocks and self.read_chunk(path, block_number, padded=False) == piece:
+                    continue
+                version = blocks.get(block_number, 0) + 1
+            if self.write_chunk(path, block_number, piece, version, block_size=block_size):
+                written.append(block_number)
+        if written:
+            self._save_edits()
+        return written
+
+    def _save_edits(self):
+        """Write the add_file history next to the manifest, replacing it whole."""
+        if self.edits_path is None:
+            return
+        tmp_path = self.edits_path.with_suffix(".tmp")
+        with open(tmp_path, 'w') as f:
+            json.dump(self._edit_times, f)
+        os.replace(tmp_path, self.edits_path)
+
+    def add_files(self, files: Dict[str, bytes], changes_per_day: Optional[float] = None) -> List[str]:
+        """
+        Store new contents for a set of files, like add_file for each.
+
+        In pack mode, changed files of up to PACK_THRESHOLD bytes are written
+        together into new packs of about PACK_SIZE, one chunk each, rather
+        than one chunk per file. Existing packs are never rewritten: a file
+        that changes moves to the new pack, and a pack is deleted once none
+        of its files live in it any more.
+
+        Args:
+            files (Dict): path -> contents
+            changes_per_day (float, optional): As for add_file
+
+        Returns:
+            list: Paths of the files that changed
+        """
+        changed = []
+        to_pack: Dict[str, bytes] = {}
+        for path, data in files.items():
+            if self.pack_small_files and len(data) <= PACK_THRESHOLD:
+                if self.read_file(path) != data:
+                    to_pack[path] = data
+                    changed.append(path)
+            elif self.add_file(path, data, changes_per_day):
+                changed.append(path)
+
+        batch: Dict[str, bytes] = {}
+        batch_bytes = 0
+        for path, data in to_pack.items():
+            if batch and batch_bytes + len(data) > PACK_SIZE:
+                self._write_pack(batch)
+                batch, batch_bytes = {}, 0
+            batch[path] = data
+            batch_bytes += len(data)
+        if batch:
+            self._write_pack(batch)
+        return changed
+
+    def _write_pack(self, files: Dict[str, bytes]) -> str:
+        """Write files into a new pack, each at its next version. Returns the pack's path."""
+        entries = {path: (data, self.manifest.get_file_version(path) + 1) for path, data in files.items()}
+        pack, _ = build_pack(entries)
+        pack_path = PACK_PREFIX + hashlib.sha256(pack).hexdigest()[:16]
+        self.write_chunk(pack_path, 0, pack, 1, block_size=len(pack))
+        return pack_path
+
+    def _adopt_pack(self, pack_path: str, pack: bytes):
+        """Take the files in a newly stored pack that are newer than ours."""
+        for path, (offset, length, version) in read_pack_index(pack).items():
+            if version <= self.manifest.get_file_version(path):
+                continue
+            if path in self.manifest.files:
+                self._drop_file(path)
+            if self.manifest.set_packed(path, pack_path, offset, length, version) and self.index is not None:
+                self.index.set_packed(path, pack_path, offset, length, version)
+        self._drop_unreferenced_packs()
+        self.save_manifest()
+
+    def _drop_unreferenced_packs(self):
+        """Delete packs none of whose files live in them any more."""
+        referenced = {entry[0] for entry in self.manifest.packed.values()}
+        unused = [path for path in self.manifest.files if path.startswith(PACK_PREFIX) and path not in referenced]
+        for path in unused:
+            self._drop_file(path)
+            self.manifest.remove_file(path)
+            if self.index is not None:
+                self.index.remove_file(path)
+        if unused:
+            self.save_manifest()
+
+    def read_file(self, path: str) -> Optional[bytes]:
+        """The whole contents of a file, packed or not, or None if we don't have it."""
+        if path in self.manifest.packed:
+            pack, offset, length, _ = self.manifest.packed[path]
+            data = self.read_chunk(pack, 0, padded=False)
+            return data[offset:offset + length] if data is not None else None
+        if path not in self.manifest.files:
+            return None
+
+        block_size = self.get_block_size(path)
+        contents = bytearray(self.get_file_size(path))
+        for block_number in self.manifest.files[path]:
+            data = self.read_chunk(path, block_number, padded=False)
+            if data:
+                offset = block_number * block_size
+                contents[offset:offset + len(data)] = data
+        return bytes(contents)
+
+    def _write_indexed_chunk(self, path: str, block_number: int, data: bytes, version: int) -> bool:
+        """Store a chunk on disk and record it in the SQLite index."""
+        if len(data) > self.get_block_size(path):
+            return False
+
+        chunk_filename = self._generate_chunk_filename(path, block_number, version)
+        self.store.write(chunk_filename, data)
+
+        if self.cache is not None:
+            # Freshly received chunks are likely to be served on to the next peer
+            self.cache.put((path, block_number, version), data)
+        self._index_chunk(path, block_number, version, len(data), hashlib.sha256(data).hexdigest(), chunk_filename)
+        return True
+
+    def _index_chunk(self, path: str, block_number: int, version: int, length: int, digest: str,
+                     chunk_filename: str):
+        """Record a chunk now in the store in the SQLite index (its row only) and the manifest."""
+        self.index.add(path, block_number, version, length, digest, chunk_filename)
+        self.manifest.update(path, block_number, version, length)
+
+    def get_block_versions(self, path: str, block_number: int) -> List[int]:
+        """All stored versions of a block, oldest first."""
+        if self.index is not None:
+            return self.index.versions(path, block_number)
+        if path not in self.files:
+            return []
+        return self.files[path].get_block_versions(block_number)
+
+    def delete_chunk_version(self, path: str, block_number: int, version: int) -> Optional[int]:
+        """
+        Delete a stored chunk version, from memory and from disk. The latest
+        version of a block is never deleted.
+
+        Returns:
+            int: Bytes reclaimed, or None if nothing was deleted
+        """
+        if version >= self.manifest.get_version(path, block_number):
+            return None
+
+        if self.index is not None:
+            row = self.index.lookup(path, block_number, version)
+            if row is None:
+                return None
+            self.index.remove(path, block_number, version)
+            if self.cache is not None:
+                self.cache.invalidate((path, block_number, version))
+        else:
+            if path not in self.files or not self.files[path].delete_block_version(block_number, version):
+                return None
+            if not self.store:
+                return self.files[path].block_size
+
+        return self.store.delete(self._generate_chunk_filename(path, block_number, version))
+
+    def storage_usage(self) -> int:
+        """Bytes used by stored chunks."""
+        if self.store:
+            return self.store.usage()
+        return sum(
+            chunked_file.block_size * len(versions)
+            for chunked_file in self.files.values()
+            for versions in chunked_file.blocks.values()
+        )
+
+    def compact_storage(self) -> int:
+        """
+        Reclaim disk space left by deleted chunk versions, for stores that
+        don't free it right away (segments).
+
+        Returns:
+            int: Bytes reclaimed
+        """
+        return self.store.compact() if self.store else 0
+
+    def get_block_size(self, path: str) -> int:
+        """Block size `path` is laid out in (the package's default for unknown files)."""
+        block_size = self.manifest.get_block_size(path)
+        if block_size is not None:
+            return block_size
+        if path in self.files:
+            return self.files[path].block_size
+        return self.block_size
+
+    def get_chunk_length(self, path: str, block_number: int, version: int = None) -> Optional[int]:
+        """Unpadded length of a stored chunk, or None if we don't have it."""
+        if self.index is not None:
+            row = self.index.lookup(path, block_number, version)
+            return row[1] if row else None
+        if path not in self.files:
+            return None
+        return self.files[path].get_block_length(block_number, version)
+
+    def read_chunk_range(self, path: str, block_number: int, version: int, offset: int,
+                         length: int) -> Optional[bytes]:
+        """
+        Part of a chunk (unpadded), without reading the rest of it from disk.
+
+        Args:
+            path (str): File path
+            block_number (int): Block number
+            version (int): Chunk version
+            offset (int): Where in the chunk to start
+            length (int): Bytes to read at most
+
+        Returns:
+            bytes: The data, or None if we don't have the chunk
+        """
+        if self.index is not None:
+            row = self.index.lookup(path, block_number, version)
+            if row is None:
+                return None
+            data = self.cache.get((path, block_number, row[0])) if self.cache is not None else None
+            if data is None:
+                return self.store.read_range(row[3], offset, length)
+            return data[offset:offset + length]
+
+        data = self.read_chunk(path, block_number, version, padded=False)
+        return None if data is None else data[offset:offset + length]
+
+    def get_file_size(self, path: str) -> int:
+        """Size of a file, as described by the latest version of its blocks or its pack entry."""
+        if path in self.manifest.packed:
+            return self.manifest.packed[path][2]
+        block_size = self.get_block_size(path)
+        size = 0
+        for block_number, version in self.manifest.files.get(path, {}).items():
+            length = self.get_chunk_length(path, block_number, version)
+            if length:
+                size = max(size, block_number * block_size + length)
+        return size
+
+    def materialize(self, target_dir: str, atomic: bool = False,
+                    paths: Optional[Iterable[str]] = None) -> Dict[str, int]:
+        """
+        Write the package's files out as real files under `target_dir`.
+
+        A state file in `target_dir` remembers which block versions were
+        written last time, so later calls only rewrite blocks whose version
+        changed, in place with os.pwrite, and then truncate the file to its
+        new size. Rewriting a block is idempotent, so a crash halfway through
+        is repaired by the next call. New files are built in a temporary file
+        and swapped in with os.replace. A block we can't read yet isn't
+        recorded, so the next call writes it. Files that were materialized
+        but are no longer in the package are deleted.
+
+        Args:
+            target_dir (str): Directory to write the files into
+            atomic (bool, optional): Also swap existing files in atomically.
+                                     The old file is cloned with
+                                     copy_file_range (a cheap reflink on
+                                     filesystems that support it) and patched.
+            paths (Iterable, optional): Only write out these files, e.g. the
+                                        ones a transfer just completed
+
+        Returns:
+            Dict: Number of files and blocks touched, bytes written and files removed
+        """
+        target = Path(target_dir).resolve()
+        target.mkdir(parents=True, exist_ok=True)
+        state_path = target / ".materialized.json"
+        state = {}
+        if state_path.exists():
+            with open(state_path, 'r') as f:
+                state = json.load(f)
+
+        wanted = set(paths) if paths is not None else None
+        stats = {"files": 0, "blocks": 0, "bytes_written": 0, "removed": 0}
+        for path, blocks in self.manifest.files.items():
+            if path.startswith(PACK_PREFIX) or (wanted is not None and path not in wanted):
+                continue
+            dest = self._materialize_path(target, path)
+
+            applied = {int(block): version for block, version in state.get(path, {}).items() if block != "packed"}
+            if not dest.exists():
+                applied = {}
+            changed = [block for block, version in blocks.items() if applied.get(block) != version]
+            if not changed:
+                continue
+
+            dest.parent.mkdir(parents=True, exist_ok=True)
+            written, done = self._materialize_file(path, dest, changed, atomic)
+            state[path] = {str(block): version for block, version in blocks.items()
+                           if block in done or (block not in changed and block in applied)}
+            stats["files"] += 1
+            stats["blocks"] += len(done)
+            stats["bytes_written"] += written
+
+        # Packed files are small, so they're always written out whole
+        for path, (_, _, _, version) in self.manifest.packed.items():
+            if wanted is not None and path not in wanted:
+                continue
+            dest = self._materialize_path(target, path)
+            if dest.exists() and state.get(path) == {"packed": version}:
+                continue
+            data = self.read_file(path)
+            if data is None:
+                continue
+            dest.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = dest.with_name(f".{dest.name}.tmp")
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+                os.fsync(f.fileno())
+            os.replace(tmp_path, dest)
+            state[path] = {"packed": version}
+            stats["files"] += 1
+            stats["blocks"] += 1
+            stats["bytes_written"] += len(data)
+
+        # Files we wrote out earlier that the package no longer has
+        for path in list(state):
+            if path in self.manifest.files or path in self.manifest.packed:
+                continue
+            if wanted is not None and path not in wanted:
+                continue
+            try:
+                self._materialize_path(target, path).unlink()
+            except FileNotFoundError:
+                pass
+            del state[path]
+            stats["removed"] += 1
+
+        tmp_state = state_path.with_name(state_path.name + ".tmp")
+        with open(tmp_state, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp_state, state_path)
+        return stats
+
+    @staticmethod
+    def _materialize_path(target: Path, path: str) -> Path:
+        dest = (target / path.lstrip('/')).resolve()
+        if target not in dest.parents:
+            raise ValueError(f"Refusing to materialize {path} outside {target}")
+        return dest
+
+    def _materialize_file(self, path: str, dest: Path, blocks: List[int], atomic: bool) -> Tuple[int, Set[int]]:
+        """Write `blocks` of a file into `dest`. Returns bytes written and the blocks that were."""
+        block_size = self.get_block_size(path)
+        size = self.get_file_size(path)
+        in_place = dest.exists() and not atomic
+        out_path = dest if in_place else dest.with_name(f".{dest.name}.tmp")
+
+        fd = os.open(out_path, os.O_RDWR | os.O_CREAT | (0 if in_place else os.O_TRUNC), 0o644)
+        try:
+            if dest.exists() and not in_place:
+                # Start from the current contents, then patch the changed blocks
+                with open(dest, 'rb') as src:
+                    _copy_file(src.fileno(), fd, os.fstat(src.fileno()).st_size)
+
+            written = 0
+            done = set()
+            for block_number in sorted(blocks):
+                data = self.read_chunk(path, block_number, padded=False)
+                if data is None:
+                    continue
+                # Short blocks before the end of the file are zero-padded, as in memory
+                offset = block_number * block_size
+                data = data.ljust(min(block_size, max(0, size - offset)), b'\0')
+                written += os.pwrite(fd, data, offset)
+                done.add(block_number)
+            os.ftruncate(fd, size)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+        if not in_place:
+            os.replace(out_path, dest)
+        return written, done
+
+    def save_manifest(self, durable: bool = False):
         """
         Save package manifest to filesystem.
+
+        With a chunk index, the index is the package's record and chunk
+        writes don't save the manifest; manifest.json is then only a snapshot,
+        written when this is called, for opening the package without the index.
+
+        Args:
+            durable (bool, optional): fsync the manifest before returning
         """
         if not self.base_path:
             return
-        
-        manifest = {
-            "name": self.name,
-            "version": self.version,
-            "files": {}
-        }
-        
-        for path, chunked_file in self.files.items():
-            manifest["files"][path] = chunked_file.get_version_map()
-        
-        with open(self.manifest_path, 'w') as f:
-            json.dump(manifest, f, indent=2)
-    
+        if self.index is not None:
+            self.index.set_package(self.name, self.version)
+        if self._defer_manifest and not durable:
+            self._manifest_deferred = True
+            return
+
+        # Replace the manifest whole, so a crash never leaves half of one
+        tmp_path = self.manifest_path.with_suffix(".tmp")
+        with open(tmp_path, 'wb') as f:
+            f.write(self.manifest.serialize())
+            if durable:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp_path, self.manifest_path)
+        self._manifest_deferred = False
+        if durable:
+            dir_fd = os.open(self.base_path, os.O_RDONLY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
+        self._manifest_unsynced = not durable
+
+    @contextmanager
+    def deferred_manifest(self):
+        """
+        Hold back manifest saves made inside the block until the next
+        flush(), so a run of chunk writes rewrites the manifest once.
+        """
+        self._defer_manifest += 1
+        try:
+            yield
+        finally:
+            self._defer_manifest -= 1
+
+    def flush(self, durable: bool = True):
+        """
+        Save a manifest held back by deferred_manifest(), and with `durable`,
+        make everything written so far durable first: chunk data, the chunk
+        index, then the manifest that refers to them.
+        """
+        if durable:
+            if self.store is not None:
+                self.store.sync()
+            if self.index is not None:
+                self.index.sync()
+            if self._manifest_deferred or self._manifest_unsynced:
+                self.save_manifest(durable=True)
+        elif self._manifest_deferred:
+            self.save_manifest()
+
     @classmethod
     def load_manifest(cls, path: str) -> Dict:
         """Load a package manifest from a JSON file."""
@@ -218,6 +1400,8 @@ class Package:
         # Get files from both manifests
         files1 = manifest1.get('files', {})
         files2 = manifest2.get('files', {})
+        sizes1 = manifest1.get('block_sizes', {})
+        sizes2 = manifest2.get('block_sizes', {})
         
         # Check for files that exist in one manifest but not the other
         if set(files1.keys()) != set(files2.keys()):
@@ -230,6 +1414,10 @@ class Package:
                 return True
             
             chunks2 = files2[file_path]
+
+            # Same blocks in a different layout are different data
+            if sizes1.get(file_path, DEFAULT_BLOCK_SIZE) != sizes2.get(file_path, DEFAULT_BLOCK_SIZE):
+                return True
             
             # Check if block numbers differ
             if set(chunks1.keys()) != set(chunks2.keys()):
@@ -240,6 +1428,10 @@ class Package:
                 version2 = chunks2.get(block_number)
                 if version1 != version2:
                     return True
+
+        # Packed files: where each lives and at what version
+        if manifest1.get('packed', {}) != manifest2.get('packed', {}):
+            return True
         
         # If we've made it this far, manifests are identical
         return False
@@ -248,14 +1440,49 @@ class Package:
         """
         Compare with another package manifest and return list of chunks
         that are newer in the other manifest.
+
+        Files may be laid out in different block sizes on each side (manifests
+        without block sizes are in DEFAULT_BLOCK_SIZE). If so, blocks can't be
+        compared one to one: we need all of the peer's blocks if its layout is
+        newer, and none otherwise.
+
+        Packed files are compared by version, and a pack is needed if any of
+        the files in it is newer than ours (and we don't have it already).
         """
         missing_chunks = []
+        their_sizes = other_manifest.get("block_sizes", {})
+        their_file_sizes = other_manifest.get("file_sizes", {})
+        their_files = other_manifest["files"]
+
+        wanted_packs = set()
+        for file_path, (pack, _, _, their_version) in other_manifest.get("packed", {}).items():
+            if their_version > self.manifest.get_file_version(file_path) and pack not in self.manifest.files:
+                wanted_packs.add(pack)
+        for pack in sorted(wanted_packs):
+            if their_files.get(pack):
+                missing_chunks.append(ChunkVersion(
+                    block_number=0,
+                    version=max(their_files[pack].values()),
+                    file_path=pack,
+                    block_size=their_sizes.get(pack),
+                    length=their_file_sizes.get(pack)
+                ))
         
-        for file_path, their_chunks in other_manifest["files"].items():
-            our_chunks = {}
-            if file_path in self.files:
-                our_chunks = self.files[file_path].get_version_map()
+        for file_path, their_chunks in their_files.items():
+            if file_path.startswith(PACK_PREFIX):
+                continue
+            if file_path in self.manifest.packed and \
+                    max(their_chunks.values(), default=0) <= self.manifest.packed[file_path][3]:
+                continue
+            our_chunks = self.manifest.files.get(file_path, {})
+            their_size = their_sizes.get(file_path, DEFAULT_BLOCK_SIZE)
+            our_size = self.get_block_size(file_path)
+            if our_chunks and their_chunks and our_size != their_size:
+                if not layout_is_newer(their_size, max(their_chunks.values()), our_size, max(our_chunks.values())):
+                    continue
+                our_chunks = {}
                 
+            file_size = their_file_sizes.get(file_path)
             for block_number, their_version in their_chunks.items():
                 block_number = int(block_number)  # Convert from JSON string if needed
                 our_version = our_chunks.get(block_number, 0)
@@ -263,7 +1490,9 @@ class Package:
                     missing_chunks.append(ChunkVersion(
                         block_number=block_number,
                         version=their_version,
-                        file_path=file_path
+                        file_path=file_path,
+                        block_size=their_size,
+                        length=chunk_length(file_size, their_size, block_number)
                     ))
                     
         return missing_chunks
@@ -276,17 +1505,20 @@ class Package:
             data = other_package.read_chunk(
                 chunk.file_path, 
                 chunk.block_number, 
-                chunk.version
+                chunk.version,
+                padded=False
             )
-            if data:
+            if data is not None:
                 self.write_chunk(
                     chunk.file_path,
                     chunk.block_number,
                     data,
-                    chunk.version
+                    chunk.version,
+                    chunk.block_size
                 )
                 if chunk.version > self.version:
                     self.version = chunk.version
+                    self.manifest.set_version(chunk.version)
     
     def sync_with_manifest(self, other_manifest: Dict, chunk_fetcher) -> None:
         """
@@ -305,5 +1537,13 @@ class Package:
                     chunk.file_path,
                     chunk.block_number,
                     data,
-                    chunk.version
+                    chunk.version,
+                    chunk.block_size
                 )
+
+
+def chunks_to_offer(package: Package, peer_manifest: Dict) -> List[ChunkVersion]:
+    """The chunks a peer would fetch from us, given its manifest."""
+    peer = Package(package.name, package.version)
+    peer.manifest = Manifest.from_dict(peer_manifest)
+    return peer.get_missing_chunks(package.manifest.to_dict())
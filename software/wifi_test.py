@@ -1,6 +1,9 @@
+import logging
+
 from wifi import connect_to_wifi
 
 def main():
+    logging.basicConfig(level=logging.INFO)
     print("Starting connect_to_wifi")
     connect_to_wifi("rpi1", "password")
 